@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+API test harness
+
+Runs mailctl.py api on a temporary database on localhost and sends concurrent
+reads and writes to it. Checks that a snapshot is taken at startup, that
+every write is answered with the right result, that reads keep being
+answered quickly while writes hash passwords and delete, and that the
+database ends up with the written domains, users and aliases.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent import futures
+
+CONTRIB = os.path.dirname(os.path.abspath(__file__))
+MAILCTL = os.path.join(CONTRIB, os.pardir, 'mailctl.py')
+
+
+class UnixConnection(http.client.HTTPConnection):
+    """
+    HTTP connection over a unix socket
+    """
+
+    def __init__(self, path, timeout=30):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class Harness(object):
+    """
+    Temporary database with its mailctl.py api process
+    """
+
+    def __init__(self, directory, verbose=False):
+        self.directory = directory
+        self.db = os.path.join(directory, 'api.sqlite')
+        self.socket = os.path.join(directory, 'api.sock')
+        self.output = None if verbose else subprocess.DEVNULL
+        self.process = None
+        self.failures = 0
+        connection = sqlite3.connect(self.db)
+        with open(os.path.join(CONTRIB, 'db_schema.sql')) as schema:
+            connection.executescript(schema.read())
+        connection.execute('PRAGMA journal_mode = wal')
+        connection.close()
+
+    def start(self, rounds):
+        """
+        Start mailctl.py api in the background and wait for its socket
+        """
+        config = os.path.join(self.directory, 'mailctl.conf')
+        with open(config, 'w') as stream:
+            stream.write('[passwords]\nrounds = {:d}\n'.format(rounds))
+        self.process = subprocess.Popen(
+            [sys.executable, MAILCTL, '--db', self.db, '--config', config, 'api',
+             '--listen', 'unix:' + self.socket], stdout=self.output)
+        deadline = time.monotonic() + 10
+        while not os.path.exists(self.socket):
+            if time.monotonic() > deadline or self.process.poll() is not None:
+                raise RuntimeError('mailctl.py api did not start')
+            time.sleep(0.05)
+
+    def stop(self):
+        """
+        Stop the api process
+        """
+        self.process.send_signal(signal.SIGTERM)
+        self.process.wait(30)
+
+    def request(self, method, path, body=None):
+        """
+        Send one request, returns HTTP status, reply and seconds taken
+        """
+        connection = UnixConnection(self.socket)
+        start = time.monotonic()
+        try:
+            connection.request(method, path, body=None if body is None else json.dumps(body),
+                               headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+        return response.status, json.loads(data), time.monotonic() - start
+
+    def check(self, description, success, detail=''):
+        """
+        Report the result of a check
+        """
+        if success:
+            print('ok   {}'.format(description))
+        else:
+            print('FAIL {}{}'.format(description, ': ' + detail if detail else ''))
+            self.failures += 1
+
+    def reads(self, stop):
+        """
+        Read domains and aliases until stop is set, returns latencies of the reads
+        """
+        latencies = []
+        while not stop.is_set():
+            for path in ('/domains', '/aliases?limit=50', '/health'):
+                status, reply, elapsed = self.request('GET', path)
+                if status != 200:
+                    raise RuntimeError('GET {} failed with {}: {}'.format(path, status, reply))
+                latencies.append(elapsed)
+        return latencies
+
+    def writes(self, pool, requests):
+        """
+        Send (method, path, body) requests concurrently from pool, returns a
+        description of the failed ones, empty if all succeeded
+        """
+        replies = list(pool.map(lambda request: self.request(*request), requests))
+        return str([reply for status, reply, _ in replies if status != 200][:3]) \
+            if any(status != 200 for status, _, _ in replies) else ''
+
+    def run(self, users, aliases, readers, clients, rounds):
+        """
+        Run all scenarios, returns True if all checks passed
+        """
+        self.start(rounds)
+        snapshots = os.path.join(self.directory, 'snapshots')
+        self.check('snapshot at startup', os.path.isdir(snapshots) and any(
+            name.endswith('.sqlite') for name in os.listdir(snapshots)))
+        self.check('add domain', self.request('POST', '/domains',
+                                              {'name': 'sample.test'})[0] == 200)
+
+        stop = threading.Event()
+        with futures.ThreadPoolExecutor(readers) as reading, \
+                futures.ThreadPoolExecutor(clients) as pool:
+            reads = [reading.submit(self.reads, stop) for number in range(readers)]
+            try:
+                # Users first, aliases need them as destinations
+                start = time.monotonic()
+                failed = self.writes(pool, [('POST', '/users',
+                                             {'email': 'user{}@sample.test'.format(number)})
+                                            for number in range(users)])
+                self.check('{} concurrent user adds in {:.2f}s'.format(
+                    users, time.monotonic() - start), not failed, failed)
+                # Aliases point to the users that are kept, so they do not race deletions.
+                # Password changes hash and deletions take a snapshot while reads go on.
+                requests = [('POST', '/aliases',
+                             {'source': 'alias{}@sample.test'.format(number),
+                              'destination': 'user{}@sample.test'.format(number * 2 % users)})
+                            for number in range(aliases)]
+                requests += [('POST', '/users/user{}@sample.test/password'.format(number), None)
+                             for number in range(0, users, 2)]
+                requests += [('DELETE', '/users/user{}@sample.test'.format(number), None)
+                             for number in range(1, users, 2)]
+                start = time.monotonic()
+                failed = self.writes(pool, requests)
+                self.check('{} concurrent alias adds, password changes and deletions in {:.2f}s'
+                           .format(len(requests), time.monotonic() - start), not failed, failed)
+                duplicate = self.request('POST', '/aliases',
+                                         {'source': 'alias0@sample.test',
+                                          'destination': 'user0@sample.test'})
+                self.check('duplicate alias fails on its own', duplicate[0] == 422)
+            finally:
+                stop.set()
+            try:
+                latencies = sorted(latency for future in reads for latency in future.result())
+            except RuntimeError as error:
+                self.check('reads during writes', False, str(error))
+            else:
+                slowest = latencies[-1] if latencies else 0.0
+                self.check('{} reads during writes, slowest {:.3f}s'.format(
+                    len(latencies), slowest), latencies and slowest < 1.0)
+
+        status, reply, _ = self.request('GET', '/users?limit=100000')
+        expected = sorted('user{}@sample.test'.format(number) for number in range(0, users, 2))
+        self.check('remaining users', status == 200 and sorted(reply['users']) == expected)
+        status, reply, _ = self.request('GET', '/aliases?limit=100000')
+        destinations = sum(len(alias['destinations']) for alias in reply.get('aliases', []))
+        self.check('remaining aliases', status == 200 and destinations == aliases,
+                   '{} destinations'.format(destinations))
+        self.stop()
+        return self.failures == 0
+
+
+def main():
+    """
+    Parse arguments and run the harness in a temporary directory
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-u', '--users', help='users to add (default: 20)',
+                        type=int, default=20)
+    parser.add_argument('-a', '--aliases', help='aliases to add (default: 200)',
+                        type=int, default=200)
+    parser.add_argument('-r', '--readers', help='concurrent reading clients (default: 4)',
+                        type=int, default=4)
+    parser.add_argument('-c', '--clients', help='concurrent writing clients (default: 50)',
+                        type=int, default=50)
+    parser.add_argument('--rounds', help='password hashing rounds (default: 5000)',
+                        type=int, default=5000)
+    parser.add_argument('-v', '--verbose', help='show mailctl.py output',
+                        action='store_true')
+    args = parser.parse_args()
+    if args.users < 2:
+        parser.error('at least 2 users are required')
+    if args.readers < 1 or args.clients < 1:
+        parser.error('at least one reader and one client are required')
+
+    with tempfile.TemporaryDirectory(prefix='mailctl-api-') as directory:
+        harness = Harness(directory, args.verbose)
+        try:
+            success = harness.run(args.users, args.aliases, args.readers, args.clients,
+                                  args.rounds)
+        finally:
+            if harness.process is not None and harness.process.poll() is None:
+                harness.process.kill()
+    sys.exit(0 if success else 1)
+
+
+if __name__ == '__main__':
+    main()
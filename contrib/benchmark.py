@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""
+Benchmark mailctl.py and the Postfix and Dovecot lookup queries
+
+Generates synthetic mail databases of several sizes on the schema in
+contrib/db_schema.sql, times mailctl.py commands and the queries of the contrib
+configuration files on them and writes the results as JSON. Results of two runs
+can be compared to catch regressions.
+"""
+
+import argparse
+import contextlib
+import glob
+import io
+import itertools
+import json
+import os
+import random
+import re
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+CONTRIB = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(CONTRIB, os.pardir))
+
+from mailctl import Database, MailCtl, passlib_enabled  # noqa: E402
+
+# Domains, users and alias rows of each size
+SIZES = {
+    'tiny': (10, 1000, 5000),
+    'small': (100, 10000, 50000),
+    'medium': (1000, 100000, 500000),
+    'large': (10000, 1000000, 5000000),
+}
+# Hash stored for all generated users, hashing a million passwords would take hours
+PASSWORD_HASH = ('{SHA512-CRYPT}$6$rounds=5000$benchmarkbenchma$HrNSFbsIqaPdaMqi9KSE4Wy'
+                 'NNPsjCBHpBYxIbwB0U6Q8G8c3Nk7bCQtJz1bW6C3rUQyG7rSdlCjr0y9jJdEj/')
+# Rows written per transaction while generating
+CHUNK_SIZE = 100000
+# Share of aliases pointing to another alias, and of disabled aliases
+ALIAS_CHAINS = 0.02
+ALIAS_DISABLED = 0.05
+# Rounds of lookups per query
+LOOKUP_ROUNDS = 5
+# Aliases in the single domain of the scaling check, and aliases added one by one.
+# Below the bulk insert threshold, so every row runs the per row triggers.
+SCALING_ALIASES = (2000, 8000)
+SCALING_ROWS = 500
+# Growth of the time per row from the smallest to the largest domain reported as
+# regression. A statement scanning the domain for each row grows with the domain,
+# 4 times here, merging the search index makes inserts up to 2 times slower.
+SCALING_THRESHOLD = 3.0
+
+
+def generate(path, domains, users, aliases, seed):
+    """
+    Create database at path with synthetic domains, users and aliases
+
+    Domain sizes follow a Zipf distribution, so a few domains hold most users.
+    Most aliases have one destination, a few are lists with hundreds.
+    """
+    rng = random.Random(seed)
+    connection = sqlite3.connect(path)
+    with open(os.path.join(CONTRIB, 'db_schema.sql')) as schema:
+        connection.executescript(schema.read())
+    connection.close()
+    db = Database(path, journal_mode='wal', synchronous='off')
+
+    names = ['d{}.bench'.format(number) for number in range(domains)]
+    weights = list(itertools.accumulate(1 / (rank + 1) ** 1.1 for rank in range(domains)))
+    with db.transaction():
+        db.executemany('INSERT INTO virtual_domains (id, name) VALUES (?, ?)',
+                       enumerate(names, 1))
+    user_domains = rng.choices(range(domains), cum_weights=weights, k=users)
+    emails = ['user{}@{}'.format(number, names[domain])
+              for number, domain in enumerate(user_domains)]
+    for start in range(0, users, CHUNK_SIZE):
+        with db.transaction():
+            db.add_users((user_domains[number] + 1, PASSWORD_HASH, emails[number])
+                         for number in range(start, min(start + CHUNK_SIZE, users)))
+
+    sources = []
+    rows = []
+    while aliases > 0:
+        domain = rng.choices(range(domains), cum_weights=weights)[0]
+        source = 'alias{}@{}'.format(len(sources), names[domain])
+        fanout = min(int(rng.paretovariate(1.2)), 500, aliases, users)
+        destinations = [emails[number] for number in rng.sample(range(users), fanout)]
+        # Chains only point to older aliases, so there are no cycles
+        if sources and rng.random() < ALIAS_CHAINS:
+            destinations[0] = rng.choice(sources)
+        enabled = int(rng.random() >= ALIAS_DISABLED)
+        rows.extend((source, destination, domain + 1, enabled)
+                    for destination in destinations)
+        sources.append(source)
+        aliases -= fanout
+        if len(rows) >= CHUNK_SIZE or aliases <= 0:
+            with db.bulk_alias_insert():
+                db.executemany('INSERT INTO virtual_aliases '
+                               '(source, destination, domain_id, enabled) '
+                               'VALUES (?, ?, ?, ?)', rows)
+            rows = []
+    # A long running database has a pruned change log
+    db.prune_changes(db.change_range()[1] + 1)
+    db.execute('VACUUM')
+
+
+def load(path):
+    """
+    Return domain names, user emails and alias sources of database at path
+    """
+    db = Database(path)
+    return {
+        'domains': [name for name, in db.execute('SELECT name FROM virtual_domains '
+                                                 'ORDER BY id')],
+        'users': [email for email, in db.execute('SELECT email FROM virtual_users '
+                                                 'ORDER BY id')],
+        'aliases': [source for source, in db.execute('SELECT source FROM virtual_aliases '
+                                                     'GROUP BY source ORDER BY min(id)')],
+    }
+
+
+def timed(func, runs):
+    """
+    Call func(run) runs times, returns timing statistics in milliseconds
+    """
+    times = []
+    for run in range(runs):
+        start = time.perf_counter()
+        func(run)
+        times.append((time.perf_counter() - start) * 1000)
+    return {'runs': runs, 'median_ms': round(statistics.median(times), 3),
+            'min_ms': round(min(times), 3), 'max_ms': round(max(times), 3)}
+
+
+def mailctl(db, argv, stdin='', check=True):
+    """
+    Run mailctl.py command on open database in this process, discarding output
+
+    With check, a failing command raises RuntimeError.
+    """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        stdin, sys.stdin = sys.stdin, io.StringIO(stdin)
+        try:
+            MailCtl(['--no-snapshot'] + argv, db=db)
+        except SystemExit as error:
+            if error.code and check:
+                raise RuntimeError('mailctl.py {} failed'.format(' '.join(argv)))
+        finally:
+            sys.stdin = stdin
+
+
+def lookup_queries():
+    """
+    Return dictionary of lookup queries in contrib configuration files by name
+    """
+    queries = {}
+    for path in sorted(glob.glob(os.path.join(CONTRIB, 'postfix', '*.cf')) +
+                       glob.glob(os.path.join(CONTRIB, 'dovecot', '*.conf.ext'))):
+        with open(path) as config:
+            for line in config:
+                match = re.match(r'\s*(\w*query)\s*=\s*(.+?);?\s*$', line)
+                if match:
+                    name = '{} {}'.format(os.path.basename(path), match.group(1))
+                    # Postfix and Dovecot insert the quoted key
+                    queries[name] = re.sub(r"'%[su]'", '?', match.group(2))
+    return queries
+
+
+def benchmark(path, data, runs, lookups, seed):
+    """
+    Time mailctl.py commands and lookup queries on database at path
+    """
+    rng = random.Random(seed)
+    db = Database(path)
+    results = {}
+    hits = rng.sample(data['users'], min(lookups, len(data['users'])))
+    aliases = rng.sample(data['aliases'], min(runs, len(data['aliases'])))
+    # Mid-sized domains, the largest ones hold a big share of all rows
+    domains = data['domains'][len(data['domains']) // 2:][:runs]
+
+    commands = [
+        ('user show', lambda run: mailctl(db, ['user', 'show'])),
+        ('alias show', lambda run: mailctl(db, ['alias', 'show'])),
+        ('alias search substring', lambda run: mailctl(
+            db, ['alias', 'search', 'ias{}@'.format(rng.randrange(1000))])),
+        ('alias search exact', lambda run: mailctl(
+            db, ['alias', 'search', '--mode', 'exact', aliases[run % len(aliases)]])),
+        # Chains to disabled aliases are reported as problems, which is no failure here
+        ('alias resolve', lambda run: mailctl(
+            db, ['alias', 'resolve', aliases[run % len(aliases)]], check=False)),
+        ('alias audit', lambda run: mailctl(db, ['alias', 'audit', '--problems'],
+                                            check=False)),
+        ('domain delete', lambda run: mailctl(
+            db, ['domain', 'delete', domains[run % len(domains)]], 'YES\n')),
+    ]
+    if passlib_enabled():
+        commands.insert(0, ('user add', lambda run: mailctl(
+            db, ['user', 'add', '--rounds', '1000', '--workers', '1',
+                 'new{}@{}'.format(run, data['domains'][0])])))
+    for name, func in commands:
+        # Some commands fail on purpose, e.g. resolve with dead ends
+        try:
+            results[name] = timed(func, min(runs, len(domains)) if name == 'domain delete'
+                                  else runs)
+        except RuntimeError as error:
+            results[name] = {'error': str(error)}
+        print('  {:45} {}'.format(name, results[name]), file=sys.stderr)
+
+    for name, query in lookup_queries().items():
+        keys = hits if 'virtual_users' in query else \
+            data['aliases'] if 'virtual_aliases' in query else data['domains']
+        for kind, values in (('hit', keys), ('miss', ['missing@{}'.format(key)
+                                                     for key in keys])):
+            values = [values[number % len(values)] for number in range(lookups)]
+            # Median of several rounds, single lookups are too short to time
+            stats = timed(lambda run: [db.execute(query, (value,)).fetchall()
+                                       for value in values], LOOKUP_ROUNDS)
+            key = '{} {}'.format(name, kind)
+            results[key] = {'runs': lookups * LOOKUP_ROUNDS,
+                            'mean_us': round(stats['median_ms'] * 1000 / lookups, 3)}
+            print('  {:45} {}'.format(key, results[key]), file=sys.stderr)
+    return results
+
+
+def scaling(directory, seed):
+    """
+    Time alias inserts and deletes in one domain holding more and more aliases
+
+    The databases have no statistics from ANALYZE, like most installations.
+    Returns milliseconds per row by number of aliases in the domain.
+    """
+    results = {}
+    for aliases in SCALING_ALIASES:
+        path = os.path.join(directory, 'scaling-{}-{}.sqlite'.format(aliases, seed))
+        if not os.path.exists(path):
+            generate(path, 1, 100, aliases, seed)
+        work = os.path.join(directory, 'scaling-work.sqlite')
+        Database(path).backup(work)
+        db = Database(work)
+        domain = db.execute('SELECT name FROM virtual_domains').fetchone()[0]
+        destination = db.execute('SELECT email FROM virtual_users').fetchone()[0]
+        rows = db.execute('SELECT count(*) FROM virtual_aliases').fetchone()[0]
+        # The commit merges search index segments, which takes longer in larger
+        # domains but once per transaction, so only the statements are timed
+        with db.transaction():
+            start = time.perf_counter()
+            db.add_aliases(('scaling{}@{}'.format(number, domain), destination, '', 1)
+                           for number in range(SCALING_ROWS))
+            insert = (time.perf_counter() - start) * 1000 / SCALING_ROWS
+        start = time.perf_counter()
+        mailctl(db, ['alias', 'delete', '--domain', domain, '--yes'])
+        delete = (time.perf_counter() - start) * 1000 / (rows + SCALING_ROWS)
+        results[str(aliases)] = {'insert_ms_per_row': round(insert, 4),
+                                 'delete_ms_per_row': round(delete, 4)}
+        print('  {:45} {}'.format('{} aliases in domain'.format(aliases),
+                                  results[str(aliases)]), file=sys.stderr)
+        del db
+        os.unlink(work)
+    return results
+
+
+def scaling_regressions(results):
+    """
+    Print per row timings growing with the domain size
+
+    Returns number of timings more than SCALING_THRESHOLD times slower in the
+    largest domain than in the smallest.
+    """
+    smallest, largest = results[str(min(SCALING_ALIASES))], results[str(max(SCALING_ALIASES))]
+    regressions = 0
+    for key in sorted(smallest):
+        ratio = largest[key] / smallest[key] if smallest[key] else 1.0
+        flag = ''
+        if ratio > SCALING_THRESHOLD:
+            flag = ' REGRESSION'
+            regressions += 1
+        print('scaling  {:45} {:>10} -> {:>10} {:6.2f}x{}'.format(
+            key, smallest[key], largest[key], ratio, flag), file=sys.stderr)
+    return regressions
+
+
+def compare(baseline, results, threshold):
+    """
+    Print timings that changed between two result documents
+
+    Returns number of timings slower than threshold times the baseline.
+    """
+    regressions = 0
+    for size, current in results['sizes'].items():
+        previous = baseline['sizes'].get(size)
+        if previous is None:
+            continue
+        for name, timing in current['operations'].items():
+            old = previous['operations'].get(name, {})
+            key = 'median_ms' if 'median_ms' in timing else 'mean_us'
+            if not old.get(key) or key not in timing:
+                continue
+            ratio = timing[key] / old[key]
+            flag = ''
+            if ratio > threshold:
+                flag = ' REGRESSION'
+                regressions += 1
+            print('{:8} {:45} {:>10} -> {:>10} {:6.2f}x{}'.format(
+                size, name, old[key], timing[key], ratio, flag), file=sys.stderr)
+    return regressions
+
+
+def main():
+    """
+    Parse arguments, generate databases and run the benchmarks
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-s', '--size', help='database sizes (default: tiny and small)',
+                        choices=SIZES, action='append')
+    parser.add_argument('-d', '--directory',
+                        help='keep generated databases in this directory and reuse them')
+    parser.add_argument('-r', '--runs', help='runs of each command (default: 5)',
+                        type=int, default=5)
+    parser.add_argument('-l', '--lookups', help='lookups of each query (default: 10000)',
+                        type=int, default=10000)
+    parser.add_argument('--seed', help='random seed (default: 1)', type=int, default=1)
+    parser.add_argument('-o', '--output', help='JSON results file (default: stdout)')
+    parser.add_argument('-c', '--compare', help='JSON results of an earlier run')
+    parser.add_argument('-t', '--threshold',
+                        help='slowdown reported as regression by --compare (default: 1.5)',
+                        type=float, default=1.5)
+    parser.add_argument('--scaling',
+                        help='check that alias inserts and deletes per row do not get '
+                             'slower in larger domains',
+                        action='store_true')
+    args = parser.parse_args()
+
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=CONTRIB,
+                                  capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        revision = None
+    results = {'revision': revision, 'python': sys.version.split()[0],
+               'sqlite': sqlite3.sqlite_version, 'seed': args.seed, 'sizes': {}}
+    with tempfile.TemporaryDirectory(prefix='mailctl-benchmark-') as temp:
+        directory = args.directory or temp
+        os.makedirs(directory, exist_ok=True)
+        for size in args.size or ['tiny', 'small']:
+            domains, users, aliases = SIZES[size]
+            path = os.path.join(directory, 'bench-{}-{}.sqlite'.format(size, args.seed))
+            print('{}: {} domains, {} users, {} aliases'.format(size, domains, users, aliases),
+                  file=sys.stderr)
+            start = time.monotonic()
+            # Generated data only depends on size and seed
+            if not os.path.exists(path):
+                generate(path, domains, users, aliases, args.seed)
+            generate_time = time.monotonic() - start
+            data = load(path)
+            # Commands change the database, work on a copy
+            work = os.path.join(temp, 'work.sqlite')
+            Database(path).backup(work)
+            results['sizes'][size] = {
+                'domains': domains, 'users': users, 'aliases': aliases,
+                'file_bytes': os.path.getsize(path),
+                'generate_seconds': round(generate_time, 2),
+                'operations': benchmark(work, data, args.runs, args.lookups, args.seed),
+            }
+            os.unlink(work)
+        if args.scaling:
+            print('scaling: {} aliases added to a domain of {} aliases'.format(
+                SCALING_ROWS, ' and '.join(map(str, SCALING_ALIASES))), file=sys.stderr)
+            results['scaling'] = scaling(directory, args.seed)
+
+    document = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(document + '\n')
+    else:
+        print(document)
+    regressions = 0
+    if args.scaling:
+        regressions += scaling_regressions(results['scaling'])
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions += compare(json.load(baseline), results, args.threshold)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
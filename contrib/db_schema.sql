@@ -1,4 +1,6 @@
 PRAGMA foreign_keys = ON;
+-- Must be set before the first table is created, see mailctl.py db maintain
+PRAGMA auto_vacuum = INCREMENTAL;
 
 CREATE TABLE IF NOT EXISTS virtual_domains (
   id INTEGER PRIMARY KEY ASC,
@@ -23,3 +25,153 @@ CREATE TABLE IF NOT EXISTS virtual_aliases (
   enabled BOOLEAN DEFAULT 1,
   FOREIGN KEY (domain_id) REFERENCES virtual_domains(id) ON DELETE CASCADE
 );
+
+CREATE UNIQUE INDEX IF NOT EXISTS virtual_domains_name ON virtual_domains (name);
+CREATE UNIQUE INDEX IF NOT EXISTS virtual_users_email ON virtual_users (email);
+CREATE INDEX IF NOT EXISTS virtual_users_domain_id ON virtual_users (domain_id);
+CREATE UNIQUE INDEX IF NOT EXISTS virtual_aliases_source_destination ON virtual_aliases (source, destination);
+CREATE INDEX IF NOT EXISTS virtual_aliases_enabled_source ON virtual_aliases (source, destination, enabled) WHERE enabled;
+CREATE INDEX IF NOT EXISTS virtual_aliases_destination ON virtual_aliases (destination, source);
+CREATE INDEX IF NOT EXISTS virtual_aliases_domain_id ON virtual_aliases (domain_id);
+
+-- Trigram full text index for "mailctl.py alias search", requires SQLite 3.34
+CREATE VIRTUAL TABLE IF NOT EXISTS virtual_aliases_fts USING fts5(
+  source, destination, description,
+  content='virtual_aliases', content_rowid='id', tokenize='trigram'
+);
+
+-- Flags read by triggers, while bulk_insert is set "mailctl.py import" indexes,
+-- logs and counts new aliases with one statement each instead of per row
+CREATE TABLE IF NOT EXISTS mailctl_settings (
+  key TEXT PRIMARY KEY,
+  value TEXT NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS virtual_aliases_fts_insert AFTER INSERT ON virtual_aliases WHEN NOT EXISTS (SELECT 1 FROM mailctl_settings WHERE key = 'bulk_insert') BEGIN
+  INSERT INTO virtual_aliases_fts (rowid, source, destination, description)
+  VALUES (new.id, new.source, new.destination, new.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS virtual_aliases_fts_delete AFTER DELETE ON virtual_aliases BEGIN
+  INSERT INTO virtual_aliases_fts (virtual_aliases_fts, rowid, source, destination, description)
+  VALUES ('delete', old.id, old.source, old.destination, old.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS virtual_aliases_fts_update
+AFTER UPDATE OF source, destination, description ON virtual_aliases BEGIN
+  INSERT INTO virtual_aliases_fts (virtual_aliases_fts, rowid, source, destination, description)
+  VALUES ('delete', old.id, old.source, old.destination, old.description);
+  INSERT INTO virtual_aliases_fts (rowid, source, destination, description)
+  VALUES (new.id, new.source, new.destination, new.description);
+END;
+
+-- Change log read by "mailctl.py changes", seq is never reused
+CREATE TABLE IF NOT EXISTS mailctl_changes (
+  seq INTEGER PRIMARY KEY AUTOINCREMENT,
+  changed TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+  table_name TEXT NOT NULL,
+  operation TEXT NOT NULL,
+  row_id INTEGER NOT NULL,
+  data TEXT NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS virtual_domains_changes_insert AFTER INSERT ON virtual_domains BEGIN
+  INSERT INTO mailctl_changes (table_name, operation, row_id, data)
+  VALUES ('virtual_domains', 'insert', new.id, json_object('id', new.id, 'name', new.name));
+END;
+
+CREATE TRIGGER IF NOT EXISTS virtual_domains_changes_update AFTER UPDATE ON virtual_domains WHEN old.id IS NOT new.id OR old.name IS NOT new.name BEGIN
+  INSERT INTO mailctl_changes (table_name, operation, row_id, data)
+  VALUES ('virtual_domains', 'update', new.id, json_object('id', new.id, 'name', new.name));
+END;
+
+CREATE TRIGGER IF NOT EXISTS virtual_domains_changes_delete AFTER DELETE ON virtual_domains BEGIN
+  INSERT INTO mailctl_changes (table_name, operation, row_id, data)
+  VALUES ('virtual_domains', 'delete', old.id, json_object('id', old.id, 'name', old.name));
+END;
+
+CREATE TRIGGER IF NOT EXISTS virtual_users_changes_insert AFTER INSERT ON virtual_users BEGIN
+  INSERT INTO mailctl_changes (table_name, operation, row_id, data)
+  VALUES ('virtual_users', 'insert', new.id, json_object('id', new.id, 'domain_id', new.domain_id, 'email', new.email));
+END;
+
+CREATE TRIGGER IF NOT EXISTS virtual_users_changes_update AFTER UPDATE ON virtual_users WHEN old.id IS NOT new.id OR old.domain_id IS NOT new.domain_id OR old.email IS NOT new.email OR old.password IS NOT new.password BEGIN
+  INSERT INTO mailctl_changes (table_name, operation, row_id, data)
+  VALUES ('virtual_users', 'update', new.id, json_object('id', new.id, 'domain_id', new.domain_id, 'email', new.email));
+END;
+
+CREATE TRIGGER IF NOT EXISTS virtual_users_changes_delete AFTER DELETE ON virtual_users BEGIN
+  INSERT INTO mailctl_changes (table_name, operation, row_id, data)
+  VALUES ('virtual_users', 'delete', old.id, json_object('id', old.id, 'domain_id', old.domain_id, 'email', old.email));
+END;
+
+CREATE TRIGGER IF NOT EXISTS virtual_aliases_changes_insert AFTER INSERT ON virtual_aliases WHEN NOT EXISTS (SELECT 1 FROM mailctl_settings WHERE key = 'bulk_insert') BEGIN
+  INSERT INTO mailctl_changes (table_name, operation, row_id, data)
+  VALUES ('virtual_aliases', 'insert', new.id, json_object('id', new.id, 'domain_id', new.domain_id, 'source', new.source, 'destination', new.destination, 'description', new.description, 'enabled', new.enabled, 'created', new.created));
+END;
+
+CREATE TRIGGER IF NOT EXISTS virtual_aliases_changes_update AFTER UPDATE ON virtual_aliases WHEN old.id IS NOT new.id OR old.domain_id IS NOT new.domain_id OR old.source IS NOT new.source OR old.destination IS NOT new.destination OR old.description IS NOT new.description OR old.enabled IS NOT new.enabled OR old.created IS NOT new.created BEGIN
+  INSERT INTO mailctl_changes (table_name, operation, row_id, data)
+  VALUES ('virtual_aliases', 'update', new.id, json_object('id', new.id, 'domain_id', new.domain_id, 'source', new.source, 'destination', new.destination, 'description', new.description, 'enabled', new.enabled, 'created', new.created));
+END;
+
+CREATE TRIGGER IF NOT EXISTS virtual_aliases_changes_delete AFTER DELETE ON virtual_aliases BEGIN
+  INSERT INTO mailctl_changes (table_name, operation, row_id, data)
+  VALUES ('virtual_aliases', 'delete', old.id, json_object('id', old.id, 'domain_id', old.domain_id, 'source', old.source, 'destination', old.destination, 'description', old.description, 'enabled', old.enabled, 'created', old.created));
+END;
+
+-- Change log id of this database, and the log and position followed by "mailctl.py replicate"
+CREATE TABLE IF NOT EXISTS mailctl_replication (
+  key TEXT PRIMARY KEY,
+  value TEXT NOT NULL
+);
+
+-- Users, aliases and alias destinations per domain read by "mailctl.py stats"
+CREATE TABLE IF NOT EXISTS mailctl_domain_stats (
+  domain_id INTEGER PRIMARY KEY,
+  users INTEGER NOT NULL DEFAULT 0,
+  aliases INTEGER NOT NULL DEFAULT 0,
+  destinations INTEGER NOT NULL DEFAULT 0,
+  disabled INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER IF NOT EXISTS virtual_domains_stats_insert AFTER INSERT ON virtual_domains BEGIN
+  INSERT OR IGNORE INTO mailctl_domain_stats (domain_id) VALUES (new.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS virtual_domains_stats_update AFTER UPDATE OF id ON virtual_domains BEGIN
+  UPDATE mailctl_domain_stats SET domain_id = new.id WHERE domain_id = old.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS virtual_domains_stats_delete AFTER DELETE ON virtual_domains BEGIN
+  DELETE FROM mailctl_domain_stats WHERE domain_id = old.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS virtual_users_stats_insert AFTER INSERT ON virtual_users BEGIN
+  UPDATE mailctl_domain_stats SET users = users + 1 WHERE domain_id = new.domain_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS virtual_users_stats_update AFTER UPDATE OF domain_id ON virtual_users WHEN old.domain_id IS NOT new.domain_id BEGIN
+  UPDATE mailctl_domain_stats SET users = users - 1 WHERE domain_id = old.domain_id;
+  UPDATE mailctl_domain_stats SET users = users + 1 WHERE domain_id = new.domain_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS virtual_users_stats_delete AFTER DELETE ON virtual_users BEGIN
+  UPDATE mailctl_domain_stats SET users = users - 1 WHERE domain_id = old.domain_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS virtual_aliases_stats_insert AFTER INSERT ON virtual_aliases WHEN NOT EXISTS (SELECT 1 FROM mailctl_settings WHERE key = 'bulk_insert') BEGIN
+  UPDATE mailctl_domain_stats SET aliases = aliases + NOT EXISTS (SELECT 1 FROM virtual_aliases WHERE source = new.source AND id != new.id), destinations = destinations + 1, disabled = disabled + NOT coalesce(new.enabled, 0) WHERE domain_id = new.domain_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS virtual_aliases_stats_update AFTER UPDATE OF domain_id, source, enabled ON virtual_aliases WHEN old.domain_id IS NOT new.domain_id OR old.source IS NOT new.source OR old.enabled IS NOT new.enabled BEGIN
+  UPDATE mailctl_domain_stats SET aliases = aliases - NOT EXISTS (SELECT 1 FROM virtual_aliases WHERE source = old.source AND id != old.id), destinations = destinations - 1, disabled = disabled - NOT coalesce(old.enabled, 0) WHERE domain_id = old.domain_id;
+  UPDATE mailctl_domain_stats SET aliases = aliases + NOT EXISTS (SELECT 1 FROM virtual_aliases WHERE source = new.source AND id != new.id), destinations = destinations + 1, disabled = disabled + NOT coalesce(new.enabled, 0) WHERE domain_id = new.domain_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS virtual_aliases_stats_delete AFTER DELETE ON virtual_aliases BEGIN
+  UPDATE mailctl_domain_stats SET aliases = aliases - NOT EXISTS (SELECT 1 FROM virtual_aliases WHERE source = old.source), destinations = destinations - 1, disabled = disabled - NOT coalesce(old.enabled, 0) WHERE domain_id = old.domain_id;
+END;
+
+-- Schema version as maintained by "mailctl.py db migrate"
+PRAGMA user_version = 5;
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Load test Postfix and Dovecot lookups against concurrent mailctl.py writers
+
+Runs reader processes replaying the queries of the contrib Postfix and Dovecot
+configuration files and writer processes adding aliases, deleting users and
+changing passwords with mailctl.py on the same database. Reports throughput,
+latency percentiles and the share of operations failing because the database
+was locked, for each journal mode and database size, and writes the results
+as JSON.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from concurrent import futures
+
+CONTRIB = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(CONTRIB, os.pardir))
+
+from benchmark import SIZES, generate, load, lookup_queries  # noqa: E402
+from mailctl import Database, MailCtl, passlib_enabled  # noqa: E402
+
+# Journal modes to compare, the others do not persist or are not crash safe
+JOURNAL_MODES = ('wal', 'delete', 'truncate', 'persist')
+# Keys of each kind passed to the readers, and share of lookups for missing keys
+KEY_SAMPLE = 10000
+MISSES = 0.3
+# Seconds for all processes to start before the test begins
+START_DELAY = 1.0
+# Milliseconds readers wait for a locked database, long enough to wait out a commit
+BUSY_TIMEOUT = 1000
+# Seconds a reader waits after a locked lookup, doubled while the database stays locked
+LOCK_BACKOFF = 0.001
+LOCK_BACKOFF_MAX = 0.1
+
+
+def command(db, argv, stdin=''):
+    """
+    Run mailctl.py command on open database in this process
+
+    Returns exit code and output. Raises sqlite3.OperationalError if the
+    database is locked.
+    """
+    output = io.StringIO()
+    code = 0
+    with contextlib.redirect_stdout(output):
+        stdin, sys.stdin = sys.stdin, io.StringIO(stdin)
+        try:
+            MailCtl(['--no-snapshot'] + argv, db=db)
+        except SystemExit as error:
+            code = error.code if isinstance(error.code, int) else 1
+        finally:
+            sys.stdin = stdin
+    return code, output.getvalue()
+
+
+def reader(path, queries, busy_timeout, start, duration, seed):
+    """
+    Replay lookups of (query, keys) pairs until duration seconds after start
+
+    Uses one connection like a Postfix or Dovecot process. After a locked lookup
+    the reader backs off like a client retrying later, so a lock is not counted
+    again for every spin of the loop. Returns latencies in milliseconds and
+    numbers of lookups failing as locked or otherwise.
+    """
+    rng = random.Random(seed)
+    connection = sqlite3.connect(path, timeout=busy_timeout / 1000.0, isolation_level=None)
+    latencies = []
+    locked = errors = 0
+    backoff = LOCK_BACKOFF
+    time.sleep(max(start - time.time(), 0))
+    while time.time() < start + duration:
+        query, keys = rng.choice(queries)
+        key = rng.choice(keys)
+        if rng.random() < MISSES:
+            key = 'missing-' + key
+        began = time.perf_counter()
+        try:
+            connection.execute(query, (key,)).fetchall()
+        except sqlite3.OperationalError as error:
+            if Database.is_busy(error):
+                locked += 1
+                time.sleep(backoff)
+                backoff = min(backoff * 2, LOCK_BACKOFF_MAX)
+            else:
+                errors += 1
+            continue
+        latencies.append((time.perf_counter() - began) * 1000)
+        backoff = LOCK_BACKOFF
+    connection.close()
+    return {'latencies': latencies, 'locked': locked, 'errors': errors}
+
+
+def writer(path, number, victims, users, domain, rounds, start, duration, seed):
+    """
+    Run mailctl.py alias add, user delete and user password until duration
+    seconds after start
+
+    victims are the users this writer deletes, users are alias destinations
+    and get new passwords. Returns latencies and error counts by command.
+    """
+    rng = random.Random(seed)
+    db = Database(path)
+    operations = ['alias add', 'user delete']
+    if passlib_enabled():
+        operations.append('user password')
+    results = {operation: {'latencies': [], 'locked': 0, 'errors': 0}
+               for operation in operations}
+    victims = iter(victims)
+    time.sleep(max(start - time.time(), 0))
+    count = 0
+    while time.time() < start + duration:
+        operation = rng.choice(operations)
+        stdin = ''
+        if operation == 'alias add':
+            argv = ['alias', 'add', '-a', 'load{}-{}@{}'.format(number, count, domain),
+                    '-u', rng.choice(users)]
+        elif operation == 'user delete':
+            victim = next(victims, None)
+            if victim is None:
+                operations.remove(operation)
+                continue
+            argv = ['user', 'delete', victim]
+            stdin = 'YES\n'
+        else:
+            argv = ['user', 'password', rng.choice(users), '--rounds', str(rounds),
+                    '--workers', '1']
+        count += 1
+        began = time.perf_counter()
+        try:
+            code = command(db, argv, stdin)[0]
+        except sqlite3.OperationalError as error:
+            results[operation]['locked' if Database.is_busy(error) else 'errors'] += 1
+            continue
+        elapsed = (time.perf_counter() - began) * 1000
+        if code:
+            results[operation]['errors'] += 1
+        else:
+            results[operation]['latencies'].append(elapsed)
+    return results
+
+
+def summary(results, duration):
+    """
+    Return throughput, latency percentiles and lock error rate of merged results
+    """
+    latencies = sorted(latency for result in results for latency in result['latencies'])
+    locked = sum(result['locked'] for result in results)
+    errors = sum(result['errors'] for result in results)
+    attempts = len(latencies) + locked + errors
+    stats = {'ops': len(latencies), 'per_second': round(len(latencies) / duration, 1),
+             'locked': locked, 'errors': errors,
+             'lock_rate': round(locked / attempts, 5) if attempts else 0.0}
+    if len(latencies) > 1:
+        percentiles = statistics.quantiles(latencies, n=100, method='inclusive')
+        stats.update({'p50_ms': round(percentiles[49], 3), 'p90_ms': round(percentiles[89], 3),
+                      'p99_ms': round(percentiles[98], 3), 'max_ms': round(latencies[-1], 3)})
+    return stats
+
+
+def run(path, data, journal_mode, readers, writers, duration, busy_timeout, rounds, seed):
+    """
+    Run readers and writers on database at path in journal_mode
+
+    Returns summaries of the lookups and of each mailctl.py command.
+    """
+    Database(path, journal_mode=journal_mode).conn.close()
+    rng = random.Random(seed)
+    keys = {kind: rng.sample(values, min(KEY_SAMPLE, len(values)))
+            for kind, values in data.items()}
+    queries = [(query, keys['users'] if 'virtual_users' in query else
+                keys['aliases'] if 'virtual_aliases' in query else keys['domains'])
+               for query in lookup_queries().values()]
+    # Users deleted by the writers, the others are kept as alias destinations
+    half = len(data['users']) // 2
+    victims = data['users'][half:]
+    kept = set(data['users'][:half])
+    users = [user for user in keys['users'] if user in kept]
+    start = time.time() + START_DELAY
+    with futures.ProcessPoolExecutor(readers + writers) as pool:
+        reads = [pool.submit(reader, path, queries, busy_timeout, start, duration,
+                             seed + number)
+                 for number in range(readers)]
+        writes = [pool.submit(writer, path, number, victims[number::writers], users,
+                              data['domains'][0], rounds, start, duration,
+                              seed + readers + number)
+                  for number in range(writers)]
+        reads = [future.result() for future in reads]
+        writes = [future.result() for future in writes]
+    results = {'lookups': summary(reads, duration)}
+    for operation in sorted(set(operation for result in writes for operation in result)):
+        results[operation] = summary([result[operation] for result in writes
+                                      if operation in result], duration)
+    return results
+
+
+def main():
+    """
+    Parse arguments, generate databases and run the load tests
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-s', '--size', help='database sizes (default: tiny)',
+                        choices=SIZES, action='append')
+    parser.add_argument('-j', '--journal-mode',
+                        help='journal modes (default: wal and delete)',
+                        choices=JOURNAL_MODES, action='append')
+    parser.add_argument('-r', '--readers', help='reader processes (default: 4)',
+                        type=int, default=4)
+    parser.add_argument('-w', '--writers', help='writer processes (default: 1)',
+                        type=int, default=1)
+    parser.add_argument('-t', '--duration', help='seconds per test (default: 10)',
+                        type=float, default=10.0)
+    parser.add_argument('-b', '--busy-timeout',
+                        help='milliseconds readers wait for a locked database, 0 reports '
+                             'the lock error at once (default: {})'.format(BUSY_TIMEOUT),
+                        type=int, default=BUSY_TIMEOUT)
+    parser.add_argument('--rounds', help='password hashing rounds (default: 1000)',
+                        type=int, default=1000)
+    parser.add_argument('-d', '--directory',
+                        help='keep generated databases in this directory and reuse them')
+    parser.add_argument('--seed', help='random seed (default: 1)', type=int, default=1)
+    parser.add_argument('-o', '--output', help='JSON results file (default: stdout)')
+    args = parser.parse_args()
+    if args.readers < 1:
+        parser.error('at least one reader is required')
+    if args.writers < 0:
+        parser.error('writers must not be negative')
+    if args.duration <= 0:
+        parser.error('duration must be positive')
+    if args.busy_timeout < 0:
+        parser.error('busy timeout must not be negative')
+
+    results = {'python': sys.version.split()[0], 'sqlite': sqlite3.sqlite_version,
+               'readers': args.readers, 'writers': args.writers,
+               'duration': args.duration, 'busy_timeout': args.busy_timeout,
+               'seed': args.seed, 'runs': []}
+    print('{:8} {:9} {:14} {:>9} {:>9} {:>9} {:>9} {:>9} {:>8}'.format(
+        'size', 'journal', 'operation', 'ops/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+        'locked'), file=sys.stderr)
+    with tempfile.TemporaryDirectory(prefix='mailctl-load-') as temp:
+        directory = args.directory or temp
+        os.makedirs(directory, exist_ok=True)
+        for size in args.size or ['tiny']:
+            path = os.path.join(directory, 'bench-{}-{}.sqlite'.format(size, args.seed))
+            # Same databases as contrib/benchmark.py
+            if not os.path.exists(path):
+                generate(path, *SIZES[size], seed=args.seed)
+            data = load(path)
+            for journal_mode in args.journal_mode or ['wal', 'delete']:
+                # Writers change the database, work on a copy
+                work = os.path.join(temp, 'work.sqlite')
+                Database(path).backup(work)
+                operations = run(work, data, journal_mode, args.readers, args.writers,
+                                 args.duration, args.busy_timeout, args.rounds, args.seed)
+                for suffix in ('', '-wal', '-shm', '-journal'):
+                    if os.path.exists(work + suffix):
+                        os.unlink(work + suffix)
+                results['runs'].append({'size': size, 'journal_mode': journal_mode,
+                                        'operations': operations})
+                for name, stats in operations.items():
+                    print('{:8} {:9} {:14} {:>9} {:>9} {:>9} {:>9} {:>9} {:>7.2%}'.format(
+                        size, journal_mode, name, stats['per_second'],
+                        stats.get('p50_ms', '-'), stats.get('p90_ms', '-'),
+                        stats.get('p99_ms', '-'), stats.get('max_ms', '-'),
+                        stats['lock_rate']), file=sys.stderr)
+
+    document = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(document + '\n')
+    else:
+        print(document)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Replication test harness
+
+Runs a primary and replicas of a mail database on localhost with mailctl.py
+replicate, changes the primary and checks that all replicas end up with the
+same domains, users and aliases. Covers incremental changes, a replica
+reconnecting after downtime and the full copy after the change log was pruned.
+"""
+
+import argparse
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+CONTRIB = os.path.dirname(os.path.abspath(__file__))
+MAILCTL = os.path.join(CONTRIB, os.pardir, 'mailctl.py')
+sys.path.insert(0, os.path.join(CONTRIB, os.pardir))
+
+from mailctl import Database  # noqa: E402
+
+
+class Harness(object):
+    """
+    Temporary primary and replica databases with their mailctl processes
+    """
+
+    def __init__(self, directory, replicas, verbose=False):
+        self.directory = directory
+        self.primary = self.create('primary')
+        self.replicas = [self.create('replica{}'.format(number))
+                         for number in range(1, replicas + 1)]
+        self.address = 'unix:' + os.path.join(directory, 'replication.sock')
+        self.output = None if verbose else subprocess.DEVNULL
+        self.processes = {}
+        self.failures = 0
+
+    def create(self, name):
+        """
+        Create empty database from contrib/db_schema.sql, returns its path
+        """
+        path = os.path.join(self.directory, name + '.sqlite')
+        connection = sqlite3.connect(path)
+        with open(os.path.join(CONTRIB, 'db_schema.sql')) as schema:
+            connection.executescript(schema.read())
+        connection.execute('PRAGMA journal_mode = wal')
+        connection.close()
+        return path
+
+    def mailctl(self, db, *args, stdin=None):
+        """
+        Run mailctl.py on database db and wait for it
+        """
+        subprocess.run([sys.executable, MAILCTL, '--db', db, '--no-snapshot'] + list(args),
+                       input=stdin, text=True, stdout=self.output, check=True)
+
+    def start(self, name, db, *args):
+        """
+        Start mailctl.py in the background on database db
+        """
+        self.processes[name] = subprocess.Popen(
+            [sys.executable, MAILCTL, '--db', db] + list(args), stdout=self.output)
+
+    def stop(self, name):
+        """
+        Stop background mailctl.py
+        """
+        process = self.processes.pop(name)
+        process.send_signal(signal.SIGTERM)
+        process.wait(10)
+
+    def batch(self, commands):
+        """
+        Run commands in one batch on the primary
+        """
+        self.mailctl(self.primary, 'batch', '--yes', stdin='\n'.join(commands) + '\n')
+
+    @staticmethod
+    def content(path):
+        """
+        Return replicated rows of database at path
+        """
+        db = Database(path)
+        return {table: db.execute('SELECT {} FROM {} ORDER BY id'.format(
+            ', '.join(columns), table)).fetchall()
+            for table, columns in db.REPLICATED_TABLES.items()}
+
+    @staticmethod
+    def position(path):
+        """
+        Return seq of the last change applied to replica at path
+        """
+        return int(Database(path).replication_state().get('primary_seq', -1))
+
+    def wait(self, replicas, timeout=30):
+        """
+        Wait until replicas applied the last change of the primary
+        """
+        last = Database(self.primary).change_range()[1]
+        deadline = time.monotonic() + timeout
+        while any(self.position(replica) < last for replica in replicas):
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def check(self, description, replicas):
+        """
+        Compare replicas with the primary and report the result
+        """
+        start = time.monotonic()
+        caught_up = self.wait(replicas)
+        expected = self.content(self.primary)
+        rows = sum(len(table) for table in expected.values())
+        for replica in replicas:
+            if not caught_up or self.content(replica) != expected:
+                print('FAIL {}: {} differs from primary'.format(
+                    description, os.path.basename(replica)))
+                self.failures += 1
+                return
+        print('ok   {}: {} replicas match {} rows after {:.2f}s'.format(
+            description, len(replicas), rows, time.monotonic() - start))
+
+    def run(self, aliases):
+        """
+        Run all scenarios, returns True if all replicas matched
+        """
+        self.start('primary', self.primary, 'replicate', '--listen', self.address,
+                   '--poll-interval', '0.1')
+        while not os.path.exists(self.address[5:]):
+            time.sleep(0.05)
+        for number, replica in enumerate(self.replicas):
+            self.start(number, replica, 'replicate', '--from', self.address,
+                       '--retry-interval', '0.2')
+
+        self.batch(['domain add sample.test', 'domain add other.test'] +
+                   ['user add user{}@sample.test'.format(number) for number in range(5)] +
+                   ['alias add -a team@sample.test -u user{}@sample.test'.format(number)
+                    for number in range(5)])
+        self.check('initial copy', self.replicas)
+
+        self.batch(['alias disable team@sample.test',
+                    'alias add -a info@other.test -u user0@sample.test',
+                    'user delete user4@sample.test',
+                    'user password user1@sample.test',
+                    'alias enable team@sample.test'])
+        self.check('incremental changes', self.replicas)
+
+        # A replica catches up after downtime
+        self.stop(0)
+        self.batch(['user add late{}@other.test'.format(number) for number in range(3)] +
+                   ['domain delete other.test'])
+        self.start(0, self.replicas[0], 'replicate', '--from', self.address)
+        self.check('reconnect after downtime', self.replicas)
+
+        # A replica behind pruned changes gets a full copy
+        self.stop(0)
+        self.batch(['alias add -a pruned@sample.test -u user1@sample.test'])
+        last = Database(self.primary).change_range()[1]
+        self.mailctl(self.primary, 'changes', '--prune-before', str(last + 1))
+        self.mailctl(self.replicas[0], 'replicate', '--from', self.address, '--once')
+        self.check('full copy after pruning', self.replicas)
+
+        if aliases:
+            self.mailctl(self.primary, 'import', '-', '--format', 'csv',
+                         stdin='type,name,destination\n' + ''.join(
+                             'alias,bulk{}@sample.test,user0@sample.test\n'.format(number)
+                             for number in range(aliases)))
+            self.check('bulk import of {} aliases'.format(aliases), self.replicas[1:])
+
+        for name in list(self.processes):
+            self.stop(name)
+        return self.failures == 0
+
+
+def main():
+    """
+    Parse arguments and run the harness in a temporary directory
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-r', '--replicas', help='number of replicas (default: 2)',
+                        type=int, default=2)
+    parser.add_argument('-a', '--aliases',
+                        help='aliases to import in the bulk scenario (default: 10000)',
+                        type=int, default=10000)
+    parser.add_argument('-v', '--verbose', help='show mailctl.py output',
+                        action='store_true')
+    args = parser.parse_args()
+    if args.replicas < 2:
+        parser.error('at least 2 replicas are required')
+
+    with tempfile.TemporaryDirectory(prefix='mailctl-replication-') as directory:
+        harness = Harness(directory, args.replicas, args.verbose)
+        try:
+            success = harness.run(args.aliases)
+        finally:
+            for process in harness.processes.values():
+                process.kill()
+    sys.exit(0 if success else 1)
+
+
+if __name__ == '__main__':
+    main()
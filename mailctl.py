@@ -5,571 +5,4944 @@ mailctl.py
 Helper script to manage Postfix mail aliases kept in a SQLite Database
 """
 
+import time
+# Taken before the other imports, reported by --profile-startup
+START_TIME = time.perf_counter()
+
 import sys
 import os
 import argparse
+import io
 import sqlite3
-try:
-    from passlib.hash import sha512_crypt
-    PASSLIB_ENABLED = True
-except ImportError:
-    print('Failed to import passlib.')
-    print ('Password creation feature will be disabled.')
-    PASSLIB_ENABLED = False
-from random import choice
+import json
+import contextlib
+import collections
+import configparser
+import copy
+import csv
+import filecmp
+import functools
+import gzip
+import hashlib
+import hmac
+import http
+import random
+import re
+import shutil
+import shlex
+import signal
+import socket
+import struct
+import subprocess
+import tempfile
+import threading
+import urllib.parse as urllib_parse
+# asyncio and concurrent.futures take longer to import than the rest together,
+# they are imported by the daemons and the commands that need them
+
+
+# passlib handler, imported by passlib_enabled() when passwords are hashed
+sha512_crypt = None
+
+
+def passlib_enabled():
+    """
+    Return True if the passlib module is available, importing it on first use
+    """
+    global sha512_crypt
+    if sha512_crypt is None:
+        try:
+            from passlib.hash import sha512_crypt
+        except ImportError:
+            sha512_crypt = False
+    return sha512_crypt is not False
+
+
+def hash_password(password, rounds):
+    """
+    Return SHA512-CRYPT password hash of a given password.
+
+    Lives on module level so it can be run in worker processes.
+    """
+    passlib_enabled()
+    return '{SHA512-CRYPT}' + sha512_crypt.using(rounds=rounds).hash(password)
+
+
+def _hash_password_job(job):
+    """
+    Hash the password of a (username, password, rounds) job
+
+    Returns tuple of username, password and password hash
+    """
+    username, password, rounds = job
+    return username, password, hash_password(password, rounds)
+
+
+def verify_password(password, password_hash):
+    """
+    Return True if password matches SHA512-CRYPT password hash
+
+    Lives on module level so it can be run in worker processes.
+    """
+    passlib_enabled()
+    if password_hash.startswith('{SHA512-CRYPT}'):
+        password_hash = password_hash[len('{SHA512-CRYPT}'):]
+    try:
+        return sha512_crypt.verify(password, password_hash)
+    except ValueError:
+        return False
+
+
+def prometheus_metrics(db):
+    """
+    Return domain statistics of a Database in the Prometheus text exposition format
+    """
+    with db.snapshot():
+        domains = db.stats_totals()[0]
+        rows = db.domain_stats().fetchall()
+    lines = ['# HELP mailctl_domains Number of domains', '# TYPE mailctl_domains gauge',
+             'mailctl_domains {}'.format(domains)]
+    for column, (name, description) in enumerate((
+            ('users', 'Users of the domain'),
+            ('aliases', 'Aliases of the domain'),
+            ('alias_destinations', 'Alias destinations of the domain'),
+            ('alias_destinations_disabled', 'Disabled alias destinations of the domain')), 1):
+        lines.append('# HELP mailctl_{} {}'.format(name, description))
+        lines.append('# TYPE mailctl_{} gauge'.format(name))
+        for row in rows:
+            domain = row[0].replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            lines.append('mailctl_{}{{domain="{}"}} {}'.format(name, domain, row[column]))
+    return '\n'.join(lines) + '\n'
+
+
+class CdbWriter(object):
+    """
+    Writer for constant database (CDB) files as read by Postfix cdb: tables
+
+    Records are written as they are added, the hash tables and header when the
+    writer is finished.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.tables = [[] for _ in range(256)]
+        self.position = 2048
+        self.stream.seek(self.position)
+
+    @staticmethod
+    def hash(key):
+        """
+        Return CDB hash of key bytes
+        """
+        value = 5381
+        for byte in key:
+            value = ((value << 5) + value) & 0xffffffff ^ byte
+        return value
+
+    def add(self, key, value):
+        """
+        Add record with key and value bytes
+        """
+        self.stream.write(struct.pack('<LL', len(key), len(value)))
+        self.stream.write(key)
+        self.stream.write(value)
+        key_hash = self.hash(key)
+        self.tables[key_hash & 0xff].append((key_hash, self.position))
+        self.position += 8 + len(key) + len(value)
+
+    def finish(self):
+        """
+        Write hash tables and header
+        """
+        header = []
+        for table in self.tables:
+            slots = [(0, 0)] * (len(table) * 2)
+            for key_hash, position in table:
+                slot = (key_hash >> 8) % len(slots)
+                while slots[slot][1]:
+                    slot = (slot + 1) % len(slots)
+                slots[slot] = (key_hash, position)
+            header.append((self.position, len(slots)))
+            for key_hash, position in slots:
+                self.stream.write(struct.pack('<LL', key_hash, position))
+            self.position += 8 * len(slots)
+        self.stream.seek(0)
+        for position, length in header:
+            self.stream.write(struct.pack('<LL', position, length))
+
+
+class AliasGraph(object):
+    """
+    Graph of enabled aliases to expand addresses into their final recipients
+
+    Addresses are expanded like Postfix does: every destination that is an alias
+    itself is expanded again, an alias pointing to itself also delivers to its own
+    address. Expansions are computed once per strongly connected component with an
+    iterative version of Tarjan's algorithm, so chains of any length are resolved
+    without recursion and shared chains only once. Addresses are compared in
+    lower case.
+    """
+
+    def __init__(self, aliases, mailboxes, domains):
+        self.edges = {}
+        for source, destination in aliases:
+            self.edges.setdefault(source.lower(), []).append(destination.lower())
+        self.mailboxes = set(mailbox.lower() for mailbox in mailboxes)
+        self.domains = set(domain.lower() for domain in domains)
+        # Recipients and members of the cycle, if any, of resolved aliases
+        self.expansions = {}
+        self.cycles = {}
+
+    def kind(self, address):
+        """
+        Return mailbox, external or dead end for the final recipient address
+        """
+        if address in self.mailboxes:
+            return 'mailbox'
+        if address.rpartition('@')[2] not in self.domains:
+            return 'external'
+        return 'dead end'
+
+    def _resolve(self, start):
+        """
+        Compute expansions of all unresolved aliases reachable from start
+        """
+        index = {start: 0}
+        low = {start: 0}
+        stack = [start]
+        on_stack = set([start])
+        work = [(start, iter(self.edges[start]))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child == node or child not in self.edges or child in self.expansions:
+                    continue
+                if child not in index:
+                    index[child] = low[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(self.edges[child])))
+                    break
+                if child in on_stack:
+                    low[node] = min(low[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] != index[node]:
+                    continue
+                # node is the root of a strongly connected component
+                component = set()
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.add(member)
+                    if member == node:
+                        break
+                recipients = set()
+                expansions = []
+                for member in component:
+                    for child in self.edges[member]:
+                        if child == member or child not in self.edges:
+                            recipients.add(child)
+                        elif child not in component:
+                            expansions.append(self.expansions[child])
+                if len(expansions) == 1 and not recipients:
+                    # Share the set along chains of forwarding aliases
+                    recipients = expansions[0]
+                else:
+                    for expansion in expansions:
+                        recipients.update(expansion)
+                    recipients = frozenset(recipients)
+                cycle = tuple(sorted(component)) if len(component) > 1 else None
+                for member in component:
+                    self.expansions[member] = recipients
+                    if cycle:
+                        self.cycles[member] = cycle
+
+    def expand(self, address):
+        """
+        Return tuple of the set of final recipients of address and the members of
+        the alias cycle it is part of or None
+        """
+        address = address.lower()
+        if address not in self.edges:
+            return frozenset([address]), None
+        if address not in self.expansions:
+            self._resolve(address)
+        return self.expansions[address], self.cycles.get(address)
+
+
+class Rollback(Exception):
+    """
+    Raised inside a Database.transaction() block to discard its changes
+    """
+
+
+class QueryStats(object):
+    """
+    Timing, row counts and query plans of the statements run by Database
+
+    Statements are counted by their SQL text and by operation, the Database method
+    that ran them as named with operation(), or else their first keyword.
+    Statements taking at least slow_ms milliseconds get their query plan
+    captured. With trace, every statement is written to that stream as JSON line.
+    """
+
+    SLOW_MS = 100
+    # Statements with a query plan, not PRAGMA or transaction control
+    EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+
+    def __init__(self, slow_ms=SLOW_MS, trace=None):
+        self.slow_ms = slow_ms
+        self.trace = trace
+        self.started = time.perf_counter()
+        # SQL text mapped to [calls, total ms, max ms, rows, plan]
+        self.statements = {}
+        # Operation name mapped to [calls, total ms, rows]
+        self.operations = {}
+        # Running operation of each thread, connections of several threads share stats
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def operation(self, name):
+        """
+        Count the statements of a with block under operation name
+        """
+        previous = getattr(self.local, 'operation', None)
+        self.local.operation = name
+        try:
+            yield
+        finally:
+            self.local.operation = previous
+
+    def current_operation(self, sql):
+        """
+        Return name of the running operation, or the first keyword of sql
+        """
+        return getattr(self.local, 'operation', None) or sql.split(None, 1)[0].lower()
+
+    @staticmethod
+    def explain(conn, sql, params):
+        """
+        Return EXPLAIN QUERY PLAN of statement as indented lines, None if it has none
+        """
+        if not sql.lstrip().upper().startswith(QueryStats.EXPLAINABLE):
+            return None
+        try:
+            rows = conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+        except sqlite3.Error:
+            return None
+        depths = {0: -1}
+        plan = []
+        for node, parent, _, detail in rows:
+            depths[node] = depths.get(parent, -1) + 1
+            plan.append('  ' * depths[node] + detail)
+        return plan
+
+    @staticmethod
+    def full_scans(plan):
+        """
+        Return plan lines reading whole tables without an index
+
+        Virtual tables such as the full text index report their own index
+        lookups as SCAN with VIRTUAL TABLE INDEX, those are not full scans.
+        """
+        return [line.strip() for line in plan or ()
+                if line.strip().startswith('SCAN ') and ' USING ' not in line
+                and ' VIRTUAL TABLE INDEX ' not in line]
+
+    def record(self, conn, sql, params, operation, elapsed, rows):
+        """
+        Add statement that took elapsed seconds and returned or changed rows
+        """
+        milliseconds = elapsed * 1000
+        statement = self.statements.setdefault(sql, [0, 0.0, 0.0, 0, None])
+        statement[0] += 1
+        statement[1] += milliseconds
+        statement[2] = max(statement[2], milliseconds)
+        statement[3] += max(rows, 0)
+        plan = None
+        if milliseconds >= self.slow_ms:
+            if statement[4] is None:
+                statement[4] = self.explain(conn, sql, params) or []
+            plan = statement[4]
+        counters = self.operations.setdefault(operation, [0, 0.0, 0])
+        counters[0] += 1
+        counters[1] += milliseconds
+        counters[2] += max(rows, 0)
+        if self.trace is not None and not self.trace.closed:
+            event = {'time': round(time.time(), 6), 'operation': operation, 'sql': sql,
+                     'ms': round(milliseconds, 3), 'rows': rows}
+            if plan is not None:
+                event['plan'] = plan
+                event['full_scans'] = self.full_scans(plan)
+            self.trace.write(json.dumps(event) + '\n')
+
+    def summary(self, stream, limit=20):
+        """
+        Write statements and operations taking the most time to stream
+        """
+        total = sum(statement[1] for statement in self.statements.values())
+        slow = [(sql, statement) for sql, statement in self.statements.items()
+                if statement[4] is not None]
+        stream.write('Statements: {} in {:.1f}ms of {:.1f}ms, {} slow\n'.format(
+            sum(statement[0] for statement in self.statements.values()), total,
+            (time.perf_counter() - self.started) * 1000, len(slow)))
+        stream.write('{:>7} {:>11} {:>10} {:>9}  statement\n'.format(
+            'calls', 'total ms', 'max ms', 'rows'))
+        for sql, statement in sorted(self.statements.items(),
+                                     key=lambda item: -item[1][1])[:limit]:
+            text = ' '.join(sql.split())
+            stream.write('{:>7} {:>11.3f} {:>10.3f} {:>9}  {}\n'.format(
+                statement[0], statement[1], statement[2], statement[3],
+                text if len(text) <= 100 else text[:97] + '...'))
+        stream.write('{:>7} {:>11} {:>9}  operation\n'.format('calls', 'total ms', 'rows'))
+        for operation, counters in sorted(self.operations.items(),
+                                          key=lambda item: -item[1][1])[:limit]:
+            stream.write('{:>7} {:>11.3f} {:>9}  {}\n'.format(
+                counters[0], counters[1], counters[2], operation))
+        for sql, statement in slow:
+            stream.write('Slow statement, up to {:.1f}ms: {}\n'.format(
+                statement[2], ' '.join(sql.split())))
+            for line in statement[4]:
+                stream.write('    {}\n'.format(line))
+            for line in self.full_scans(statement[4]):
+                stream.write('  Full table scan: {}\n'.format(line))
+
+
+class TracedCursor(object):
+    """
+    Cursor recording its statement in QueryStats once all rows have been read
+
+    Time spent fetching rows counts for the statement. fetchone() is used for
+    queries returning a single row and records the statement right away,
+    cursors whose rows are not all read are recorded when they are closed.
+    """
+
+    def __init__(self, cursor, stats, sql, params, operation, elapsed):
+        self.cursor = cursor
+        self.stats = stats
+        self.sql = sql
+        self.params = params
+        self.operation = operation
+        self.elapsed = elapsed
+        self.rows = 0
+        self.finished = False
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = next(self.cursor)
+        except StopIteration:
+            self.elapsed += time.perf_counter() - start
+            self.finish()
+            raise
+        self.elapsed += time.perf_counter() - start
+        self.rows += 1
+        return row
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self.cursor.fetchone()
+        self.elapsed += time.perf_counter() - start
+        if row is not None:
+            self.rows += 1
+        self.finish()
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = self.cursor.fetchmany(self.cursor.arraysize if size is None else size)
+        self.elapsed += time.perf_counter() - start
+        self.rows += len(rows)
+        if not rows:
+            self.finish()
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self.cursor.fetchall()
+        self.elapsed += time.perf_counter() - start
+        self.rows += len(rows)
+        self.finish()
+        return rows
+
+    def close(self):
+        """
+        Record statement and close the cursor
+        """
+        self.finish()
+        self.cursor.close()
+
+    def finish(self):
+        """
+        Record statement unless already done
+        """
+        if not self.finished:
+            self.finished = True
+            self.stats.record(self.cursor.connection, self.sql, self.params,
+                              self.operation, self.elapsed, self.rows)
+
+
+def stats_operation(method):
+    """
+    Decorate Database method to count its statements under its name in QueryStats
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.stats is None:
+            return method(self, *args, **kwargs)
+        with self.stats.operation(method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class Database(object):
     """
     Wrapper to provide SQLite connectivity
+
+    Statements run in autocommit mode unless they are part of a transaction()
+    block, so plain queries never commit.
     """
-    def __init__(self, db):
-        self.conn = sqlite3.connect(db)
-        self.conn.execute('pragma foreign_keys = on')
-        self.conn.commit()
+
+    # Schema migrations as tuples of description and statements, applied in order.
+    # The number of applied migrations is kept in PRAGMA user_version.
+    MIGRATIONS = [
+        ('unique and covering indexes for Postfix and Dovecot lookups', [
+            # Merge duplicate domains into the one with the lowest id
+            'CREATE TEMP TABLE mailctl_domain_map '
+            '(old_id INTEGER PRIMARY KEY, new_id INTEGER NOT NULL)',
+            'INSERT INTO mailctl_domain_map (old_id, new_id) '
+            'SELECT id, MIN(id) OVER (PARTITION BY name) FROM virtual_domains',
+            'DELETE FROM mailctl_domain_map WHERE old_id = new_id',
+            'UPDATE virtual_users SET domain_id = '
+            '(SELECT new_id FROM mailctl_domain_map WHERE old_id = domain_id) '
+            'WHERE domain_id IN (SELECT old_id FROM mailctl_domain_map)',
+            'UPDATE virtual_aliases SET domain_id = '
+            '(SELECT new_id FROM mailctl_domain_map WHERE old_id = domain_id) '
+            'WHERE domain_id IN (SELECT old_id FROM mailctl_domain_map)',
+            'DELETE FROM virtual_domains WHERE id IN (SELECT old_id FROM mailctl_domain_map)',
+            'DROP TABLE mailctl_domain_map',
+            # Drop duplicate users and aliases, keeping the oldest row
+            'DELETE FROM virtual_users WHERE id NOT IN '
+            '(SELECT MIN(id) FROM virtual_users GROUP BY email)',
+            'DELETE FROM virtual_aliases WHERE id NOT IN '
+            '(SELECT MIN(id) FROM virtual_aliases GROUP BY source, destination)',
+            'CREATE UNIQUE INDEX IF NOT EXISTS virtual_domains_name '
+            'ON virtual_domains (name)',
+            # Serves the Postfix virtual_mailbox_maps and Dovecot password_query lookups
+            'CREATE UNIQUE INDEX IF NOT EXISTS virtual_users_email '
+            'ON virtual_users (email)',
+            'CREATE INDEX IF NOT EXISTS virtual_users_domain_id '
+            'ON virtual_users (domain_id)',
+            'CREATE UNIQUE INDEX IF NOT EXISTS virtual_aliases_source_destination '
+            'ON virtual_aliases (source, destination)',
+            # Covers the Postfix virtual_alias_maps query
+            'CREATE INDEX IF NOT EXISTS virtual_aliases_enabled_source '
+            'ON virtual_aliases (source, destination, enabled) WHERE enabled',
+            'CREATE INDEX IF NOT EXISTS virtual_aliases_destination '
+            'ON virtual_aliases (destination, source)',
+            'CREATE INDEX IF NOT EXISTS virtual_aliases_domain_id '
+            'ON virtual_aliases (domain_id)',
+        ]),
+        ('full text search index on aliases', [
+            # Trigram index over an external content table, requires SQLite 3.34
+            "CREATE VIRTUAL TABLE IF NOT EXISTS virtual_aliases_fts USING fts5("
+            "source, destination, description, "
+            "content='virtual_aliases', content_rowid='id', tokenize='trigram')",
+            "INSERT INTO virtual_aliases_fts (virtual_aliases_fts) VALUES ('rebuild')",
+            # Flags read by triggers. While bulk_insert is set, bulk_alias_insert()
+            # indexes, logs and counts the new aliases itself instead of per row.
+            'CREATE TABLE IF NOT EXISTS mailctl_settings ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL)',
+            'CREATE TRIGGER IF NOT EXISTS virtual_aliases_fts_insert '
+            'AFTER INSERT ON virtual_aliases '
+            "WHEN NOT EXISTS (SELECT 1 FROM mailctl_settings WHERE key = 'bulk_insert') BEGIN "
+            'INSERT INTO virtual_aliases_fts (rowid, source, destination, description) '
+            'VALUES (new.id, new.source, new.destination, new.description); END',
+            'CREATE TRIGGER IF NOT EXISTS virtual_aliases_fts_delete '
+            'AFTER DELETE ON virtual_aliases BEGIN '
+            'INSERT INTO virtual_aliases_fts '
+            '(virtual_aliases_fts, rowid, source, destination, description) '
+            "VALUES ('delete', old.id, old.source, old.destination, old.description); END",
+            'CREATE TRIGGER IF NOT EXISTS virtual_aliases_fts_update '
+            'AFTER UPDATE OF source, destination, description ON virtual_aliases BEGIN '
+            'INSERT INTO virtual_aliases_fts '
+            '(virtual_aliases_fts, rowid, source, destination, description) '
+            "VALUES ('delete', old.id, old.source, old.destination, old.description); "
+            'INSERT INTO virtual_aliases_fts (rowid, source, destination, description) '
+            'VALUES (new.id, new.source, new.destination, new.description); END',
+        ]),
+        ('change log of domains, users and aliases', [
+            # AUTOINCREMENT keeps sequence numbers unique even after pruning. Users are
+            # logged without password hash, replicas get the current row when sent.
+            'CREATE TABLE IF NOT EXISTS mailctl_changes ('
+            'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'changed TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL, '
+            'table_name TEXT NOT NULL, operation TEXT NOT NULL, '
+            'row_id INTEGER NOT NULL, data TEXT NOT NULL)',
+            'CREATE TRIGGER IF NOT EXISTS virtual_domains_changes_insert '
+            'AFTER INSERT ON virtual_domains BEGIN '
+            'INSERT INTO mailctl_changes (table_name, operation, row_id, data) '
+            "VALUES ('virtual_domains', 'insert', new.id, json_object("
+            "'id', new.id, 'name', new.name)); END",
+            'CREATE TRIGGER IF NOT EXISTS virtual_domains_changes_update '
+            'AFTER UPDATE ON virtual_domains WHEN '
+            'old.id IS NOT new.id OR old.name IS NOT new.name BEGIN '
+            'INSERT INTO mailctl_changes (table_name, operation, row_id, data) '
+            "VALUES ('virtual_domains', 'update', new.id, json_object("
+            "'id', new.id, 'name', new.name)); END",
+            'CREATE TRIGGER IF NOT EXISTS virtual_domains_changes_delete '
+            'AFTER DELETE ON virtual_domains BEGIN '
+            'INSERT INTO mailctl_changes (table_name, operation, row_id, data) '
+            "VALUES ('virtual_domains', 'delete', old.id, json_object("
+            "'id', old.id, 'name', old.name)); END",
+            'CREATE TRIGGER IF NOT EXISTS virtual_users_changes_insert '
+            'AFTER INSERT ON virtual_users BEGIN '
+            'INSERT INTO mailctl_changes (table_name, operation, row_id, data) '
+            "VALUES ('virtual_users', 'insert', new.id, json_object("
+            "'id', new.id, 'domain_id', new.domain_id, 'email', new.email)); END",
+            'CREATE TRIGGER IF NOT EXISTS virtual_users_changes_update '
+            'AFTER UPDATE ON virtual_users WHEN '
+            'old.id IS NOT new.id OR old.domain_id IS NOT new.domain_id OR '
+            'old.email IS NOT new.email OR old.password IS NOT new.password BEGIN '
+            'INSERT INTO mailctl_changes (table_name, operation, row_id, data) '
+            "VALUES ('virtual_users', 'update', new.id, json_object("
+            "'id', new.id, 'domain_id', new.domain_id, 'email', new.email)); END",
+            'CREATE TRIGGER IF NOT EXISTS virtual_users_changes_delete '
+            'AFTER DELETE ON virtual_users BEGIN '
+            'INSERT INTO mailctl_changes (table_name, operation, row_id, data) '
+            "VALUES ('virtual_users', 'delete', old.id, json_object("
+            "'id', old.id, 'domain_id', old.domain_id, 'email', old.email)); END",
+            'CREATE TRIGGER IF NOT EXISTS virtual_aliases_changes_insert '
+            'AFTER INSERT ON virtual_aliases '
+            "WHEN NOT EXISTS (SELECT 1 FROM mailctl_settings WHERE key = 'bulk_insert') BEGIN "
+            'INSERT INTO mailctl_changes (table_name, operation, row_id, data) '
+            "VALUES ('virtual_aliases', 'insert', new.id, json_object("
+            "'id', new.id, 'domain_id', new.domain_id, 'source', new.source, "
+            "'destination', new.destination, 'description', new.description, "
+            "'enabled', new.enabled, 'created', new.created)); END",
+            'CREATE TRIGGER IF NOT EXISTS virtual_aliases_changes_update '
+            'AFTER UPDATE ON virtual_aliases WHEN '
+            'old.id IS NOT new.id OR old.domain_id IS NOT new.domain_id OR '
+            'old.source IS NOT new.source OR '
+            'old.destination IS NOT new.destination OR '
+            'old.description IS NOT new.description OR '
+            'old.enabled IS NOT new.enabled OR old.created IS NOT new.created BEGIN '
+            'INSERT INTO mailctl_changes (table_name, operation, row_id, data) '
+            "VALUES ('virtual_aliases', 'update', new.id, json_object("
+            "'id', new.id, 'domain_id', new.domain_id, 'source', new.source, "
+            "'destination', new.destination, 'description', new.description, "
+            "'enabled', new.enabled, 'created', new.created)); END",
+            'CREATE TRIGGER IF NOT EXISTS virtual_aliases_changes_delete '
+            'AFTER DELETE ON virtual_aliases BEGIN '
+            'INSERT INTO mailctl_changes (table_name, operation, row_id, data) '
+            "VALUES ('virtual_aliases', 'delete', old.id, json_object("
+            "'id', old.id, 'domain_id', old.domain_id, 'source', old.source, "
+            "'destination', old.destination, 'description', old.description, "
+            "'enabled', old.enabled, 'created', old.created)); END",
+        ]),
+        ('replication state', [
+            # Id of the own change log, and the log and position followed by replicas
+            'CREATE TABLE IF NOT EXISTS mailctl_replication ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL)',
+        ]),
+        ('domain statistics', [
+            # Aliases are distinct sources, destinations and disabled count rows
+            'CREATE TABLE IF NOT EXISTS mailctl_domain_stats ('
+            'domain_id INTEGER PRIMARY KEY, users INTEGER NOT NULL DEFAULT 0, '
+            'aliases INTEGER NOT NULL DEFAULT 0, destinations INTEGER NOT NULL DEFAULT 0, '
+            'disabled INTEGER NOT NULL DEFAULT 0)',
+            'INSERT OR REPLACE INTO mailctl_domain_stats '
+            '(domain_id, users, aliases, destinations, disabled) '
+            'SELECT id, '
+            '(SELECT count(*) FROM virtual_users WHERE domain_id = virtual_domains.id), '
+            '(SELECT count(DISTINCT source) FROM virtual_aliases '
+            'WHERE domain_id = virtual_domains.id), '
+            '(SELECT count(*) FROM virtual_aliases WHERE domain_id = virtual_domains.id), '
+            '(SELECT count(*) FROM virtual_aliases '
+            'WHERE domain_id = virtual_domains.id AND NOT coalesce(enabled, 0)) '
+            'FROM virtual_domains',
+            'CREATE TRIGGER IF NOT EXISTS virtual_domains_stats_insert '
+            'AFTER INSERT ON virtual_domains BEGIN '
+            'INSERT OR IGNORE INTO mailctl_domain_stats (domain_id) VALUES (new.id); END',
+            'CREATE TRIGGER IF NOT EXISTS virtual_domains_stats_update '
+            'AFTER UPDATE OF id ON virtual_domains BEGIN '
+            'UPDATE mailctl_domain_stats SET domain_id = new.id '
+            'WHERE domain_id = old.id; END',
+            'CREATE TRIGGER IF NOT EXISTS virtual_domains_stats_delete '
+            'AFTER DELETE ON virtual_domains BEGIN '
+            'DELETE FROM mailctl_domain_stats WHERE domain_id = old.id; END',
+            'CREATE TRIGGER IF NOT EXISTS virtual_users_stats_insert '
+            'AFTER INSERT ON virtual_users BEGIN '
+            'UPDATE mailctl_domain_stats SET users = users + 1 '
+            'WHERE domain_id = new.domain_id; END',
+            'CREATE TRIGGER IF NOT EXISTS virtual_users_stats_update '
+            'AFTER UPDATE OF domain_id ON virtual_users '
+            'WHEN old.domain_id IS NOT new.domain_id BEGIN '
+            'UPDATE mailctl_domain_stats SET users = users - 1 '
+            'WHERE domain_id = old.domain_id; '
+            'UPDATE mailctl_domain_stats SET users = users + 1 '
+            'WHERE domain_id = new.domain_id; END',
+            'CREATE TRIGGER IF NOT EXISTS virtual_users_stats_delete '
+            'AFTER DELETE ON virtual_users BEGIN '
+            'UPDATE mailctl_domain_stats SET users = users - 1 '
+            'WHERE domain_id = old.domain_id; END',
+            # An alias is counted with its first destination and uncounted with its last.
+            # The domain follows from the source, correlating on the source alone lets
+            # SQLite use the source index instead of scanning all aliases of the domain.
+            'CREATE TRIGGER IF NOT EXISTS virtual_aliases_stats_insert '
+            'AFTER INSERT ON virtual_aliases '
+            "WHEN NOT EXISTS (SELECT 1 FROM mailctl_settings WHERE key = 'bulk_insert') BEGIN "
+            'UPDATE mailctl_domain_stats SET '
+            'aliases = aliases + NOT EXISTS (SELECT 1 FROM virtual_aliases '
+            'WHERE source = new.source AND id != new.id), '
+            'destinations = destinations + 1, '
+            'disabled = disabled + NOT coalesce(new.enabled, 0) '
+            'WHERE domain_id = new.domain_id; END',
+            'CREATE TRIGGER IF NOT EXISTS virtual_aliases_stats_update '
+            'AFTER UPDATE OF domain_id, source, enabled ON virtual_aliases WHEN '
+            'old.domain_id IS NOT new.domain_id OR old.source IS NOT new.source OR '
+            'old.enabled IS NOT new.enabled BEGIN '
+            'UPDATE mailctl_domain_stats SET '
+            'aliases = aliases - NOT EXISTS (SELECT 1 FROM virtual_aliases '
+            'WHERE source = old.source AND id != old.id), '
+            'destinations = destinations - 1, '
+            'disabled = disabled - NOT coalesce(old.enabled, 0) '
+            'WHERE domain_id = old.domain_id; '
+            'UPDATE mailctl_domain_stats SET '
+            'aliases = aliases + NOT EXISTS (SELECT 1 FROM virtual_aliases '
+            'WHERE source = new.source AND id != new.id), '
+            'destinations = destinations + 1, '
+            'disabled = disabled + NOT coalesce(new.enabled, 0) '
+            'WHERE domain_id = new.domain_id; END',
+            'CREATE TRIGGER IF NOT EXISTS virtual_aliases_stats_delete '
+            'AFTER DELETE ON virtual_aliases BEGIN '
+            'UPDATE mailctl_domain_stats SET '
+            'aliases = aliases - NOT EXISTS (SELECT 1 FROM virtual_aliases '
+            'WHERE source = old.source), '
+            'destinations = destinations - 1, '
+            'disabled = disabled - NOT coalesce(old.enabled, 0) '
+            'WHERE domain_id = old.domain_id; END',
+        ]),
+    ]
+    SEARCH_MODES = ('substring', 'exact', 'prefix', 'domain')
+    SEARCH_FIELDS = ('source', 'destination', 'description', 'any')
+    # The trigram tokenizer can not match shorter patterns
+    FTS_MIN_PATTERN = 3
+    # Number of aliases from which add_aliases() indexes and logs them in one statement
+    FTS_BULK_ROWS = 1000
+    # Tables and columns copied to replicas, as logged in the change log
+    REPLICATED_TABLES = {
+        'virtual_domains': ('id', 'name'),
+        'virtual_users': ('id', 'domain_id', 'email', 'password'),
+        'virtual_aliases': ('id', 'domain_id', 'source', 'destination', 'description',
+                            'enabled', 'created'),
+    }
+    # Per row insert triggers on aliases skipped while the bulk_insert flag is set, and
+    # the statements replacing them; the parameter is the highest alias id before the insert
+    BULK_TRIGGERS = {
+        'virtual_aliases_fts_insert':
+            'INSERT INTO virtual_aliases_fts (rowid, source, destination, description) '
+            'SELECT id, source, destination, description FROM virtual_aliases WHERE id > ?',
+        'virtual_aliases_changes_insert':
+            'INSERT INTO mailctl_changes (table_name, operation, row_id, data) '
+            "SELECT 'virtual_aliases', 'insert', id, json_object("
+            "'id', id, 'domain_id', domain_id, 'source', source, "
+            "'destination', destination, 'description', description, "
+            "'enabled', enabled, 'created', created) "
+            'FROM virtual_aliases WHERE id > ? ORDER BY id',
+        'virtual_aliases_stats_insert':
+            'UPDATE mailctl_domain_stats SET '
+            '(aliases, destinations, disabled) = (SELECT count(DISTINCT source), count(*), '
+            'count(*) FILTER (WHERE NOT coalesce(enabled, 0)) FROM virtual_aliases '
+            'WHERE domain_id = mailctl_domain_stats.domain_id) '
+            'WHERE domain_id IN (SELECT domain_id FROM virtual_aliases WHERE id > ?)',
+    }
+
+    JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+    SYNCHRONOUS_MODES = ('off', 'normal', 'full', 'extra')
+    # Milliseconds SQLite waits for a lock before a statement fails as busy
+    BUSY_TIMEOUT = 5000
+    # Pages copied per backup step and seconds to let other connections work between steps
+    BACKUP_PAGES = 1024
+    BACKUP_PAUSE = 0.005
+    # Attempts for statements still failing as busy after the busy timeout
+    BUSY_RETRIES = 5
+    # Rows ANALYZE examines per index, 0 examines all rows
+    ANALYSIS_LIMIT = 1000
+    # Free pages released per incremental vacuum step and seconds to pause between steps
+    VACUUM_PAGES = 256
+    VACUUM_PAUSE = 0.05
+
+    def __init__(self, db, journal_mode=None, synchronous=None, busy_timeout=None,
+                 cache_size=None, mmap_size=None, stats=None, readonly=False):
+        if journal_mode is not None and journal_mode.lower() not in self.JOURNAL_MODES:
+            raise ValueError('invalid journal mode {}'.format(journal_mode))
+        if synchronous is not None and synchronous.lower() not in self.SYNCHRONOUS_MODES:
+            raise ValueError('invalid synchronous mode {}'.format(synchronous))
+        if busy_timeout is None:
+            busy_timeout = self.BUSY_TIMEOUT
+        self.path = db
+        # QueryStats recording all statements, None unless requested
+        self.stats = stats
+        # Transactions are managed explicitly by transaction()
+        if readonly:
+            # Writes fail instead of taking the write lock
+            self.conn = sqlite3.connect('file:{}?mode=ro'.format(urllib_parse.quote(db)),
+                                        timeout=int(busy_timeout) / 1000.0,
+                                        isolation_level=None, uri=True)
+        else:
+            self.conn = sqlite3.connect(db, timeout=int(busy_timeout) / 1000.0,
+                                        isolation_level=None)
         self.cur = self.conn.cursor()
+        self.savepoints = 0
+        # PRAGMA does not support parameters, all values have been validated above
+        self.execute('PRAGMA busy_timeout = {:d}'.format(int(busy_timeout)))
+        if journal_mode is not None:
+            self.execute('PRAGMA journal_mode = {}'.format(journal_mode.lower()))
+        if synchronous is not None:
+            self.execute('PRAGMA synchronous = {}'.format(synchronous.lower()))
+        if cache_size is not None:
+            self.execute('PRAGMA cache_size = {:d}'.format(int(cache_size)))
+        if mmap_size is not None:
+            self.execute('PRAGMA mmap_size = {:d}'.format(int(mmap_size)))
+        self.execute('pragma foreign_keys = on')
+
+    def _retry(self, func, *args):
+        """
+        Call func, retrying with backoff while the database is busy
+
+        Only statements outside of a transaction, including BEGIN, are retried.
+        Inside a transaction a single statement can not be retried on its own,
+        the error is raised so the whole transaction is rolled back.
+        """
+        for attempt in range(self.BUSY_RETRIES):
+            try:
+                return func(*args)
+            except sqlite3.OperationalError as error:
+                if not self.is_busy(error) or self.conn.in_transaction or \
+                        attempt == self.BUSY_RETRIES - 1:
+                    raise
+                time.sleep(0.05 * 2 ** attempt)
+
+    @staticmethod
+    def is_busy(error):
+        """
+        Return True if an SQLite error was caused by a locked database
+        """
+        # Extended result codes keep the primary code in the lowest byte
+        errorcode = getattr(error, 'sqlite_errorcode', None)
+        if errorcode is not None:
+            return errorcode & 0xff == sqlite3.SQLITE_BUSY
+        return 'database is locked' in str(error)
+
+    def _traced(self, sql, params, func, *args):
+        """
+        Call func like _retry() and record it as statement sql in self.stats
+
+        Queries returning rows are wrapped in a TracedCursor, which records them
+        once their rows have been read.
+        """
+        operation = self.stats.current_operation(sql)
+        start = time.perf_counter()
+        result = self._retry(func, *args)
+        elapsed = time.perf_counter() - start
+        if isinstance(result, sqlite3.Cursor) and result.description is not None:
+            return TracedCursor(result, self.stats, sql, params, operation, elapsed)
+        self.stats.record(self.conn, sql, params, operation, elapsed,
+                          result.rowcount if isinstance(result, sqlite3.Cursor) else 0)
+        return result
 
     def query(self, arg):
         """
         Query database
         """
-        self.cur.execute(arg)
-        self.conn.commit()
+        if self.stats is not None:
+            return self._traced(arg, (), self.cur.execute, arg)
+        self._retry(self.cur.execute, arg)
         return self.cur
 
-    def __del__(self):
+    def execute(self, arg, params=()):
         """
-        Close database connection
+        Execute parameterized statement without committing
+
+        Returns a new cursor, so results of several statements can be iterated at
+        the same time. SQLite keeps the compiled statement in its statement cache.
         """
-        self.conn.close()
+        if self.stats is not None:
+            return self._traced(arg, params, self.conn.execute, arg, params)
+        return self._retry(self.conn.execute, arg, params)
 
+    def executemany(self, arg, rows):
+        """
+        Execute parameterized statement for each row without committing
+        """
+        # Rows may be a generator that can only be consumed once
+        rows = list(rows)
+        if self.stats is not None:
+            # The plan of slow statements is explained with the first row
+            return self._traced(arg, rows[0] if rows else (), self.conn.executemany,
+                                arg, rows)
+        return self._retry(self.conn.executemany, arg, rows)
 
-class MailCtl(object):
-    """
-    Script main class
-    """
+    def begin(self):
+        """
+        Start a transaction unless one is already active
 
-    DB = 'mail.sqlite'
+        The write lock is taken right away, so statements inside the transaction
+        do not fail on a database locked by another writer.
+        """
+        if not self.conn.in_transaction:
+            self.execute('BEGIN IMMEDIATE')
 
-    def __init__(self):
-        # Create top level parser
-        parser = argparse.ArgumentParser(
-            description='Postfix database management tool',
-            usage='''mailctl.py <command> [<args>]
+    def commit(self):
+        """
+        Commit pending changes
+        """
+        if self.stats is not None:
+            self._traced('COMMIT', (), self.conn.commit)
+        else:
+            self._retry(self.conn.commit)
 
-The most commonly used commands are:
-   user     manage users
-   alias    mange aliases
-   domain   manage domains
-''')
-        parser.add_argument('command', help='Subcommand to run')
-        # parse_args defaults to [1:] for args, but exclude the rest of the args too,
-        # or validation will fail
-        args = parser.parse_args(sys.argv[1:2])
-        if not hasattr(self, args.command):
-            print('Unrecognized command')
-            parser.print_help()
-            sys.exit(1)
+    def rollback(self):
+        """
+        Discard pending changes
+        """
+        if self.stats is not None:
+            self._traced('ROLLBACK', (), self.conn.rollback)
+        else:
+            self.conn.rollback()
 
-        # Setup database connection
-        if not os.path.isfile(self.DB):
-            print('Database file {} is not a file.'.format(self.DB))
-            sys.exit(1)
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Run the statements of a with block in a single transaction
+
+        Changes are committed when the block completes and rolled back if it or
+        the commit raises. Nested blocks use savepoints, so they can be rolled back
+        on their own.
+        """
+        if self.conn.in_transaction:
+            self.savepoints += 1
+            savepoint = 'mailctl_{:d}'.format(self.savepoints)
+            self.execute('SAVEPOINT ' + savepoint)
+            try:
+                yield self
+            except BaseException:
+                self.execute('ROLLBACK TO ' + savepoint)
+                self.execute('RELEASE ' + savepoint)
+                raise
+            else:
+                self.execute('RELEASE ' + savepoint)
+            finally:
+                self.savepoints -= 1
         else:
+            self.begin()
             try:
-                self.db = Database(self.DB)
-            except sqlite3.OperationalError as error:
-                print('Failed to open database file {}: {}'.format(self.DB, str(error)))
-                sys.exit(1)
+                yield self
+                self.commit()
+            except BaseException:
+                # A failed commit leaves the transaction open
+                if self.conn.in_transaction:
+                    self.rollback()
+                raise
 
-        # use dispatch pattern to invoke method with same name
-        getattr(self, args.command)()
+    @contextlib.contextmanager
+    def snapshot(self):
+        """
+        Run the queries of a with block on one consistent state of the database
 
-    def _hash_password(self, password):
+        Unlike transaction() this does not take the write lock.
         """
-        Return SHA512-CRYPT password hash of a given password.
+        if self.conn.in_transaction:
+            yield self
+            return
+        self.execute('BEGIN DEFERRED')
+        try:
+            yield self
+        finally:
+            self.rollback()
 
-        Requires the passlib module to work
+    @staticmethod
+    def _window(limit, offset):
         """
-        if PASSLIB_ENABLED:
-            return '{SHA512-CRYPT}' + sha512_crypt.using(rounds=5000).hash(password)
-        else:
-            return False
+        Return LIMIT and OFFSET parameters, a negative limit means no limit
+        """
+        return (-1 if limit is None else limit), (0 if offset is None else offset)
+
+    # Domains
+
+    @stats_operation
+    def list_domains(self, limit=None, offset=None):
+        """
+        Return cursor of (name,) rows of domains ordered by name
+        """
+        return self.execute('SELECT name FROM virtual_domains ORDER BY name '
+                            'LIMIT ? OFFSET ?', self._window(limit, offset))
+
+    @stats_operation
+    def domain_ids(self):
+        """
+        Return dictionary mapping all domain names to their ids
+        """
+        return dict(self.execute('SELECT name, id FROM virtual_domains'))
+
+    @stats_operation
+    def get_domain_id(self, name):
+        """
+        Return id of domain, None if it does not exist
+        """
+        row = self.execute('SELECT id FROM virtual_domains WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    @stats_operation
+    def add_domain(self, name):
+        """
+        Add domain, returns its id
+        """
+        return self.execute('INSERT INTO virtual_domains (name) VALUES (?)', (name,)).lastrowid
+
+    @stats_operation
+    def delete_domain(self, name):
+        """
+        Delete domain, returns number of deleted rows
+        """
+        return self.execute('DELETE FROM virtual_domains WHERE name = ?', (name,)).rowcount
 
-    def _get_domain_users(self, domainname):
+    @stats_operation
+    def delete_domains(self, rows):
         """
-        Retrieve users for a domain from database
+        Delete domains from (name,) rows including their users and aliases
 
-        Returns list of users if users are configured. Empty list if there aren't any.
+        Returns number of deleted domains.
         """
+        return self.executemany('DELETE FROM virtual_domains WHERE name = ?', rows).rowcount
 
-        db_query = "SELECT  email FROM virtual_users WHERE domain_id = "\
-                   "(SELECT id from virtual_domains WHERE name='{}')".format(domainname)
-        result = self.db.query(db_query)
-        result_set = result.fetchall()
-        users = []
-        if result_set:
-            for row in result_set:
-                users.append(row[0])
-        return users
+    # Users
 
-    def _get_domain_aliases(self, domainname):
+    @stats_operation
+    def list_users(self, limit=None, offset=None):
         """
-        Retrieve aliases for a domain from database
+        Return cursor of (email,) rows of users ordered by email
+        """
+        return self.execute('SELECT email FROM virtual_users ORDER BY email '
+                            'LIMIT ? OFFSET ?', self._window(limit, offset))
 
-        Returns list of aliases if aliases are configured. Empty list if there aren't any.
+    @stats_operation
+    def user_emails(self):
+        """
+        Return set of all user emails
         """
+        return set(row[0] for row in self.execute('SELECT email FROM virtual_users'))
 
-        db_query = "SELECT  source FROM virtual_aliases WHERE domain_id = "\
-                   "(SELECT id from virtual_domains WHERE name='{}')".format(domainname)
-        result = self.db.query(db_query)
-        result_set = result.fetchall()
-        aliases = []
-        if result_set:
-            for row in result_set:
-                alias = row[0]
-                if alias not in aliases:
-                    aliases.append(alias)
-        return sorted(aliases)
+    @stats_operation
+    def user_exists(self, email):
+        """
+        Return True if user exists
+        """
+        return self.execute('SELECT 1 FROM virtual_users WHERE email = ?',
+                            (email,)).fetchone() is not None
 
-    def _get_user_aliases(self, username):
+    @stats_operation
+    def list_domain_users(self, name):
         """
-        Retrieve virtual aliases for a user from database
+        Return list of emails of all users of a domain
+        """
+        return [row[0] for row in self.execute(
+            'SELECT email FROM virtual_users WHERE domain_id = '
+            '(SELECT id FROM virtual_domains WHERE name = ?)', (name,))]
 
-        Returns list of aliases if aliases are configured. Empty list if there aren't any.
+    @stats_operation
+    def add_users(self, rows):
+        """
+        Add users from (domain_id, password_hash, email) rows, returns number of rows
         """
+        return self.executemany(
+            'INSERT INTO virtual_users (domain_id, password, email) VALUES (?, ?, ?)',
+            rows).rowcount
 
-        db_query = "SELECT source FROM virtual_aliases WHERE destination = '{}'".format(username)
-        result = self.db.query(db_query)
-        result_set = result.fetchall()
-        aliases = []
-        if result_set:
-            for row in result_set:
-                aliases.append(row[0])
-        return aliases
+    @stats_operation
+    def set_passwords(self, rows):
+        """
+        Update passwords from (password_hash, email) rows, returns number of rows
+        """
+        return self.executemany('UPDATE virtual_users SET password = ? WHERE email = ?',
+                                rows).rowcount
 
-    def show_domains(self):
+    @stats_operation
+    def delete_user(self, email):
         """
-        Show database domains
+        Delete user, returns number of deleted rows
         """
-        db_query = 'SELECT name FROM virtual_domains'
-        result = self.db.query(db_query)
-        for row in result:
-            print(row[0])
+        return self.execute('DELETE FROM virtual_users WHERE email = ?', (email,)).rowcount
 
-    def add_domain(self, domainname):
+    @stats_operation
+    def delete_domain_users(self, name):
         """
-        Addd domain to database
+        Delete all users of a domain, returns number of deleted rows
         """
+        return self.execute('DELETE FROM virtual_users WHERE domain_id = '
+                            '(SELECT id FROM virtual_domains WHERE name = ?)',
+                            (name,)).rowcount
 
-        # Check if domain already exists before we add it twice
-        db_query = "SELECT name FROM virtual_domains WHERE name = '{}'".format(domainname)
-        result = self.db.query(db_query)
-        if result.fetchone():
-            print('Domain {} already exists!'.format(domainname))
-            return False
-        
-        # Add domain to database
-        db_query = "INSERT INTO virtual_domains (name) VALUES ('{}')".format(domainname)
-        result = self.db.query(db_query)
-        if result.rowcount:
-            print('Added domain {}'.format(domainname))
-            return True
-        else:
-            print('Failed to add domain {}'.format(domainname))
-            return False
+    @stats_operation
+    def delete_users(self, rows):
+        """
+        Delete users from (email,) rows, returns number of deleted rows
+        """
+        return self.executemany('DELETE FROM virtual_users WHERE email = ?', rows).rowcount
 
-    def delete_domain(self, domainname):
+    # Aliases
+
+    @stats_operation
+    def list_aliases(self, enabled=None):
         """
-        Delete domain including all users and aliases from database
+        Return cursor of (source, destination) rows of all aliases
+
+        Only enabled or disabled aliases are returned if enabled is True or False.
         """
+        if enabled is None:
+            return self.execute('SELECT source, destination FROM virtual_aliases')
+        return self.execute('SELECT source, destination FROM virtual_aliases '
+                            'WHERE enabled = ?', (int(enabled),))
 
-        # Check if domain to be deleted exists in database
-        db_query = "SELECT name FROM virtual_domains WHERE name = '{}'".format(domainname)
-        result = self.db.query(db_query)
-        if not result.fetchone():
-            print('Domain {} not found!'.format(domainname))
-            return False
+    @stats_operation
+    def alias_pairs(self):
+        """
+        Return set of (source, destination) tuples of all aliases
+        """
+        return set(self.list_aliases())
 
-        # Get list of users of this domain
-        users = self._get_domain_users(domainname)
-        if users:
-            print('Domain {} is home of these users. They will be deleted!'.format(domainname))
-            for user in sorted(users):
-                print(user)
-        else:
-            print("Domain {} has no users".format(domainname))
-        
-        # Get list of aliases of this domain
-        aliases = self._get_domain_aliases(domainname)
-        if aliases:
-            print('Domain {} is home of these aliases. They will be deleted!'.format(domainname))
-            for alias in sorted(aliases):
-                print(alias)
-        else:
-            print("Domain {} has no aliases".format(domainname))
-        
-        confirmation = raw_input('\nEnter YES to remove domain {} including '\
-                                 'all aliases and users: '.format(domainname))
-        if confirmation != 'YES':
-            print('Aborting')
-            return True
+    @stats_operation
+    def alias_states(self):
+        """
+        Return dictionary of enabled flags by (source, destination) of all aliases
+        """
+        return dict(((source, destination), bool(enabled)) for source, destination, enabled
+                    in self.execute('SELECT source, destination, enabled FROM virtual_aliases'))
 
-        # Delete virtual aliases from this domain
-        if aliases:
-            db_query = "DELETE FROM virtual_aliases WHERE domain_id = "\
-                       "(SELECT id from virtual_domains WHERE name='{}')".format(domainname)
-            result = self.db.query(db_query)
-            if result.rowcount:
-                print("Deleted virtual aliases from " + domainname)
-            else:
-                print("Failed to delete virtual aliases from " + domainname)
-                return False
+    @stats_operation
+    def list_alias_groups(self, enabled=None, limit=None, offset=None):
+        """
+        Return cursor of (source, destinations) rows ordered by source
 
-        # Delete users from this domain
-        if users:
-            db_query = "DELETE FROM virtual_users WHERE domain_id = "\
-                        "(SELECT id from virtual_domains WHERE name='{}')".format(domainname)
-            result = self.db.query(db_query)
-            if result.rowcount:
-                print("Deleted users from " + domainname)
-            else:
-                print("Failed to delete users from " + domainname)
-                return False
+        Destinations of an alias are joined by newlines. Only enabled or disabled
+        aliases are returned if enabled is True or False.
+        """
+        if enabled is None:
+            return self.execute('SELECT source, group_concat(destination, char(10)) '
+                                'FROM virtual_aliases '
+                                'GROUP BY source ORDER BY source LIMIT ? OFFSET ?',
+                                self._window(limit, offset))
+        return self.execute('SELECT source, group_concat(destination, char(10)) '
+                            'FROM virtual_aliases WHERE enabled = ? '
+                            'GROUP BY source ORDER BY source LIMIT ? OFFSET ?',
+                            (int(enabled),) + self._window(limit, offset))
 
-        # Delete the domain itself
-        db_query = "DELETE FROM virtual_domains WHERE name = '{}'".format(domainname)
-        result = self.db.query(db_query)
-        if result.rowcount:
-            print('Deleted domain {}'.format(domainname))
-            return True
+    @stats_operation
+    def has_table(self, name):
+        """
+        Return True if a table or virtual table exists
+        """
+        return self.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                            (name,)).fetchone() is not None
+
+    @stats_operation
+    def search_alias_groups(self, pattern, mode='substring', field='source',
+                            limit=None, offset=None):
+        """
+        Return cursor of (source, destinations) rows of matching aliases
+
+        Modes are exact match, prefix match, domain match and substring match. Exact
+        and prefix matches use the indexes on source and destination, domain matches
+        of sources the domain index. Substring matches use the trigram full text
+        index if the schema has it, otherwise all aliases are scanned. The field is
+        source, destination, description or any of them. All destinations of an
+        alias are returned if one of them matches.
+        """
+        if mode not in self.SEARCH_MODES:
+            raise ValueError('invalid search mode {}'.format(mode))
+        if field not in self.SEARCH_FIELDS:
+            raise ValueError('invalid search field {}'.format(field))
+        fields = ('source', 'destination', 'description') if field == 'any' else (field,)
+        conditions = []
+        params = []
+        if mode == 'exact':
+            for column in fields:
+                conditions.append('{} = ?'.format(column))
+                params.append(pattern)
+        elif mode == 'prefix' and pattern:
+            # Range scans can use an index, LIKE 'prefix%' can not with BINARY collation
+            upper = pattern[:-1] + chr(min(ord(pattern[-1]) + 1, sys.maxunicode))
+            for column in fields:
+                conditions.append('({0} >= ? AND {0} < ?)'.format(column))
+                params.extend((pattern, upper))
+        elif mode == 'domain':
+            if 'source' in fields:
+                conditions.append('domain_id = (SELECT id FROM virtual_domains WHERE name = ?)')
+                params.append(pattern)
+            for column in fields:
+                if column != 'source':
+                    conditions.append("{} LIKE ? ESCAPE '\\'".format(column))
+                    params.append('%@' + self._escape_like(pattern))
+        elif len(pattern) >= self.FTS_MIN_PATTERN and self.has_table('virtual_aliases_fts'):
+            columns = '' if field == 'any' else field + ' : '
+            conditions.append('id IN (SELECT rowid FROM virtual_aliases_fts '
+                              'WHERE virtual_aliases_fts MATCH ?)')
+            params.append('{}"{}"'.format(columns, pattern.replace('"', '""')))
         else:
-            print('Failed to delete domain {} '.format(domainname))
-            return False
+            for column in fields:
+                conditions.append("{} LIKE ? ESCAPE '\\'".format(column))
+                params.append('%' + self._escape_like(pattern) + '%')
+        if not conditions:
+            conditions.append('1')
+        return self.execute('SELECT source, group_concat(destination, char(10)) '
+                            'FROM virtual_aliases WHERE source IN '
+                            '(SELECT source FROM virtual_aliases WHERE {}) '
+                            'GROUP BY source ORDER BY source LIMIT ? OFFSET ?'.format(
+                                ' OR '.join(conditions)),
+                            tuple(params) + self._window(limit, offset))
+
+    @staticmethod
+    def _escape_like(value):
+        """
+        Escape LIKE wildcards in value, using backslash as escape character
+        """
+        return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+    @stats_operation
+    def alias_exists(self, source, destination=None, enabled=None):
+        """
+        Return True if alias exists
+
+        Optionally only matches a given destination and enabled state.
+        """
+        if destination is not None:
+            return self.execute('SELECT 1 FROM virtual_aliases '
+                                'WHERE source = ? AND destination = ?',
+                                (source, destination)).fetchone() is not None
+        if enabled is not None:
+            return self.execute('SELECT 1 FROM virtual_aliases '
+                                'WHERE source = ? AND enabled = ?',
+                                (source, int(enabled))).fetchone() is not None
+        return self.execute('SELECT 1 FROM virtual_aliases WHERE source = ?',
+                            (source,)).fetchone() is not None
+
+    @stats_operation
+    def list_aliases_for_destination(self, email):
+        """
+        Return list of sources of aliases delivering to email
+        """
+        return [row[0] for row in self.execute(
+            'SELECT source FROM virtual_aliases WHERE destination = ?', (email,))]
+
+    @stats_operation
+    def list_domain_aliases(self, name):
+        """
+        Return sorted list of distinct alias sources of a domain
+        """
+        return [row[0] for row in self.execute(
+            'SELECT DISTINCT source FROM virtual_aliases WHERE domain_id = '
+            '(SELECT id FROM virtual_domains WHERE name = ?) ORDER BY source', (name,))]
+
+    @stats_operation
+    def add_alias(self, source, destination, description, domain_id):
+        """
+        Add alias, returns its id
+        """
+        return self.execute('INSERT INTO virtual_aliases '
+                            '(source, destination, description, domain_id) '
+                            'VALUES (?, ?, ?, ?)',
+                            (source, destination, description, domain_id)).lastrowid
+
+    @contextlib.contextmanager
+    def bulk_alias_insert(self):
+        """
+        Index, log and count aliases added in the with block with one statement each
+
+        Sets the bulk_insert flag, which the per row insert triggers on aliases
+        check, for the duration of the block. This is several times faster for
+        large batches. Runs in a transaction, other connections never see the flag.
+        """
+        with self.transaction():
+            triggers = [name for name, in self.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name IN ({})"
+                .format(', '.join('?' * len(self.BULK_TRIGGERS))), tuple(self.BULK_TRIGGERS))]
+            if not triggers:
+                yield
+                return
+            last_id = self.execute('SELECT coalesce(max(id), 0) FROM virtual_aliases') \
+                .fetchone()[0]
+            self.execute("INSERT INTO mailctl_settings (key, value) VALUES ('bulk_insert', '1')")
+            yield
+            self.execute("DELETE FROM mailctl_settings WHERE key = 'bulk_insert'")
+            # New rows get ids above the previous maximum
+            for name in triggers:
+                self.execute(self.BULK_TRIGGERS[name], (last_id,))
+
+    @stats_operation
+    def add_aliases(self, rows):
+        """
+        Add aliases from (source, destination, description, domain_id) rows
+
+        Large batches are added to the search index and the change log by
+        bulk_alias_insert(). Returns number of rows.
+        """
+        rows = list(rows)
+        if len(rows) < self.FTS_BULK_ROWS:
+            return self.executemany('INSERT INTO virtual_aliases '
+                                    '(source, destination, description, domain_id) '
+                                    'VALUES (?, ?, ?, ?)', rows).rowcount
+        with self.bulk_alias_insert():
+            return self.executemany('INSERT INTO virtual_aliases '
+                                    '(source, destination, description, domain_id) '
+                                    'VALUES (?, ?, ?, ?)', rows).rowcount
+
+    @stats_operation
+    def set_alias_enabled(self, source, enabled):
+        """
+        Enable or disable all destinations of an alias, returns number of rows
+        """
+        return self.execute('UPDATE virtual_aliases SET enabled = ? WHERE source = ?',
+                            (int(enabled), source)).rowcount
+
+    @stats_operation
+    def set_aliases_enabled(self, rows):
+        """
+        Enable or disable aliases from (enabled, source, destination) rows
+
+        Returns number of rows.
+        """
+        return self.executemany('UPDATE virtual_aliases SET enabled = ? '
+                                'WHERE source = ? AND destination = ?', rows).rowcount
+
+    @stats_operation
+    def delete_aliases(self, rows):
+        """
+        Delete aliases from (source, destination) rows, returns number of deleted rows
+        """
+        return self.executemany('DELETE FROM virtual_aliases '
+                                'WHERE source = ? AND destination = ?', rows).rowcount
+
+    @stats_operation
+    def delete_alias(self, source):
+        """
+        Delete all destinations of an alias, returns number of deleted rows
+        """
+        return self.execute('DELETE FROM virtual_aliases WHERE source = ?',
+                            (source,)).rowcount
+
+    @stats_operation
+    def delete_aliases_for_destination(self, email):
+        """
+        Delete all aliases delivering to email, returns number of deleted rows
+        """
+        return self.execute('DELETE FROM virtual_aliases WHERE destination = ?',
+                            (email,)).rowcount
+
+    @stats_operation
+    def delete_domain_aliases(self, name):
+        """
+        Delete all aliases of a domain, returns number of deleted rows
+        """
+        return self.execute('DELETE FROM virtual_aliases WHERE domain_id = '
+                            '(SELECT id FROM virtual_domains WHERE name = ?)',
+                            (name,)).rowcount
+
+    # Bulk operations on targets collected in temporary tables
+
+    @stats_operation
+    def collect_alias_targets(self, sources=(), domains=(), patterns=()):
+        """
+        Collect existing aliases by source, domain name or GLOB pattern of source
+
+        Replaces the targets of earlier calls. Returns number of distinct sources.
+        """
+        self.execute('CREATE TEMP TABLE IF NOT EXISTS mailctl_alias_targets '
+                     '(source TEXT PRIMARY KEY) WITHOUT ROWID')
+        self.execute('DELETE FROM temp.mailctl_alias_targets')
+        self.executemany('INSERT OR IGNORE INTO temp.mailctl_alias_targets (source) '
+                         'SELECT source FROM virtual_aliases WHERE source = ?',
+                         ((source,) for source in sources))
+        self.executemany('INSERT OR IGNORE INTO temp.mailctl_alias_targets (source) '
+                         'SELECT source FROM virtual_aliases WHERE domain_id = '
+                         '(SELECT id FROM virtual_domains WHERE name = ?)',
+                         ((domain,) for domain in domains))
+        self.executemany('INSERT OR IGNORE INTO temp.mailctl_alias_targets (source) '
+                         'SELECT source FROM virtual_aliases WHERE source GLOB ?',
+                         ((pattern,) for pattern in patterns))
+        return self.execute('SELECT count(*) FROM temp.mailctl_alias_targets').fetchone()[0]
+
+    @stats_operation
+    def count_alias_targets(self, enabled=None):
+        """
+        Return (sources, rows) of collected aliases, optionally only enabled or disabled
+        """
+        return self.execute('SELECT count(DISTINCT source), count(*) FROM virtual_aliases '
+                            'WHERE source IN (SELECT source FROM temp.mailctl_alias_targets) '
+                            'AND (? IS NULL OR enabled = ?)',
+                            (enabled, enabled)).fetchone()
+
+    @stats_operation
+    def list_alias_targets(self, enabled=None, limit=None):
+        """
+        Return cursor of (source,) rows of collected aliases ordered by source
+        """
+        return self.execute('SELECT DISTINCT source FROM virtual_aliases '
+                            'WHERE source IN (SELECT source FROM temp.mailctl_alias_targets) '
+                            'AND (? IS NULL OR enabled = ?) ORDER BY source LIMIT ?',
+                            (enabled, enabled, self._window(limit, None)[0]))
+
+    @stats_operation
+    def set_alias_targets_enabled(self, enabled):
+        """
+        Enable or disable all collected aliases, returns number of changed rows
+        """
+        return self.execute('UPDATE virtual_aliases SET enabled = ? '
+                            'WHERE source IN (SELECT source FROM temp.mailctl_alias_targets) '
+                            'AND enabled IS NOT ?', (int(enabled), int(enabled))).rowcount
+
+    @stats_operation
+    def delete_alias_targets(self):
+        """
+        Delete all collected aliases, returns number of deleted rows
+        """
+        return self.execute('DELETE FROM virtual_aliases WHERE source IN '
+                            '(SELECT source FROM temp.mailctl_alias_targets)').rowcount
+
+    @stats_operation
+    def collect_domain_targets(self, names):
+        """
+        Collect existing domains by name, replacing earlier targets
+
+        Returns list of (name, users, aliases) rows of the collected domains.
+        """
+        self.execute('CREATE TEMP TABLE IF NOT EXISTS mailctl_domain_targets '
+                     '(id INTEGER PRIMARY KEY)')
+        self.execute('DELETE FROM temp.mailctl_domain_targets')
+        self.executemany('INSERT OR IGNORE INTO temp.mailctl_domain_targets (id) '
+                         'SELECT id FROM virtual_domains WHERE name = ?',
+                         ((name,) for name in names))
+        return self.execute('SELECT name, '
+                            '(SELECT count(*) FROM virtual_users WHERE domain_id = d.id), '
+                            '(SELECT count(*) FROM virtual_aliases WHERE domain_id = d.id) '
+                            'FROM virtual_domains d '
+                            'WHERE id IN (SELECT id FROM temp.mailctl_domain_targets) '
+                            'ORDER BY name').fetchall()
+
+    @stats_operation
+    def list_domain_target_users(self):
+        """
+        Return list of email addresses of users of collected domains
+        """
+        return [email for email, in self.execute(
+            'SELECT email FROM virtual_users '
+            'WHERE domain_id IN (SELECT id FROM temp.mailctl_domain_targets)')]
+
+    @stats_operation
+    def delete_domain_targets(self):
+        """
+        Delete collected domains with their aliases and users
+
+        Returns numbers of deleted domains, users and aliases.
+        """
+        aliases = self.execute('DELETE FROM virtual_aliases WHERE domain_id IN '
+                               '(SELECT id FROM temp.mailctl_domain_targets)').rowcount
+        users = self.execute('DELETE FROM virtual_users WHERE domain_id IN '
+                             '(SELECT id FROM temp.mailctl_domain_targets)').rowcount
+        domains = self.execute('DELETE FROM virtual_domains WHERE id IN '
+                               '(SELECT id FROM temp.mailctl_domain_targets)').rowcount
+        return domains, users, aliases
+
+    # Lookup tables
+
+    @stats_operation
+    def export_domains(self):
+        """
+        Return cursor of (key, value) rows answering virtual_mailbox_domains lookups
+
+        Keys are lower case, as Postfix folds the case of lookup keys.
+        """
+        return self.execute("SELECT DISTINCT lower(name), '1' FROM virtual_domains ORDER BY 1")
+
+    @stats_operation
+    def export_mailboxes(self):
+        """
+        Return cursor of (key, value) rows answering virtual_mailbox_maps lookups
+        """
+        return self.execute("SELECT DISTINCT lower(email), '1' FROM virtual_users ORDER BY 1")
+
+    @stats_operation
+    def export_aliases(self):
+        """
+        Return cursor of (key, value) rows answering virtual_alias_maps lookups
+
+        Values are the comma separated destinations of enabled aliases.
+        """
+        return self.execute("SELECT key, group_concat(destination, ',') FROM "
+                            "(SELECT lower(source) AS key, destination FROM virtual_aliases "
+                            "WHERE enabled ORDER BY key, destination) "
+                            "GROUP BY key ORDER BY key")
+
+    @stats_operation
+    def export_passwords(self):
+        """
+        Return cursor of (email, password) rows for Dovecot passwd-file
+        """
+        return self.execute('SELECT email, password FROM virtual_users ORDER BY email')
+
+    # Change log
+
+    @stats_operation
+    def change_range(self):
+        """
+        Return (first, last) sequence numbers of the change log
+
+        first is the oldest change still kept, last + 1 if the log is empty.
+        """
+        last = self.execute("SELECT seq FROM sqlite_sequence WHERE name = 'mailctl_changes'") \
+            .fetchone()
+        last = 0 if last is None else last[0]
+        first = self.execute('SELECT min(seq) FROM mailctl_changes').fetchone()[0]
+        return (last + 1 if first is None else first), last
+
+    @stats_operation
+    def list_changes(self, since, limit=None):
+        """
+        Return cursor of (seq, json) rows of changes after seq since, oldest first
+        """
+        return self.execute("SELECT seq, json_object('seq', seq, 'changed', changed, "
+                            "'table', table_name, 'operation', operation, 'id', row_id, "
+                            "'row', json(data)) FROM mailctl_changes WHERE seq > ? "
+                            'ORDER BY seq LIMIT ?', (since, self._window(limit, None)[0]))
+
+    @stats_operation
+    def list_replicated_changes(self, since, limit=None):
+        """
+        Return cursor of (seq, json) rows of changes after seq since for replicas
+
+        The log has no password hashes, user inserts and updates carry the current
+        row instead, null if the user was deleted since.
+        """
+        return self.execute("SELECT seq, json_object('seq', seq, 'changed', changed, "
+                            "'table', table_name, 'operation', operation, 'id', row_id, "
+                            "'row', CASE WHEN table_name = 'virtual_users' "
+                            "AND operation != 'delete' THEN (SELECT json_object("
+                            "'id', id, 'domain_id', domain_id, 'email', email, "
+                            "'password', password) FROM virtual_users WHERE id = row_id) "
+                            'ELSE json(data) END) FROM mailctl_changes WHERE seq > ? '
+                            'ORDER BY seq LIMIT ?', (since, self._window(limit, None)[0]))
+
+    @stats_operation
+    def prune_changes(self, before):
+        """
+        Delete changes with seq below before, returns number of deleted rows
+        """
+        return self.execute('DELETE FROM mailctl_changes WHERE seq < ?', (before,)).rowcount
+
+    @stats_operation
+    def prune_old_changes(self, days):
+        """
+        Delete changes logged more than days ago, returns number of deleted rows
+        """
+        return self.execute("DELETE FROM mailctl_changes WHERE changed < datetime('now', ?)",
+                            ('-{:g} days'.format(days),)).rowcount
+
+    # Replication
+
+    @stats_operation
+    def replication_state(self):
+        """
+        Return dictionary of replication state values
+        """
+        return dict(self.execute('SELECT key, value FROM mailctl_replication'))
+
+    @stats_operation
+    def set_replication_state(self, **values):
+        """
+        Store replication state values
+        """
+        self.executemany('INSERT INTO mailctl_replication (key, value) VALUES (?, ?) '
+                         'ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+                         values.items())
+
+    @stats_operation
+    def log_id(self):
+        """
+        Return random id of the change log of this database, created on first use
+
+        Replicas following a log with another id need a full copy.
+        """
+        self.execute('INSERT OR IGNORE INTO mailctl_replication (key, value) '
+                     "VALUES ('log_id', ?)", (os.urandom(8).hex(),))
+        return self.execute("SELECT value FROM mailctl_replication "
+                            "WHERE key = 'log_id'").fetchone()[0]
+
+    @stats_operation
+    def reset_log_id(self):
+        """
+        Make replicas start over with a full copy, e.g. after a restore
+        """
+        if self.has_table('mailctl_replication'):
+            self.execute("DELETE FROM mailctl_replication WHERE key = 'log_id'")
+
+    @stats_operation
+    def dump_rows(self, table):
+        """
+        Return cursor of (json,) rows with all replicated columns of table ordered by id
+        """
+        # Table and column names come from REPLICATED_TABLES, not from input
+        return self.execute('SELECT json_object({}) FROM {} ORDER BY id'.format(
+            ', '.join("'{0}', {0}".format(column)
+                      for column in self.REPLICATED_TABLES[table]), table))
+
+    @stats_operation
+    def clear_replicated(self):
+        """
+        Delete all rows of replicated tables
+        """
+        for table in reversed(list(self.REPLICATED_TABLES)):
+            self.execute('DELETE FROM {}'.format(table))
+
+    @stats_operation
+    def upsert_rows(self, table, rows):
+        """
+        Insert or update rows of a replicated table from dictionaries by id
+        """
+        columns = self.REPLICATED_TABLES[table]
+        return self.executemany('INSERT INTO {} ({}) VALUES ({}) ON CONFLICT (id) '
+                                'DO UPDATE SET {}'.format(
+                                    table, ', '.join(columns), ', '.join('?' * len(columns)),
+                                    ', '.join('{0} = excluded.{0}'.format(column)
+                                              for column in columns[1:])),
+                                ([row[column] for column in columns] for row in rows)).rowcount
+
+    @stats_operation
+    def delete_rows(self, table, ids):
+        """
+        Delete rows of a replicated table by id, returns number of deleted rows
+        """
+        if table not in self.REPLICATED_TABLES:
+            raise KeyError(table)
+        return self.executemany('DELETE FROM {} WHERE id = ?'.format(table),
+                                ((row_id,) for row_id in ids)).rowcount
+
+    # Backups
+
+    def backup(self, path, pages=BACKUP_PAGES, pause=BACKUP_PAUSE):
+        """
+        Copy the committed state of the database into the SQLite file at path
+
+        Uses its own connection, so changes of a transaction running on this one
+        are not included. Pages are copied in steps, pausing between them, so
+        other connections are never locked out for long. Returns number of pages.
+        """
+        source = sqlite3.connect(self.path)
+        target = sqlite3.connect(path, isolation_level=None)
+        pages_copied = [0]
+
+        def progress(status, remaining, total):
+            pages_copied[0] = total
+            if remaining:
+                time.sleep(pause)
+
+        try:
+            source.backup(target, pages=pages, progress=progress)
+            # Backups are single files, no matter the journal mode of the database
+            target.execute('PRAGMA journal_mode = delete')
+        finally:
+            target.close()
+            source.close()
+        return pages_copied[0]
+
+    @staticmethod
+    def check_file(path):
+        """
+        Return result of PRAGMA quick_check of the SQLite file at path, ok if intact
+        """
+        connection = sqlite3.connect('file:{}?mode=ro'.format(urllib_parse.quote(path)),
+                                     uri=True)
+        try:
+            return '\n'.join(row[0] for row in connection.execute('PRAGMA quick_check'))
+        finally:
+            connection.close()
+
+    @stats_operation
+    def restore(self, path):
+        """
+        Replace the content of the database with the SQLite file at path
+
+        All pages are copied in one step, so other connections never see a
+        partially restored database.
+        """
+        source = sqlite3.connect(path)
+        try:
+            source.backup(self.conn)
+        finally:
+            source.close()
+
+    # Statistics
+
+    @stats_operation
+    def domain_stats(self, limit=None, offset=None):
+        """
+        Return cursor of (name, users, aliases, destinations, disabled) rows by name
+
+        Counts are kept current by triggers, so no users or aliases are scanned.
+        Aliases are distinct sources, destinations and disabled count alias rows.
+        """
+        return self.execute('SELECT name, users, aliases, destinations, disabled '
+                            'FROM virtual_domains JOIN mailctl_domain_stats '
+                            'ON domain_id = virtual_domains.id ORDER BY name '
+                            'LIMIT ? OFFSET ?', self._window(limit, offset))
+
+    @stats_operation
+    def stats_totals(self):
+        """
+        Return numbers of domains, users, aliases, destinations and disabled destinations
+        """
+        return tuple(self.execute('SELECT count(*), total(users), total(aliases), '
+                                  'total(destinations), total(disabled) '
+                                  'FROM mailctl_domain_stats').fetchone())
+
+    # Maintenance
+
+    @stats_operation
+    def integrity_check(self, quick=False):
+        """
+        Return list of problems found by PRAGMA integrity_check, ['ok'] if intact
+
+        With quick, PRAGMA quick_check is used, which skips checking that
+        indexes match their tables.
+        """
+        return [row[0] for row in self.execute(
+            'PRAGMA quick_check' if quick else 'PRAGMA integrity_check').fetchall()]
+
+    @stats_operation
+    def foreign_key_check(self):
+        """
+        Return list of table, rowid and referenced table of rows violating foreign keys
+        """
+        return [tuple(row[:3]) for row in self.execute('PRAGMA foreign_key_check').fetchall()]
+
+    @stats_operation
+    def analyze(self, limit=ANALYSIS_LIMIT):
+        """
+        Collect statistics of all tables and indexes for the query planner
+
+        limit bounds the rows examined per index, so the write lock is held
+        briefly even on large databases.
+        """
+        # PRAGMA does not support parameters, limit is always an integer
+        self.execute('PRAGMA analysis_limit = {:d}'.format(limit))
+        self.execute('ANALYZE')
+        self.execute('PRAGMA optimize')
+
+    @stats_operation
+    def page_counts(self):
+        """
+        Return page size, number of pages and number of free pages
+        """
+        return tuple(self.execute('PRAGMA {}'.format(pragma)).fetchone()[0]
+                     for pragma in ('page_size', 'page_count', 'freelist_count'))
+
+    @stats_operation
+    def auto_vacuum(self):
+        """
+        Return auto vacuum mode of the database: none, full or incremental
+        """
+        return ('none', 'full', 'incremental')[
+            self.execute('PRAGMA auto_vacuum').fetchone()[0]]
+
+    @stats_operation
+    def incremental_vacuum(self, max_pages=None, pages=VACUUM_PAGES, pause=VACUUM_PAUSE):
+        """
+        Release free pages to the file system in steps, returns number of steps
+
+        Each step is a short write transaction of its own, pausing between
+        them, so other connections are never locked out for long. Stops when
+        no free pages are left or max_pages pages have been released. Does
+        nothing unless the auto vacuum mode is incremental.
+        """
+        steps = 0
+        released = 0
+        free = self.page_counts()[2]
+        while free and (max_pages is None or released < max_pages):
+            if steps:
+                time.sleep(pause)
+            step = pages if max_pages is None else min(pages, max_pages - released)
+            # PRAGMA does not support parameters, step is always an integer. Python
+            # steps statements without result columns once, releasing a single
+            # page, executescript() steps until done.
+            sql = 'PRAGMA incremental_vacuum({:d})'.format(step)
+            if self.stats is not None:
+                self._traced(sql, (), self.conn.executescript, sql)
+            else:
+                self._retry(self.conn.executescript, sql)
+            steps += 1
+            remaining = self.page_counts()[2]
+            if remaining >= free:
+                break
+            released += free - remaining
+            free = remaining
+        return steps
+
+    @stats_operation
+    def vacuum(self):
+        """
+        Rebuild the database file, switching it to incremental auto vacuum
+
+        Writers are locked out until the whole database has been rewritten.
+        """
+        self.execute('PRAGMA auto_vacuum = incremental')
+        self.execute('VACUUM')
+
+    @stats_operation
+    def checkpoint(self):
+        """
+        Copy committed WAL pages into the database file without waiting for readers
+
+        Returns number of WAL frames and of frames copied, -1 outside WAL mode.
+        """
+        return tuple(self.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()[1:])
+
+    @stats_operation
+    def space_usage(self):
+        """
+        Return name, type, pages, bytes and unused bytes of all tables and indexes
+
+        Sorted by size, largest first. Needs SQLite built with the dbstat
+        virtual table.
+        """
+        return self.execute(
+            "SELECT s.name, COALESCE(m.type, 'table'), s.pageno, s.pgsize, s.unused "
+            'FROM dbstat AS s LEFT JOIN sqlite_master AS m ON m.name = s.name '
+            'WHERE s.aggregate = 1 ORDER BY s.pgsize DESC, s.name').fetchall()
+
+    # Schema
+
+    @stats_operation
+    def data_version(self):
+        """
+        Return number that changes whenever another connection commits changes
+        """
+        return self.execute('PRAGMA data_version').fetchone()[0]
+
+    @stats_operation
+    def schema_version(self):
+        """
+        Return number of schema migrations applied to database
+        """
+        return self.execute('PRAGMA user_version').fetchone()[0]
+
+    @stats_operation
+    def migrate(self, version):
+        """
+        Apply schema migration with given version number in a transaction
+
+        Returns number of rows changed by the migration.
+        """
+        description, statements = self.MIGRATIONS[version - 1]
+        changes = self.conn.total_changes
+        with self.transaction():
+            for statement in statements:
+                self.execute(statement)
+            # PRAGMA does not support parameters, version is always an integer
+            self.execute('PRAGMA user_version = {:d}'.format(version))
+        return self.conn.total_changes - changes
+
+    def __del__(self):
+        """
+        Close database connection
+        """
+        self.conn.close()
+
+
+class CredentialCache(object):
+    """
+    Bounded LRU cache of verified credentials with time to live
+
+    Entries remember the password hash they were verified against, so a changed
+    hash is a cache miss even before the entry is invalidated. Passwords are only
+    kept as digests keyed with a random per process secret.
+    """
+
+    def __init__(self, size=10000, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.secret = os.urandom(32)
+        self.hits = 0
+        self.misses = 0
+
+    def digest(self, password):
+        """
+        Return keyed digest of password
+        """
+        return hmac.new(self.secret, password.encode('utf-8'), 'sha256').digest()
+
+    def check(self, username, password, password_hash):
+        """
+        Return True if password was recently verified against password_hash
+        """
+        entry = self.entries.get(username)
+        if entry is not None:
+            digest, verified_hash, expires = entry
+            if expires < time.monotonic() or verified_hash != password_hash:
+                del self.entries[username]
+            elif hmac.compare_digest(digest, self.digest(password)):
+                self.entries.move_to_end(username)
+                self.hits += 1
+                return True
+        self.misses += 1
+        return False
+
+    def add(self, username, password, password_hash):
+        """
+        Remember that password was verified against password_hash
+        """
+        self.entries[username] = (self.digest(password), password_hash,
+                                  time.monotonic() + self.ttl)
+        self.entries.move_to_end(username)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, username):
+        """
+        Forget verified credentials of user
+        """
+        self.entries.pop(username, None)
+
+
+class LookupServer(object):
+    """
+    Answer Postfix socketmap and tcp_table lookups from an in-memory index
+
+    The index holds the same tables as the queries in contrib/postfix/*.cf and is
+    reloaded whenever PRAGMA data_version shows that the database was changed.
+    """
+
+    TABLES = {
+        'virtual_mailbox_domains': 'export_domains',
+        'virtual_mailbox_maps': 'export_mailboxes',
+        'virtual_alias_maps': 'export_aliases',
+    }
+    # Postfix limits socketmap replies to 100000 bytes, requests are much shorter
+    MAX_REQUEST = 100000
+    # Characters not URL encoded in tcp_table replies
+    TCP_TABLE_SAFE = '@,.+-_=/:'
+    # Dovecot dict protocol escapes
+    DICT_ESCAPES = (('\x01', '\x011'), ('\t', '\x01t'), ('\n', '\x01n'), ('\r', '\x01r'))
+
+    def __init__(self, db, poll_interval=1.0, cache=None, workers=1):
+        self.db = db
+        self.poll_interval = poll_interval
+        self.tables = {}
+        self.passwords = {}
+        self.version = None
+        self.cache = cache or CredentialCache()
+        self.workers = workers
+        self.executor = None
+        # Running password verifications, shared by concurrent logins of a user
+        self.verifying = {}
+
+    def load(self):
+        """
+        Build new index from the database and replace the current one
+        """
+        start = time.monotonic()
+        with self.db.snapshot():
+            tables = {}
+            for name, method in self.TABLES.items():
+                tables[name] = dict(getattr(self.db, method)())
+            # Logins are case insensitive like the lookup tables
+            passwords = dict((email.lower(), password_hash)
+                             for email, password_hash in self.db.export_passwords())
+            # Read inside the snapshot, a commit after it changes the version again
+            version = self.db.data_version()
+        self.tables = tables
+        self.passwords = passwords
+        self.version = version
+        print('Loaded {} domains, {} mailboxes and {} aliases in {:.1f}ms'.format(
+            len(tables['virtual_mailbox_domains']), len(tables['virtual_mailbox_maps']),
+            len(tables['virtual_alias_maps']), (time.monotonic() - start) * 1000), flush=True)
+
+    async def poll(self):
+        """
+        Reload index when database changes, the old index is kept on errors
+        """
+        import asyncio
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            self.reload()
+
+    def reload(self):
+        """
+        Reload index if the database changed since it was loaded
+        """
+        try:
+            if self.db.data_version() != self.version:
+                self.load()
+        except sqlite3.Error as error:
+            print('Failed to reload lookup tables: {}'.format(str(error)), flush=True)
+
+    def lookup(self, table, key):
+        """
+        Return value of key in table or None, raises KeyError for unknown tables
+        """
+        return self.tables[table].get(key.lower())
+
+    def socketmap_reply(self, request):
+        """
+        Return reply to socketmap request string 'name key'
+        """
+        table, _, key = request.partition(' ')
+        try:
+            value = self.lookup(table, key)
+        except KeyError:
+            return 'PERM unknown table {}'.format(table)
+        if value is None:
+            return 'NOTFOUND '
+        return 'OK ' + value
+
+    async def handle_socketmap(self, reader, writer):
+        """
+        Serve netstring encoded socketmap requests of one client connection
+        """
+        import asyncio
+        try:
+            while True:
+                length = (await reader.readuntil(b':'))[:-1]
+                if not length.isdigit() or int(length) > self.MAX_REQUEST:
+                    break
+                data = await reader.readexactly(int(length) + 1)
+                if data[-1:] != b',':
+                    break
+                reply = self.socketmap_reply(data[:-1].decode('utf-8', 'replace'))
+                reply = reply.encode('utf-8')
+                writer.write(b'%d:%s,' % (len(reply), reply))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def tcp_table_reply(self, table, request):
+        """
+        Return reply to tcp_table request line 'get key'
+        """
+        command, _, key = request.partition(' ')
+        if command.lower() != 'get':
+            return '400 unsupported request {}'.format(command)
+        value = self.lookup(table, urllib_parse.unquote(key))
+        if value is None:
+            return '500 not found'
+        return '200 ' + urllib_parse.quote(value, safe=self.TCP_TABLE_SAFE)
+
+    async def handle_tcp_table(self, table, reader, writer):
+        """
+        Serve tcp_table requests for table of one client connection
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.endswith(b'\n'):
+                    break
+                reply = self.tcp_table_reply(table, line.decode('utf-8', 'replace').strip())
+                writer.write(reply.encode('utf-8') + b'\n')
+                await writer.drain()
+        except (ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def verify(self, username, password):
+        """
+        Return True if password of user is valid
+
+        Hashes are verified in worker processes unless the credentials are cached.
+        """
+        import asyncio
+        from concurrent import futures
+        username = username.lower()
+        password_hash = self.passwords.get(username)
+        if password_hash is None:
+            return False
+        if self.cache.check(username, password, password_hash):
+            return True
+        key = (username, self.cache.digest(password), password_hash)
+        future = self.verifying.get(key)
+        if future is None:
+            if self.executor is None:
+                self.executor = futures.ProcessPoolExecutor(self.workers)
+            future = asyncio.get_running_loop().run_in_executor(
+                self.executor, verify_password, password, password_hash)
+            self.verifying[key] = future
+            future.add_done_callback(lambda _: self.verifying.pop(key, None))
+        verified = await asyncio.shield(future)
+        # Do not cache a hash that was replaced while it was being verified
+        if verified and self.passwords.get(username) == password_hash:
+            self.cache.add(username, password, password_hash)
+        return verified
+
+    async def auth_reply(self, request, admin=False):
+        """
+        Return reply to auth request dictionary
+
+        Commands are verify with user and password, user with user and invalidate
+        with a list of users. Invalidate is only accepted from admin connections.
+        """
+        command = request.get('command')
+        if command == 'invalidate':
+            if not admin:
+                return {'result': 'error', 'error': 'invalidate requires a unix socket'}
+            for username in request['users']:
+                self.cache.invalidate(username.lower())
+            # The change was committed before the request was sent
+            self.reload()
+            return {'result': 'ok'}
+        if command == 'user':
+            return {'result': 'ok' if request['user'].lower() in self.passwords else 'fail'}
+        if command == 'verify':
+            if not passlib_enabled():
+                return {'result': 'error', 'error': 'passlib is missing'}
+            verified = await self.verify(request['user'], request['password'])
+            return {'result': 'ok' if verified else 'fail'}
+        return {'result': 'error', 'error': 'unknown command'}
+
+    async def handle_auth(self, reader, writer):
+        """
+        Serve JSON lines auth requests of one client connection
+
+        Only unix socket clients may invalidate cached credentials, access to them
+        is controlled by file permissions.
+        """
+        from concurrent import futures
+        connection = writer.get_extra_info('socket')
+        admin = connection is not None and connection.family == socket.AF_UNIX
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    reply = await self.auth_reply(json.loads(line.decode('utf-8')), admin)
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    reply = {'result': 'error', 'error': 'invalid request'}
+                except futures.BrokenExecutor:
+                    self.executor = None
+                    reply = {'result': 'error', 'error': 'password verification failed'}
+                writer.write(json.dumps(reply).encode('utf-8') + b'\n')
+                await writer.drain()
+        except (ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def dict_reply(self, key):
+        """
+        Return reply to Dovecot dict lookup of shared/passdb/USER or shared/userdb/USER
+        """
+        for prefix, fields in (('shared/passdb/', ('user', 'password')),
+                               ('shared/userdb/', ('user',))):
+            if key.startswith(prefix):
+                username = key[len(prefix):]
+                password_hash = self.passwords.get(username.lower())
+                if password_hash is None:
+                    return 'N'
+                value = json.dumps(dict(zip(fields, (username, password_hash))))
+                for char, escape in self.DICT_ESCAPES:
+                    value = value.replace(char, escape)
+                return 'O' + value
+        return 'N'
+
+    async def handle_dict(self, reader, writer):
+        """
+        Serve Dovecot dict protocol lookups of one client connection
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.endswith(b'\n'):
+                    break
+                line = line.decode('utf-8', 'replace').rstrip('\n')
+                if line.startswith('H'):
+                    # Handshake is not answered
+                    continue
+                if line.startswith('L'):
+                    key = line[1:].split('\t')[0]
+                    for char, escape in reversed(self.DICT_ESCAPES):
+                        key = key.replace(escape, char)
+                    reply = self.dict_reply(key)
+                else:
+                    reply = 'Funsupported command'
+                writer.write(reply.encode('utf-8') + b'\n')
+                await writer.drain()
+        except (ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def parse_address(address):
+        """
+        Return ('unix', path) or ('inet', host, port) for unix:path, inet:host:port
+        or host:port address, raises ValueError for invalid addresses
+        """
+        if address.startswith('unix:'):
+            return ('unix', address[5:])
+        if address.startswith('inet:'):
+            address = address[5:]
+        host, _, port = address.rpartition(':')
+        if not port.isdigit():
+            raise ValueError('invalid address {}'.format(address))
+        return ('inet', host.strip('[]') or None, int(port))
+
+    @staticmethod
+    async def start(address, handler):
+        """
+        Return server listening on address parsed by parse_address()
+        """
+        import asyncio
+        if address[0] == 'unix':
+            # Remove socket left behind by a previous run
+            if os.path.exists(address[1]):
+                os.unlink(address[1])
+            return await asyncio.start_unix_server(handler, address[1])
+        return await asyncio.start_server(handler, address[1], address[2])
+
+    async def serve(self, socketmaps, tcp_tables, auth=(), dicts=()):
+        """
+        Listen on socketmap addresses, (table, address) tcp_table pairs, auth and
+        Dovecot dict addresses until SIGINT or SIGTERM is received
+        """
+        import asyncio
+        servers = []
+        for address in auth:
+            servers.append(await self.start(address, self.handle_auth))
+            print('Serving auth on {}'.format(':'.join(map(str, address))), flush=True)
+        for address in dicts:
+            servers.append(await self.start(address, self.handle_dict))
+            print('Serving Dovecot dict on {}'.format(':'.join(map(str, address))), flush=True)
+        for address in socketmaps:
+            servers.append(await self.start(address, self.handle_socketmap))
+            print('Serving socketmap on {}'.format(':'.join(map(str, address))), flush=True)
+        for table, address in tcp_tables:
+            handler = functools.partial(self.handle_tcp_table, table)
+            servers.append(await self.start(address, handler))
+            print('Serving tcp_table {} on {}'.format(table, ':'.join(map(str, address))),
+                  flush=True)
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        poller = asyncio.ensure_future(self.poll())
+        await stop.wait()
+        poller.cancel()
+        for server in servers:
+            server.close()
+            await server.wait_closed()
+        for address in list(socketmaps) + list(auth) + list(dicts):
+            if address[0] == 'unix' and os.path.exists(address[1]):
+                os.unlink(address[1])
+        if self.executor is not None:
+            self.executor.shutdown()
+        print('Credential cache had {} hits and {} misses'.format(
+            self.cache.hits, self.cache.misses), flush=True)
+
+
+class ReplicationServer(object):
+    """
+    Stream the change log of a primary database to replicas
+
+    A replica sends one JSON line {"log": id, "since": seq} with the change log id
+    and the last change it applied. Replicas following another log, behind pruned
+    changes or ahead of the log get a full copy first: a "full" message, a "row"
+    message per row and a "sync" message. Then changes are sent as written by
+    "mailctl.py changes", each batch followed by a "sync" message with the seq of
+    the last change sent and of the last change in the log. Replicas commit at
+    "sync" messages, which are also sent as heartbeat when there are no changes.
+    """
+
+    # Changes sent per sync message
+    CHUNK_SIZE = 1000
+    # Seconds without changes after which a sync message is sent
+    HEARTBEAT = 10.0
+
+    def __init__(self, db, poll_interval=1.0):
+        self.db = db
+        self.poll_interval = poll_interval
+        # Tasks serving connected replicas, cancelled on shutdown
+        self.tasks = set()
+
+    @staticmethod
+    def message(**values):
+        """
+        Return JSON line of a control message
+        """
+        return (json.dumps(values, separators=(',', ':')) + '\n').encode()
+
+    async def send_full(self, db, writer, log_id):
+        """
+        Send full copy of replicated tables, returns seq of the last change included
+
+        The rows are read from a backup taken in a worker thread, so no read
+        transaction on the database stays open while a slow replica receives them.
+        """
+        import asyncio
+        # Next to the database like other backups, readable by the owner only
+        handle, path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(db.path)),
+                                        prefix='.mailctl-replica-')
+        os.close(handle)
+        dump = None
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, db.backup, path)
+            dump = Database(path, readonly=True)
+            seq = dump.change_range()[1]
+            writer.write(self.message(type='full', log=log_id, seq=seq))
+            for table in dump.REPLICATED_TABLES:
+                cursor = dump.dump_rows(table)
+                while True:
+                    rows = cursor.fetchmany(self.CHUNK_SIZE)
+                    if not rows:
+                        break
+                    writer.write(''.join('{{"type":"row","table":"{}","row":{}}}\n'.format(
+                        table, row) for row, in rows).encode())
+                    # Let other replicas and the socket catch up between chunks
+                    await writer.drain()
+        finally:
+            if dump is not None:
+                dump.conn.close()
+            os.unlink(path)
+        return seq
+
+    async def send_changes(self, db, writer, log_id, since):
+        """
+        Send changes after since and wait for new ones until the replica disconnects
+        """
+        import asyncio
+        while True:
+            first, last = db.change_range()
+            if since < first - 1 or since > last:
+                # Pruned or restored while streaming, the replica reconnects
+                raise ValueError('change log no longer contains seq {}'.format(since))
+            # Read before querying, so no commit goes unnoticed while waiting below
+            version = db.data_version()
+            rows = db.list_replicated_changes(since, self.CHUNK_SIZE).fetchall()
+            if rows:
+                writer.write(''.join(change + '\n' for seq, change in rows).encode())
+                since = rows[-1][0]
+            writer.write(self.message(type='sync', seq=since, last=max(last, since)))
+            await writer.drain()
+            if len(rows) == self.CHUNK_SIZE:
+                continue
+            waited = 0
+            while db.data_version() == version and waited < self.HEARTBEAT:
+                await asyncio.sleep(self.poll_interval)
+                waited += self.poll_interval
+
+    async def handle(self, reader, writer):
+        """
+        Serve one replica on its own database connection
+        """
+        import asyncio
+        peer = writer.get_extra_info('peername') or 'unix socket'
+        db = Database(self.db.path, stats=self.db.stats)
+        self.tasks.add(asyncio.current_task())
+        try:
+            hello = json.loads(await asyncio.wait_for(reader.readline(), self.HEARTBEAT))
+            log, since = hello.get('log'), int(hello.get('since', -1))
+            log_id = db.log_id()
+            first, last = db.change_range()
+            if log != log_id or since < first - 1 or since > last:
+                print('Sending full copy to replica {}'.format(peer), flush=True)
+                since = await self.send_full(db, writer, log_id)
+            else:
+                print('Sending changes after {} to replica {}'.format(since, peer), flush=True)
+                writer.write(self.message(type='changes', log=log_id, seq=since))
+            await self.send_changes(db, writer, log_id, since)
+        except (ValueError, TypeError, AttributeError, asyncio.TimeoutError) as error:
+            print('Closing replica {}: {}'.format(peer, str(error) or 'timeout'), flush=True)
+        except ConnectionError:
+            print('Replica {} disconnected'.format(peer), flush=True)
+        except sqlite3.Error as error:
+            print('Closing replica {}: {}'.format(peer, str(error)), flush=True)
+        except asyncio.CancelledError:
+            # Shutting down
+            pass
+        finally:
+            self.tasks.discard(asyncio.current_task())
+            writer.close()
+            db.conn.close()
+
+    async def serve(self, addresses):
+        """
+        Listen on addresses parsed by LookupServer.parse_address() until SIGINT or
+        SIGTERM is received
+        """
+        import asyncio
+        servers = []
+        for address in addresses:
+            servers.append(await LookupServer.start(address, self.handle))
+            print('Serving replication on {}'.format(':'.join(map(str, address))),
+                  flush=True)
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        await stop.wait()
+        for server in servers:
+            server.close()
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks)
+        for server in servers:
+            await server.wait_closed()
+        for address in addresses:
+            if address[0] == 'unix' and os.path.exists(address[1]):
+                os.unlink(address[1])
+
+
+class ApiServer(object):
+    """
+    Serve domain, user and alias operations as HTTP/JSON endpoints
+
+    Reads run in a pool of threads, each with its own read-only connection.
+    Writes are queued and run as batch commands by a single writer thread, all
+    writes waiting in the queue in one transaction. Each write still succeeds
+    or fails on its own and is answered once the transaction was committed.
+    Neither blocks the event loop accepting and reading requests. Snapshots are
+    taken by a third thread with its own connection, deletions only check that
+    the last one succeeded.
+    """
+
+    # Threads serving reads
+    READERS = 4
+    # Writes committed together at most and queued writes before clients have to wait
+    GROUP_SIZE = 100
+    MAX_QUEUE = 1000
+    # Seconds between snapshots of a changed database
+    SNAPSHOT_INTERVAL = 3600
+    # Largest request body accepted
+    MAX_BODY = 1024 * 1024
+    # Collection names in paths and the batch commands handling them
+    COMMANDS = {'domains': 'domain', 'users': 'user', 'aliases': 'alias'}
+    ALIAS_FILTERS = {'all': None, 'enabled': True, 'disabled': False}
+
+    def __init__(self, mailctl, readers=READERS):
+        self.mailctl = mailctl
+        self.db = mailctl.db
+        self.readers = readers
+        self.executor = None
+        # Single thread running the writes on its own connection
+        self.write_executor = None
+        # Single thread taking snapshots with a copy of mailctl and its own connection
+        self.snapshot_executor = None
+        self.snapshotter = None
+        # Whether the last snapshot succeeded, deletions are refused otherwise
+        self.snapshot_ok = False
+        # Read-only connection of each reader thread
+        self.local = threading.local()
+        self.queue = None
+        # Tasks serving connected clients, cancelled on shutdown
+        self.tasks = set()
+        self.writes = 0
+        self.transactions = 0
+
+    def open_reader(self):
+        """
+        Open the read-only connection of the current reader thread
+        """
+        self.local.db = Database(self.db.path, stats=self.db.stats, readonly=True)
+
+    def open_writer(self):
+        """
+        Open the connection of the writer thread, used by mailctl for all writes
+        """
+        self.mailctl.db = Database(self.db.path, stats=self.db.stats)
+
+    def close_writer(self):
+        """
+        Close the connection of the writer thread and restore the one of mailctl
+        """
+        self.mailctl.db.conn.close()
+        self.mailctl.db = self.db
+
+    def open_snapshots(self):
+        """
+        Open the connection of the snapshot thread
+
+        The thread uses a copy of mailctl, so its output does not end up in the
+        output of a write.
+        """
+        self.snapshotter = copy.copy(self.mailctl)
+        self.snapshotter.db = Database(self.db.path, stats=self.db.stats)
+        self.snapshotter.output = sys.stdout
+
+    def close_snapshots(self):
+        """
+        Close the connection of the snapshot thread
+        """
+        self.snapshotter.db.conn.close()
+        self.snapshotter = None
+
+    def snapshot(self):
+        """
+        Take a snapshot, runs in the snapshot thread
+        """
+        self.snapshot_ok = self.snapshotter.snapshot_database() is not None
+        sys.stdout.flush()
+
+    async def snapshots(self):
+        """
+        Take a snapshot every SNAPSHOT_INTERVAL seconds if there were writes
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        writes = self.writes
+        while True:
+            await asyncio.sleep(self.SNAPSHOT_INTERVAL)
+            # A failed snapshot is retried even without new writes
+            if self.writes != writes or not self.snapshot_ok:
+                writes = self.writes
+                await loop.run_in_executor(self.snapshot_executor, self.snapshot)
+
+    @staticmethod
+    def argument(value):
+        """
+        Return value as command argument, raises ValueError if it is no name
+
+        Values starting with - would be parsed as options of the command.
+        """
+        if not isinstance(value, str) or not value or value.startswith('-'):
+            raise ValueError('invalid value {!r}'.format(value))
+        return value
+
+    @staticmethod
+    def aliases(rows):
+        """
+        Return list of alias dictionaries from (source, destinations) rows
+        """
+        return [{'source': source, 'destinations': destinations.split('\n')}
+                for source, destinations in rows]
+
+    def read(self, parts, query):
+        """
+        Return HTTP status and reply of a GET request, runs in a reader thread
+
+        Replies are dictionaries sent as JSON, or metrics text.
+        """
+        db = self.local.db
+        limit = int(query['limit']) if 'limit' in query else None
+        offset = int(query['offset']) if 'offset' in query else None
+        with db.snapshot():
+            if parts == ['metrics']:
+                return 200, prometheus_metrics(db)
+            if parts == ['health']:
+                return 200, {'status': 'ok', 'schema_version': db.schema_version()}
+            if parts == ['domains']:
+                return 200, {'domains': [name for name, in db.list_domains(limit, offset)]}
+            if parts == ['users']:
+                return 200, {'users': [email for email, in db.list_users(limit, offset)]}
+            if parts == ['aliases']:
+                enabled = self.ALIAS_FILTERS[query.get('filter', 'all')]
+                return 200, {'aliases': self.aliases(
+                    db.list_alias_groups(enabled, limit, offset))}
+            if parts == ['aliases', 'search']:
+                return 200, {'aliases': self.aliases(db.search_alias_groups(
+                    query['pattern'], query.get('mode', 'substring'),
+                    query.get('field', 'source'), limit, offset))}
+            if len(parts) != 2:
+                return 404, {'error': 'unknown endpoint'}
+            name = parts[1]
+            if parts[0] == 'domains':
+                if db.get_domain_id(name) is None:
+                    return 404, {'error': 'domain {} not found'.format(name)}
+                return 200, {'name': name, 'users': sorted(db.list_domain_users(name)),
+                             'aliases': db.list_domain_aliases(name)}
+            if parts[0] == 'users':
+                if not db.user_exists(name):
+                    return 404, {'error': 'user {} not found'.format(name)}
+                return 200, {'email': name,
+                             'aliases': sorted(db.list_aliases_for_destination(name))}
+            if parts[0] == 'aliases':
+                aliases = self.aliases(db.search_alias_groups(name, 'exact'))
+                if not aliases:
+                    return 404, {'error': 'alias {} not found'.format(name)}
+                return 200, aliases[0]
+        return 404, {'error': 'unknown endpoint'}
+
+    def write_command(self, method, parts, body):
+        """
+        Return batch command words of a POST or DELETE request, None if unknown
+
+        Raises ValueError, KeyError or TypeError for invalid request bodies.
+        """
+        if method == 'POST' and parts == ['domains']:
+            return ['domain', 'add', self.argument(body['name'])]
+        if method == 'POST' and parts == ['users']:
+            return ['user', 'add', self.argument(body['email'])]
+        if method == 'POST' and parts == ['aliases']:
+            return ['alias', 'add', '--alias=' + self.argument(body['source']),
+                    '--user=' + self.argument(body['destination']),
+                    '--comment=' + str(body.get('description') or '')]
+        if method == 'POST' and parts[:1] == ['users'] and parts[2:] == ['password']:
+            return ['user', 'password', self.argument(parts[1])]
+        if method == 'POST' and parts[:1] == ['aliases'] and len(parts) == 3 and \
+                parts[2] in ('enable', 'disable'):
+            return ['alias', parts[2], self.argument(parts[1])]
+        if method == 'DELETE' and len(parts) == 2 and parts[0] in self.COMMANDS:
+            return [self.COMMANDS[parts[0]], 'delete', self.argument(parts[1])]
+        return None
+
+    async def respond(self, method, target, body):
+        """
+        Return HTTP status and reply of a request
+        """
+        import asyncio
+        url = urllib_parse.urlsplit(target)
+        parts = [urllib_parse.unquote(part) for part in url.path.split('/') if part]
+        try:
+            if method == 'GET':
+                return await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.read, parts, dict(urllib_parse.parse_qsl(url.query)))
+            words = self.write_command(method, parts, json.loads(body or b'{}'))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return 400, {'error': 'invalid request'}
+        except sqlite3.Error as error:
+            return 500, {'error': str(error)}
+        if words is None:
+            return 404, {'error': 'unknown endpoint'}
+        if method == 'DELETE' and self.mailctl.auto_snapshot and not self.snapshot_ok:
+            return 503, {'error': 'not making destructive changes without a snapshot'}
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((words, future))
+        code, output = await future
+        return 200 if code == 0 else 422, {'status': 'error' if code else 'ok',
+                                           'exit_code': code,
+                                           'output': output.splitlines()}
+
+    def write(self, commands):
+        """
+        Run lists of batch command words in one transaction, runs in the writer thread
+
+        Returns list of exit code and output of each command.
+        """
+        return self.mailctl.run_commands(commands)
+
+    async def writer(self):
+        """
+        Run queued writes in groups, committing each group in one transaction
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            group = [await self.queue.get()]
+            # Let clients with requests already received queue them as well
+            await asyncio.sleep(0)
+            while len(group) < self.GROUP_SIZE and not self.queue.empty():
+                group.append(self.queue.get_nowait())
+            results = await loop.run_in_executor(
+                self.write_executor, self.write, [words for words, future in group])
+            self.writes += len(group)
+            self.transactions += 1
+            for (words, future), result in zip(group, results):
+                if not future.done():
+                    future.set_result(result)
+
+    @staticmethod
+    async def read_request(reader):
+        """
+        Return method, target, HTTP version, headers and body of a request
+
+        Returns None when the client closed the connection, raises ValueError
+        for malformed requests.
+        """
+        line = await reader.readline()
+        if not line.endswith(b'\n'):
+            return None
+        words = line.decode('latin-1').split()
+        if len(words) != 3:
+            raise ValueError('malformed request line')
+        method, target, version = words
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line.endswith(b'\n'):
+                return None
+            if not line.strip():
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if 'transfer-encoding' in headers:
+            raise ValueError('chunked requests are not supported')
+        length = int(headers.get('content-length', 0))
+        if not 0 <= length <= ApiServer.MAX_BODY:
+            raise ValueError('invalid content length {}'.format(length))
+        body = await reader.readexactly(length)
+        return method, target, version, headers, body
+
+    async def handle(self, reader, writer):
+        """
+        Serve HTTP/1.1 requests of one client connection
+        """
+        import asyncio
+        self.tasks.add(asyncio.current_task())
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request = await self.read_request(reader)
+                except ValueError as error:
+                    request = None
+                    status, reply = 400, {'error': str(error)}
+                    keep_alive = False
+                else:
+                    if request is None:
+                        break
+                    method, target, version, headers, body = request
+                    status, reply = await self.respond(method, target, body)
+                    keep_alive = version == 'HTTP/1.1' and \
+                        headers.get('connection', '').lower() != 'close'
+                if isinstance(reply, str):
+                    # Metrics in Prometheus text format
+                    data, content_type = reply.encode('utf-8'), 'text/plain; version=0.0.4'
+                else:
+                    data = (json.dumps(reply) + '\n').encode('utf-8')
+                    content_type = 'application/json'
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\n'
+                             'Content-Length: {}\r\n{}\r\n'.format(
+                                 status, http.HTTPStatus(status).phrase, content_type,
+                                 len(data), '' if keep_alive else 'Connection: close\r\n')
+                             .encode('latin-1') + data)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # Shutting down
+            pass
+        finally:
+            self.tasks.discard(asyncio.current_task())
+            writer.close()
+
+    async def serve(self, addresses):
+        """
+        Listen on addresses parsed by LookupServer.parse_address() until SIGINT or
+        SIGTERM is received
+        """
+        import asyncio
+        from concurrent import futures
+        self.queue = asyncio.Queue(self.MAX_QUEUE)
+        self.executor = futures.ThreadPoolExecutor(self.readers, initializer=self.open_reader)
+        self.write_executor = futures.ThreadPoolExecutor(1, initializer=self.open_writer)
+        snapshots = None
+        if self.mailctl.auto_snapshot:
+            # Snapshots are taken here instead of by the deleting commands
+            self.mailctl.snapshot_taken = True
+            self.snapshot_executor = futures.ThreadPoolExecutor(
+                1, initializer=self.open_snapshots)
+            await asyncio.get_running_loop().run_in_executor(self.snapshot_executor,
+                                                             self.snapshot)
+            snapshots = asyncio.ensure_future(self.snapshots())
+        servers = []
+        for address in addresses:
+            servers.append(await LookupServer.start(address, self.handle))
+            print('Serving API on {}'.format(':'.join(map(str, address))), flush=True)
+
+        writer = asyncio.ensure_future(self.writer())
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        await stop.wait()
+        for server in servers:
+            server.close()
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks)
+        writer.cancel()
+        await asyncio.gather(writer, return_exceptions=True)
+        # Let the writer thread finish the group it is running before closing
+        self.write_executor.submit(self.close_writer)
+        self.write_executor.shutdown()
+        for server in servers:
+            await server.wait_closed()
+        for address in addresses:
+            if address[0] == 'unix' and os.path.exists(address[1]):
+                os.unlink(address[1])
+        self.executor.shutdown()
+        if snapshots is not None:
+            snapshots.cancel()
+            await asyncio.gather(snapshots, return_exceptions=True)
+            self.snapshot_executor.submit(self.close_snapshots)
+            self.snapshot_executor.shutdown()
+        print('Committed {} writes in {} transactions'.format(
+            self.writes, self.transactions), flush=True)
+
+
+class CommandParser(argparse.ArgumentParser):
+    """
+    Argument parser writing help, usage and errors to the output of a command
+    """
+
+    def __init__(self, *args, output=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.output = output
+
+    def add_subparsers(self, **kwargs):
+        kwargs.setdefault('parser_class', functools.partial(CommandParser, output=self.output))
+        return super().add_subparsers(**kwargs)
+
+    def _print_message(self, message, file=None):
+        super()._print_message(message, self.output or file)
+
+
+class MailCtl(object):
+    """
+    Script main class
+    """
+
+    DB = 'mail.sqlite'
+    CONFIG = '/etc/mail/mailctl.conf'
+    # Commands whose handler method is not named like the command
+    COMMAND_METHODS = {
+        'import': 'import_',
+        'db': 'database',
+    }
+    # Commands that do not use the database
+    COMMANDS_WITHOUT_DATABASE = ('checkpassword',)
+    # Commands that can run in a batch, import commits on its own
+    BATCH_COMMANDS = ('domain', 'user', 'alias', 'db', 'export')
+    # Subcommands that need the database outside of a transaction
+    BATCH_EXCLUDED = ('db maintain', 'db restore')
+    # Subcommands taking a snapshot, batches take it before their transaction
+    BATCH_DESTRUCTIVE = ('domain delete', 'user delete', 'alias delete')
+    BATCH_TRANSACTIONS = ('command', 'all')
+    IMPORT_CHUNK_SIZE = 10000
+    IMPORT_FIELDS = ('type', 'name', 'destination', 'description')
+    SYNC_FORMATS = ('yaml', 'json')
+    # Postfix virtual_alias_expansion_limit default
+    ALIAS_MAX_FANOUT = 1000
+    # Aliases listed before confirming a bulk change
+    BULK_PREVIEW = 20
+    # Seconds between checks for new changes with changes --follow
+    CHANGES_POLL_INTERVAL = 1.0
+    # Seconds to wait before reconnecting to the primary
+    REPLICATION_RETRY = 5.0
+    # Snapshots are kept in this directory next to the database unless configured
+    SNAPSHOT_DIR = 'snapshots'
+    SNAPSHOT_KEEP = 10
+    OUTPUT_FORMATS = ('text', 'json', 'jsonl', 'csv', 'tsv')
+    EXPORT_FORMATS = ('texthash', 'cdb', 'passwd-file')
+    SOCKETMAP_ADDRESS = 'inet:127.0.0.1:9998'
+    API_ADDRESS = 'inet:127.0.0.1:9996'
+    # Hosts the API and the replication server listen on, they have no authentication
+    API_HOSTS = ('127.0.0.1', '::1', 'localhost')
+    AUTH_SOCKET = 'unix:/run/mailctl/auth.sock'
+    AUTH_CACHE_SIZE = 10000
+    AUTH_CACHE_TTL = 300
+    PASSWORD_ROUNDS = 5000
+    PASSWORD_MIN_ROUNDS = 1000
+    PASSWORD_MAX_ROUNDS = 999999999
+
+    def __init__(self, argv=None, db=None):
+        """
+        Parse argv, default sys.argv, and run the command
+
+        db is an open Database to run the command on instead of the configured one.
+        """
+        init_time = time.perf_counter()
+        # Command output, batches and the API give each command its own stream
+        self.output = sys.stdout
+        # Password hashing settings, can be overridden by configuration and command line
+        self.password_rounds = self.PASSWORD_ROUNDS
+        self.auth_socket = self.AUTH_SOCKET
+        # Answer to confirmation prompts, None asks on the terminal
+        self.assume_yes = None
+        # Users whose cached credentials are dropped once the batch commits
+        self.pending_invalidations = []
+        # Snapshot settings, one snapshot is taken before the first destructive change
+        self.snapshot_dir = None
+        self.snapshot_keep = self.SNAPSHOT_KEEP
+        self.snapshot_compress = False
+        self.auto_snapshot = True
+        self.snapshot_taken = False
+        # Days changes are kept in the change log by db maintain, None keeps all
+        self.changes_retention = None
+        try:
+            self.hash_workers = len(os.sched_getaffinity(0))
+        except AttributeError:
+            self.hash_workers = os.cpu_count() or 1
+
+        # Create top level parser
+        parser = argparse.ArgumentParser(
+            description='Postfix database management tool',
+            usage='''mailctl.py [<options>] <command> [<args>]
+
+The most commonly used commands are:
+   user     manage users
+   alias    mange aliases
+   domain   manage domains
+   import   bulk import domains, users and aliases
+   db       manage database schema, backups and snapshots
+   export   compile lookup tables for Postfix and Dovecot
+   serve    answer Postfix lookups and Dovecot logins from memory
+   checkpassword  Dovecot checkpassword helper using the serve auth socket
+   batch    run many commands on one connection
+   sync     make the database match a YAML or JSON description
+   changes  stream the change log as JSON lines
+   replicate  serve the change log to replicas, or follow a primary
+   api      serve domain, user and alias operations as HTTP/JSON on localhost
+   stats    show users and aliases per domain, or write Prometheus metrics
+''')
+        parser.add_argument('-c', '--config',
+                            help='configuration file (default: {})'.format(self.CONFIG))
+        parser.add_argument('--db', help='database file (default: {})'.format(self.DB))
+        parser.add_argument('--journal-mode',
+                            help='SQLite journal mode, wal lets readers and writers '
+                                 'work concurrently',
+                            choices=Database.JOURNAL_MODES)
+        parser.add_argument('--synchronous',
+                            help='SQLite synchronous mode',
+                            choices=Database.SYNCHRONOUS_MODES)
+        parser.add_argument('--busy-timeout',
+                            help='milliseconds to wait for a locked database',
+                            type=int)
+        parser.add_argument('--cache-size',
+                            help='SQLite page cache size, in pages or negative KiB',
+                            type=int)
+        parser.add_argument('--mmap-size',
+                            help='bytes of the database file to memory map',
+                            type=int)
+        parser.add_argument('--no-snapshot',
+                            help='do not take a snapshot before destructive changes',
+                            action='store_true')
+        parser.add_argument('--stats',
+                            help='report time and rows of all SQL statements on stderr '
+                                 'at exit',
+                            action='store_true')
+        parser.add_argument('--trace',
+                            help='append every SQL statement with its time and rows to '
+                                 'this file as JSON line')
+        parser.add_argument('--slow-query-ms',
+                            help='capture query plan of statements taking at least this '
+                                 'many milliseconds (default: {})'.format(QueryStats.SLOW_MS),
+                            type=float, default=QueryStats.SLOW_MS)
+        parser.add_argument('--profile-startup',
+                            help='report time spent on imports, configuration and '
+                                 'connecting to the database on stderr',
+                            action='store_true')
+        parser.add_argument('--stdin',
+                            help='run commands read from stdin and print their output, '
+                                 'options after it are batch options',
+                            action='store_true')
+        parser.add_argument('command', help='Subcommand to run')
+        # Everything after the command is parsed by the command handler
+        parser.add_argument('args', help=argparse.SUPPRESS, nargs=argparse.REMAINDER)
+        argv = list(sys.argv[1:] if argv is None else argv)
+        if '--stdin' in argv:
+            # Shorthand for the batch command with text results
+            position = argv.index('--stdin')
+            argv[position:position + 1] = ['batch', '--results', 'text']
+        args = parser.parse_args(argv)
+        self.argv = args.args
+        args.command = self.COMMAND_METHODS.get(args.command, args.command)
+        if not hasattr(self, args.command):
+            self.print('Unrecognized command')
+            parser.print_help()
+            sys.exit(1)
+
+        settings = self._load_config(args.config)
+        for setting in ('db', 'journal_mode', 'synchronous', 'busy_timeout',
+                        'cache_size', 'mmap_size'):
+            if getattr(args, setting) is not None:
+                settings[setting] = getattr(args, setting)
+        db_file = settings.pop('db', self.DB)
+        if args.no_snapshot:
+            self.auto_snapshot = False
+        if self.snapshot_dir is None:
+            self.snapshot_dir = os.path.join(os.path.dirname(os.path.abspath(db_file)),
+                                             self.SNAPSHOT_DIR)
+        config_time = time.perf_counter()
+
+        # Setup database connection
+        if db is not None:
+            self.db = db
+        elif args.command in self.COMMANDS_WITHOUT_DATABASE:
+            self.db = None
+        elif not os.path.isfile(db_file):
+            self.print('Database file {} is not a file.'.format(db_file))
+            sys.exit(1)
+        else:
+            try:
+                self.db = Database(db_file, **settings)
+            except (sqlite3.OperationalError, ValueError) as error:
+                self.print('Failed to open database file {}: {}'.format(db_file, str(error)))
+                sys.exit(1)
+        if args.profile_startup:
+            connect_time = time.perf_counter()
+            sys.stderr.write('Startup: imports {:.1f}ms, configuration {:.1f}ms, '
+                             'database connection {:.1f}ms\n'.format(
+                                 (init_time - START_TIME) * 1000,
+                                 (config_time - init_time) * 1000,
+                                 (connect_time - config_time) * 1000))
+
+        stats = None
+        if (args.stats or args.trace) and self.db is not None:
+            try:
+                trace = open(args.trace, 'a', buffering=1) if args.trace else None
+            except IOError as error:
+                self.print('Failed to open trace file {}: {}'.format(args.trace, str(error)))
+                sys.exit(1)
+            stats = self.db.stats = QueryStats(args.slow_query_ms, trace)
+
+        # use dispatch pattern to invoke method with same name
+        try:
+            getattr(self, args.command)()
+        except BrokenPipeError:
+            # Output was piped into a program that stopped reading, e.g. head
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            sys.exit(1)
+        except sqlite3.OperationalError as error:
+            # Callers passing an open database handle a locked database themselves
+            if not Database.is_busy(error) or db is not None:
+                raise
+            self.print('Database file {} is locked, please try again later.'.format(db_file))
+            sys.exit(1)
+        finally:
+            # Also reported when the command fails with sys.exit()
+            if stats is not None:
+                self.db.stats = None
+                if args.stats:
+                    stats.summary(sys.stderr)
+                if stats.trace is not None:
+                    stats.trace.close()
+
+    def _load_config(self, filename):
+        """
+        Load settings from configuration file
+
+        The [database] section may set path, journal_mode, synchronous, busy_timeout,
+        cache_size and mmap_size, the [passwords] section may set rounds, the
+        [serve] section auth_socket, the [backup] section directory, keep,
+        compress and auto_snapshot and the [changes] section retention_days.
+        Returns dictionary of database settings.
+        """
+        if filename is None:
+            if not os.path.isfile(self.CONFIG):
+                return {}
+            filename = self.CONFIG
+        config = configparser.ConfigParser()
+        try:
+            with open(filename) as config_file:
+                config.read_file(config_file)
+        except (IOError, configparser.Error) as error:
+            self.print('Failed to read configuration file {}: {}'.format(filename, str(error)))
+            sys.exit(1)
+
+        settings = {}
+        try:
+            if config.has_section('database'):
+                section = config['database']
+                for setting in ('journal_mode', 'synchronous'):
+                    if setting in section:
+                        settings[setting] = section[setting]
+                for setting in ('busy_timeout', 'cache_size', 'mmap_size'):
+                    if setting in section:
+                        settings[setting] = section.getint(setting)
+                if 'path' in section:
+                    settings['db'] = section['path']
+            if config.has_section('passwords') and 'rounds' in config['passwords']:
+                self.password_rounds = config['passwords'].getint('rounds')
+            if config.has_section('serve') and 'auth_socket' in config['serve']:
+                self.auth_socket = config['serve']['auth_socket']
+            if config.has_section('backup'):
+                section = config['backup']
+                self.snapshot_dir = section.get('directory', self.snapshot_dir)
+                self.snapshot_keep = section.getint('keep', self.snapshot_keep)
+                self.snapshot_compress = section.getboolean('compress', self.snapshot_compress)
+                self.auto_snapshot = section.getboolean('auto_snapshot', self.auto_snapshot)
+            if config.has_section('changes') and 'retention_days' in config['changes']:
+                self.changes_retention = config['changes'].getfloat('retention_days')
+                if self.changes_retention <= 0:
+                    raise ValueError('retention_days must be positive')
+        except ValueError as error:
+            self.print('Invalid setting in configuration file {}: {}'.format(filename, str(error)))
+            sys.exit(1)
+        return settings
+
+    def _invalidate_credentials(self, usernames):
+        """
+        Tell a running serve daemon to forget cached credentials of users
+
+        Does nothing if no daemon is listening on the auth socket. Inside a batch
+        the daemon is told after the changes were committed.
+        """
+        if self.db is not None and self.db.conn.in_transaction:
+            self.pending_invalidations.extend(usernames)
+            return
+        try:
+            address = LookupServer.parse_address(self.auth_socket)
+            if address[0] == 'unix':
+                connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                connection.settimeout(1)
+                connection.connect(address[1])
+            else:
+                connection = socket.create_connection(address[1:], timeout=1)
+            with connection:
+                request = {'command': 'invalidate', 'users': list(usernames)}
+                connection.sendall(json.dumps(request).encode('utf-8') + b'\n')
+                connection.recv(1024)
+        except (OSError, ValueError):
+            pass
+
+    def print(self, *values, **kwargs):
+        """
+        Print values to the output of the running command
+        """
+        kwargs.setdefault('file', self.output)
+        print(*values, **kwargs)
+
+    def _command_parser(self, **kwargs):
+        """
+        Return argument parser of a command handler writing to its output
+        """
+        return CommandParser(output=self.output, **kwargs)
+
+    def _confirm(self, prompt):
+        """
+        Return True if the user entered YES at prompt
+
+        If assume_yes is set it answers the prompt instead.
+        """
+        if self.assume_yes is not None:
+            self.print(prompt + ('YES' if self.assume_yes else 'NO'))
+            return self.assume_yes
+        try:
+            return input(prompt) == 'YES'
+        except EOFError:
+            self.print()
+            return False
+
+    def _hash_password(self, password):
+        """
+        Return SHA512-CRYPT password hash of a given password.
+
+        Requires the passlib module to work
+        """
+        if passlib_enabled():
+            return hash_password(password, self.password_rounds)
+        else:
+            return False
+
+    def _hash_passwords(self, usernames):
+        """
+        Generate and hash new passwords for a list of users
+
+        Hashing is spread across a pool of worker processes. Returns list of
+        tuples of username, password and password hash.
+        """
+        from concurrent import futures
+        jobs = [(username, self._generate_password(), self.password_rounds)
+                for username in usernames]
+        workers = max(min(self.hash_workers, len(jobs)), 1)
+        start = time.time()
+        if workers == 1:
+            results = [_hash_password_job(job) for job in jobs]
+        else:
+            with futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_hash_password_job, jobs,
+                                        chunksize=max(len(jobs) // (workers * 4), 1)))
+        elapsed = max(time.time() - start, 1e-6)
+        self.print('Hashed {} passwords with {} rounds in {:.2f}s using {} workers '
+                   '({:.1f} hashes/s per worker)'.format(
+                       len(jobs), self.password_rounds, elapsed, workers,
+                       len(jobs) / elapsed / workers))
+        return results
+
+    def _generate_password(self):
+        """
+        Return random 12 character password.
+
+        Consecutive characters are always taken from different character sets.
+        """
+        charsets = [
+            'abcdefghijklmnopqrstuvwxyz',
+            'ABCDEFGHIJKLMNOPQRSTUVWXYZ',
+            '0123456789',
+            '^!%&/()=?{[]}+~#-_.:,;<>',]
+        password_characters = []
+        charset = random.choice(charsets)
+        while len(password_characters) < 12:
+            password_characters.append(random.choice(charset))
+            charset = random.choice(list(set(charsets) - set([charset])))
+        return "".join(password_characters)
+
+    def _write_rows(self, rows, fields, fileformat, text_format):
+        """
+        Stream rows to stdout in the given output format
+
+        List values become JSON arrays, or comma separated values in CSV and TSV.
+        text_format is a function formatting a row for text output.
+        """
+        if fileformat == 'text':
+            for row in rows:
+                self.print(text_format(row))
+        elif fileformat in ('csv', 'tsv'):
+            writer = csv.writer(self.output, lineterminator='\n',
+                                delimiter=',' if fileformat == 'csv' else '\t')
+            writer.writerow(fields)
+            for row in rows:
+                writer.writerow([','.join(value) if isinstance(value, list) else value
+                                 for value in row])
+        elif fileformat == 'jsonl':
+            for row in rows:
+                self.print(json.dumps(dict(zip(fields, row))))
+        elif fileformat == 'json':
+            separator = '['
+            for row in rows:
+                self.print(separator)
+                self.print(json.dumps(dict(zip(fields, row))), end='')
+                separator = ','
+            self.print('[]' if separator == '[' else '\n]')
+
+    def _write_aliases(self, result, fileformat):
+        """
+        Stream (source, destinations) rows of aliases to stdout
+        """
+        rows = ((source, destinations.split('\n')) for source, destinations in result)
+        self._write_rows(rows, ('source', 'destinations'), fileformat,
+                         lambda row: '{} -> {}'.format(row[0], ', '.join(row[1])))
+
+    def show_domains(self, fileformat='text', limit=None, offset=None):
+        """
+        Show database domains
+        """
+        self._write_rows(self.db.list_domains(limit, offset), ('name',), fileformat,
+                         lambda row: row[0])
+
+    def add_domain(self, domainname):
+        """
+        Addd domain to database
+        """
+
+        with self.db.transaction():
+            # Check if domain already exists before we add it twice
+            if self.db.get_domain_id(domainname) is not None:
+                self.print('Domain {} already exists!'.format(domainname))
+                return False
+
+            # Add domain to database
+            domain_id = self.db.add_domain(domainname)
+        if domain_id:
+            self.print('Added domain {}'.format(domainname))
+            return True
+        else:
+            self.print('Failed to add domain {}'.format(domainname))
+            return False
+
+    def delete_domain(self, domainname):
+        """
+        Delete domain including all users and aliases from database
+        """
+
+        # Check if domain to be deleted exists in database
+        if self.db.get_domain_id(domainname) is None:
+            self.print('Domain {} not found!'.format(domainname))
+            return False
+
+        # Get list of users of this domain
+        users = self.db.list_domain_users(domainname)
+        if users:
+            self.print('Domain {} is home of these users. They will be deleted!'
+                       .format(domainname))
+            for user in sorted(users):
+                self.print(user)
+        else:
+            self.print("Domain {} has no users".format(domainname))
+
+        # Get list of aliases of this domain
+        aliases = self.db.list_domain_aliases(domainname)
+        if aliases:
+            self.print('Domain {} is home of these aliases. They will be deleted!'
+                       .format(domainname))
+            for alias in aliases:
+                self.print(alias)
+        else:
+            self.print("Domain {} has no aliases".format(domainname))
+
+        if not self._confirm('\nEnter YES to remove domain {} including '\
+                             'all aliases and users: '.format(domainname)):
+            self.print('Aborting')
+            # Declining on the terminal is not an error, running without --yes is
+            return self.assume_yes is None
+        if not self._auto_snapshot():
+            return False
+
+        # Delete aliases, users and the domain in a single transaction
+        messages = []
+        try:
+            with self.db.transaction():
+                # Delete virtual aliases from this domain
+                if aliases:
+                    if not self.db.delete_domain_aliases(domainname):
+                        raise Rollback("Failed to delete virtual aliases from " + domainname)
+                    messages.append("Deleted virtual aliases from " + domainname)
+
+                # Delete users from this domain
+                if users:
+                    if not self.db.delete_domain_users(domainname):
+                        raise Rollback("Failed to delete users from " + domainname)
+                    messages.append("Deleted users from " + domainname)
+
+                # Delete the domain itself
+                if not self.db.delete_domain(domainname):
+                    raise Rollback('Failed to delete domain {} '.format(domainname))
+        except Rollback as error:
+            self.print(str(error))
+            return False
+        if users:
+            self._invalidate_credentials(users)
+        for message in messages:
+            self.print(message)
+        self.print('Deleted domain {}'.format(domainname))
+        return True
+
+    def delete_domains(self, names):
+        """
+        Delete domains including all their users and aliases with one confirmation
+
+        All domains are deleted in a single transaction.
+        """
+        targets = self.db.collect_domain_targets(names)
+        found = set(name for name, users, aliases in targets)
+        missing = [name for name in names if name not in found]
+        for name in missing:
+            self.print('Domain {} not found!'.format(name))
+        if not targets:
+            return False
+        for name, users, aliases in targets:
+            self.print('{} with {} users and {} aliases'.format(name, users, aliases))
+        if not self._confirm('\nEnter YES to remove these {} domains including {} users and '
+                             '{} aliases: '.format(len(targets),
+                                                   sum(row[1] for row in targets),
+                                                   sum(row[2] for row in targets))):
+            self.print('Aborting')
+            # Declining on the terminal is not an error, running without --yes is
+            return self.assume_yes is None
+        if not self._auto_snapshot():
+            return False
+
+        with self.db.transaction():
+            users = self.db.list_domain_target_users()
+            domains, user_count, alias_count = self.db.delete_domain_targets()
+        self._invalidate_credentials(users)
+        self.print('Deleted {} domains with {} users and {} aliases'.format(
+            domains, user_count, alias_count))
+        return not missing
+
+    def show_stats(self, fileformat='text', limit=None, offset=None):
+        """
+        Show numbers of users, aliases and alias destinations of domains
+        """
+        fields = ('domain', 'users', 'aliases', 'destinations', 'disabled')
+        line = '{:<40} {:>9} {:>9} {:>12} {:>9}'
+        with self.db.snapshot():
+            if fileformat == 'text':
+                self.print(line.format(*fields))
+            self._write_rows(self.db.domain_stats(limit, offset), fields, fileformat,
+                             lambda row: line.format(*row))
+            if fileformat == 'text':
+                totals = self.db.stats_totals()
+                self.print(line.format('{} domains'.format(totals[0]),
+                                       *(int(total) for total in totals[1:])))
+
+    def write_metrics(self, path):
+        """
+        Write domain statistics in Prometheus text format to path, - for stdout
+        """
+        metrics = prometheus_metrics(self.db)
+        if path == '-':
+            self.output.write(metrics)
+            return True
+        try:
+            # Collectors never read a partially written file
+            self._write_atomically(path, lambda stream: stream.write(metrics.encode('utf-8')),
+                                   0o644)
+        except (IOError, OSError) as error:
+            self.print('Failed to write metrics to {}: {}'.format(path, str(error)))
+            return False
+        return True
+
+    def show_users(self, fileformat='text', limit=None, offset=None):
+        """
+        Show database users
+        """
+        self._write_rows(self.db.list_users(limit, offset), ('email',), fileformat,
+                         lambda row: row[0])
+
+    def add_user(self, username):
+        """
+        Add user to database
+        """
+
+        # Adding users requires passlib to create the password hash to be stored in database.abs
+        if not passlib_enabled():
+            self.print("Adding users is not enabled because the passlib module is missing.")
+            return False
+
+        try:
+            domain = username.split('@')[1]
+        except IndexError:
+            self.print('Invalid user name syntax. Needs to be user@domain.tld.')
+            return False
+
+        # Create SHA512-Crypt password hash for this user before taking the write lock
+        password = self._generate_password()
+        password_hash = self._hash_password(password)
+
+        # Check and add in one transaction, so no other writer can add the user in between
+        with self.db.transaction():
+            # Check if user already exists before we add them twice
+            if self.db.user_exists(username):
+                self.print('User {} already exists!'.format(username))
+                return False
+            # Get id of virtual domain this user belongs to
+            domain_id = self.db.get_domain_id(domain)
+            if domain_id is None:
+                self.print('Domain {} is not handled by this system. Aborting.'.format(domain))
+                return False
+            added = self.db.add_users([(domain_id, password_hash, username)])
+
+        if added:
+            self.print('Added user {} with password {}'.format(username, password))
+            return True
+        else:
+            self.print('Failed to add user {}'.format(username))
+            return False
+
+    def change_password(self, username):
+        """
+        Generate new user password
+        """
+
+        # Adding users requires passlib to create the password hash to be stored in database.abs
+        if not passlib_enabled():
+            self.print("Pasword update is not enabled because the passlib module is missing.")
+            return False
+
+        # Create SHA512-Crypt password hash for this user before taking the write lock
+        password = self._generate_password()
+        password_hash = self._hash_password(password)
+
+        # Check and update in one transaction, so the user cannot be deleted in between
+        with self.db.transaction():
+            if not self.db.user_exists(username):
+                self.print('User {} does not exist!'.format(username))
+                return False
+            changed = self.db.set_passwords([(password_hash, username)])
+
+        if changed:
+            self._invalidate_credentials([username])
+            self.print('Changed {} password to {}'.format(username, password))
+            return True
+        else:
+            self.print('Failed to change {} password'.format(username))
+            return False
+
+    def add_users(self, usernames):
+        """
+        Add many users to database
+
+        Passwords are hashed in parallel and all users are written in a single transaction.
+        """
+
+        # Adding users requires passlib to create the password hash to be stored in database
+        if not passlib_enabled():
+            self.print("Adding users is not enabled because the passlib module is missing.")
+            return False
+
+        domains = self.db.domain_ids()
+        users = self.db.user_emails()
+        new_users = []
+        failures = 0
+        for username in usernames:
+            domain = username.split('@')[-1]
+            if username in users:
+                self.print('User {} already exists!'.format(username))
+                failures += 1
+            elif '@' not in username:
+                self.print('Invalid user name syntax for {}. Needs to be user@domain.tld.'
+                           .format(username))
+                failures += 1
+            elif domain not in domains:
+                self.print('Domain {} of user {} is not handled by this system.'
+                           .format(domain, username))
+                failures += 1
+            else:
+                new_users.append(username)
+                users.add(username)
+        if not new_users:
+            return failures == 0
+
+        results = self._hash_passwords(new_users)
+        try:
+            with self.db.transaction():
+                self.db.add_users([(domains[username.split('@')[-1]], password_hash, username)
+                                   for username, password, password_hash in results])
+        except sqlite3.Error as error:
+            self.print('Failed to add users: {}'.format(str(error)))
+            return False
+        for username, password, password_hash in results:
+            self.print('Added user {} with password {}'.format(username, password))
+        return failures == 0
+
+    def change_passwords(self, usernames):
+        """
+        Generate new passwords for many users
+
+        Passwords are hashed in parallel and all users are updated in a single transaction.
+        """
+
+        # Password updates require passlib to create the password hash to be stored in database
+        if not passlib_enabled():
+            self.print("Pasword update is not enabled because the passlib module is missing.")
+            return False
+
+        users = self.db.user_emails()
+        known_users = []
+        failures = 0
+        for username in usernames:
+            if username not in users:
+                self.print('User {} does not exist!'.format(username))
+                failures += 1
+            elif username not in known_users:
+                known_users.append(username)
+        if not known_users:
+            return failures == 0
+
+        results = self._hash_passwords(known_users)
+        try:
+            with self.db.transaction():
+                self.db.set_passwords([(password_hash, username)
+                                       for username, password, password_hash in results])
+        except sqlite3.Error as error:
+            self.print('Failed to change passwords: {}'.format(str(error)))
+            return False
+        self._invalidate_credentials(known_users)
+        for username, password, password_hash in results:
+            self.print('Changed {} password to {}'.format(username, password))
+        return failures == 0
+
+    def delete_user(self, username):
+        """
+        Delete user from database
+        """
+
+        # Check if user to be deleted exists in database
+        if not self.db.user_exists(username):
+            self.print('User {} does not exist!'.format(username))
+            return False
+
+        # Get list of aliases pointing to this user
+        aliases = self.db.list_aliases_for_destination(username)
+        if aliases:
+            self.print('User {} is configured destination for these virtual aliases.'
+                       .format(username))
+            self.print('They will be deleted along with the user!')
+            for alias in sorted(aliases):
+                self.print(alias)
+            prompt = 'Enter YES to confirm deletion of user {} and all of its aliases: '\
+                     .format(username)
+        else:
+            self.print('No virtual aliases configured for user {}'.format(username))
+            prompt = 'Enter YES to confirm deletion of user {}: '.format(username)
+        if not self._confirm(prompt):
+            self.print('Aborting')
+            # Declining on the terminal is not an error, running without --yes is
+            return self.assume_yes is None
+        if not self._auto_snapshot():
+            return False
+
+        # Delete aliases and user in a single transaction
+        messages = []
+        try:
+            with self.db.transaction():
+                # Delete virtual aliases for this user
+                if aliases:
+                    if not self.db.delete_aliases_for_destination(username):
+                        raise Rollback("Failed to delete virtual aliases for " + username)
+                    messages.append("Deleted virtual aliases for " + username)
+
+                # Delete user
+                if not self.db.delete_user(username):
+                    raise Rollback('Failed to delete user {} '.format(username))
+        except Rollback as error:
+            self.print(str(error))
+            return False
+        self._invalidate_credentials([username])
+        for message in messages:
+            self.print(message)
+        self.print('Deleted user {}'.format(username))
+        return True
+
+    def show_aliases(self, searchterm, fileformat='text', limit=None, offset=None):
+        """
+        Show configured aliases
+        """
+        if searchterm == 'all':
+            enabled = None
+        elif searchterm == 'enabled':
+            enabled = True
+        elif searchterm == 'disabled':
+            enabled = False
+        else:
+            self.print('Invalid filter: ' + searchterm)
+            return False
+        self._write_aliases(self.db.list_alias_groups(enabled, limit=limit, offset=offset),
+                            fileformat)
+        return True
+
+    def search_aliases(self, pattern, fileformat='text', limit=None, offset=None,
+                       mode='substring', field='source'):
+        """
+        Search configured aliases
+        """
+        self._write_aliases(self.db.search_alias_groups(pattern, mode, field, limit, offset),
+                            fileformat)
+        return True
+
+    def _alias_graph(self):
+        """
+        Return AliasGraph of all enabled aliases
+        """
+        with self.db.snapshot():
+            return AliasGraph(self.db.list_aliases(enabled=True), self.db.user_emails(),
+                              self.db.domain_ids())
+
+    def _write_expansions(self, graph, addresses, fileformat, max_fanout, problems_only):
+        """
+        Stream expansions of addresses to stdout, returns number of problems
+
+        Cycles, dead end recipients and more recipients than max_fanout are problems.
+        """
+        counts = {'problems': 0}
+
+        def rows():
+            for address in addresses:
+                recipients, cycle = graph.expand(address)
+                dead_ends = sorted(recipient for recipient in recipients
+                                   if graph.kind(recipient) == 'dead end')
+                problem = bool(cycle or dead_ends or len(recipients) > max_fanout)
+                counts['problems'] += problem
+                if problem or not problems_only:
+                    yield (address, sorted(recipients), len(recipients),
+                           list(cycle or []), dead_ends)
+
+        def text(row):
+            line = '{} -> {} ({} recipients)'.format(row[0], ', '.join(row[1]), row[2])
+            if row[2] > max_fanout:
+                line += ' exceeds {} recipients'.format(max_fanout)
+            if row[3]:
+                line += ' cycle: ' + ', '.join(row[3])
+            if row[4]:
+                line += ' dead ends: ' + ', '.join(row[4])
+            return line
+
+        self._write_rows(rows(), ('address', 'recipients', 'fanout', 'cycle', 'dead_ends'),
+                         fileformat, text)
+        return counts['problems']
+
+    def resolve_aliases(self, addresses, fileformat='text', max_fanout=ALIAS_MAX_FANOUT):
+        """
+        Show final recipients of addresses, returns False if one has problems
+        """
+        graph = self._alias_graph()
+        return not self._write_expansions(graph, addresses, fileformat, max_fanout, False)
+
+    def audit_aliases(self, fileformat='text', max_fanout=ALIAS_MAX_FANOUT,
+                      problems_only=False):
+        """
+        Show final recipients of all enabled aliases, returns False on problems
+        """
+        graph = self._alias_graph()
+        problems = self._write_expansions(graph, sorted(graph.edges), fileformat,
+                                          max_fanout, problems_only)
+        if fileformat == 'text':
+            self.print('Audited {} aliases, {} with problems'.format(len(graph.edges), problems))
+        return not problems
+
+    def disable_alias(self, alias):
+        """
+        Disable virtual alias
+        """
+
+        with self.db.transaction():
+            if not self.db.alias_exists(alias, enabled=True):
+                self.print('No enabled alias {}!'.format(alias))
+                return False
+            rowcount = self.db.set_alias_enabled(alias, False)
+        if rowcount:
+            self.print("Disabled virtual alias " + alias)
+            return True
+        else:
+            self.print("Failed to disable virtual alias " + alias)
+            return False
+
+    def enable_alias(self, alias):
+        """
+        Enable virtual alias
+        """
+
+        with self.db.transaction():
+            if not self.db.alias_exists(alias, enabled=False):
+                self.print('No disabled alias {}!'.format(alias))
+                return False
+            rowcount = self.db.set_alias_enabled(alias, True)
+        if rowcount:
+            self.print('Enabled virtual alias ' + alias)
+            return True
+        else:
+            self.print('Failed to enable virtual alias ' + alias)
+            return False
+
+    def change_aliases(self, action, aliases=(), domains=(), patterns=()):
+        """
+        Enable, disable or delete aliases selected by source, domain or pattern
+
+        The selected aliases are shown and changed with one statement in a single
+        transaction after one confirmation.
+        """
+        # Aliases that would not change are left out of the preview
+        enabled = {'enable': False, 'disable': True, 'delete': None}[action]
+        self.db.collect_alias_targets(aliases, domains, patterns)
+        collected = set(source for source, in self.db.list_alias_targets())
+        missing = [alias for alias in aliases if alias not in collected]
+        for alias in missing:
+            self.print('Alias {} does not exist!'.format(alias))
+        sources, rows = self.db.count_alias_targets(enabled)
+        if not sources:
+            self.print('No aliases to {}'.format(action))
+            return False
+        for source, in self.db.list_alias_targets(enabled, self.BULK_PREVIEW):
+            self.print(source)
+        if sources > self.BULK_PREVIEW:
+            self.print('... and {} more'.format(sources - self.BULK_PREVIEW))
+        if not self._confirm('\nEnter YES to {} these {} aliases with {} destinations: '
+                             .format(action, sources, rows)):
+            self.print('Aborting')
+            # Declining on the terminal is not an error, running without --yes is
+            return self.assume_yes is None
+        if action == 'delete' and not self._auto_snapshot():
+            return False
+
+        with self.db.transaction():
+            if action == 'delete':
+                changed = self.db.delete_alias_targets()
+            else:
+                changed = self.db.set_alias_targets_enabled(action == 'enable')
+        self.print('{}d {} alias destinations'.format(action.capitalize(), changed))
+        return not missing
+
+    def add_alias(self, alias, user, description):
+        """
+        Add virtual alias
+        """
+
+        with self.db.transaction():
+            if self.db.alias_exists(alias, user):
+                self.print('Alias {} -> {} already exists!'.format(alias, user))
+                return False
+            alias_domain = alias.split("@")[-1]
+            # Check sanity of desired alias record
+            if not self.db.user_exists(user):
+                self.print("Invalid user " + user)
+                return False
+            domain_id = self.db.get_domain_id(alias_domain)
+            if domain_id is None:
+                self.print('{} is not a domain managed by this server!'.format(alias_domain))
+                return False
+            # Finally add alias
+            alias_id = self.db.add_alias(alias, user, description, domain_id)
+        if alias_id:
+            self.print('Added virtual alias {} -> {} '.format(alias, user))
+            return True
+        else:
+            self.print('Failed to add virtual alias {} -> {} '.format(alias, user))
+            return False
+
+    def delete_alias(self, alias):
+        """
+        Delete virtual alias from database
+        """
+
+        with self.db.transaction():
+            if not self.db.alias_exists(alias):
+                self.print('Alias {} does not exist!'.format(alias))
+                return False
+            rowcount = self.db.delete_alias(alias)
+        if rowcount:
+            self.print("Deleted virtual alias " + alias)
+            return True
+        else:
+            self.print("Failed to delete virtual alias " + alias)
+            return False
+
+    def _write_atomically(self, path, write, mode):
+        """
+        Write file through a temporary file renamed to path when complete
+
+        write is called with the temporary file opened in binary mode. An existing
+        file with identical content is left untouched, otherwise its permissions are
+        kept. Returns True if the file was replaced.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, temp_path = tempfile.mkstemp(dir=directory,
+                                             prefix='.{}.'.format(os.path.basename(path)))
+        try:
+            with os.fdopen(handle, 'w+b') as stream:
+                write(stream)
+                stream.flush()
+                os.fsync(stream.fileno())
+            if os.path.isfile(path):
+                if filecmp.cmp(path, temp_path, shallow=False):
+                    os.unlink(temp_path)
+                    return False
+                stat = os.stat(path)
+                mode = stat.st_mode & 0o7777
+                try:
+                    os.chown(temp_path, stat.st_uid, stat.st_gid)
+                except OSError:
+                    pass
+            os.chmod(temp_path, mode)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        return True
+
+    def export_tables(self, directory, formats, postmap=None):
+        """
+        Compile lookup tables into files for Postfix and Dovecot
+
+        Writes virtual_mailbox_domains, virtual_mailbox_maps and virtual_alias_maps
+        as texthash/postmap input and CDB files, and the users as Dovecot passwd-file.
+        Files are only replaced if their content changed. postmap is a Postfix table
+        type like hash to run postmap on changed texthash files.
+        """
+        tables = [
+            ('virtual_mailbox_domains', self.db.export_domains),
+            ('virtual_mailbox_maps', self.db.export_mailboxes),
+            ('virtual_alias_maps', self.db.export_aliases),
+        ]
+        outputs = []
+        for name, rows in tables:
+            if 'texthash' in formats:
+                outputs.append((name, rows, self._write_texthash, 0o644))
+            if 'cdb' in formats:
+                outputs.append((name + '.cdb', rows, self._write_cdb, 0o644))
+        if 'passwd-file' in formats:
+            # Contains password hashes, not world readable
+            outputs.append(('dovecot-passwd', self.db.export_passwords,
+                            self._write_passwd_file, 0o640))
+
+        success = True
+        # Read all tables from the same state of the database
+        with self.db.snapshot():
+            for filename, rows, writer, mode in outputs:
+                path = os.path.join(directory, filename)
+                entries = []
+                try:
+                    updated = self._write_atomically(
+                        path, lambda stream: entries.append(writer(stream, rows())), mode)
+                except (IOError, OSError) as error:
+                    self.print('Failed to write {}: {}'.format(path, str(error)))
+                    success = False
+                    continue
+                if not updated:
+                    self.print('{} is up to date'.format(path))
+                    continue
+                self.print('Updated {} ({} entries)'.format(path, entries[0]))
+                if postmap and writer == self._write_texthash:
+                    if subprocess.call(['postmap', '{}:{}'.format(postmap, path)]) != 0:
+                        self.print('Failed to run postmap on {}'.format(path))
+                        success = False
+        return success
+
+    def _write_texthash(self, stream, rows):
+        """
+        Write (key, value) rows as Postfix texthash table, returns number of rows
+        """
+        count = 0
+        for key, value in rows:
+            stream.write('{} {}\n'.format(key, value).encode('utf-8'))
+            count += 1
+        return count
+
+    def _write_cdb(self, stream, rows):
+        """
+        Write (key, value) rows as CDB table, returns number of rows
+        """
+        count = 0
+        writer = CdbWriter(stream)
+        for key, value in rows:
+            writer.add(key.encode('utf-8'), value.encode('utf-8'))
+            count += 1
+        writer.finish()
+        return count
+
+    def _write_passwd_file(self, stream, rows):
+        """
+        Write (email, password) rows as Dovecot passwd-file, returns number of rows
+        """
+        count = 0
+        for email, password in rows:
+            stream.write('{}:{}\n'.format(email, password).encode('utf-8'))
+            count += 1
+        return count
+
+    def serve_lookups(self, socketmaps, tcp_tables, poll_interval, auth=(), dicts=(),
+                      cache_size=AUTH_CACHE_SIZE, cache_ttl=AUTH_CACHE_TTL):
+        """
+        Run lookup daemon on socketmap addresses, (table, address) tcp_table pairs,
+        auth and Dovecot dict addresses
+        """
+        import asyncio
+        server = LookupServer(self.db, poll_interval, CredentialCache(cache_size, cache_ttl),
+                              self.hash_workers)
+        server.load()
+        try:
+            asyncio.run(server.serve(socketmaps, tcp_tables, auth, dicts))
+        except OSError as error:
+            self.print('Failed to start lookup server: {}'.format(str(error)))
+            return False
+        return True
+
+    def check_password(self, reply, stream):
+        """
+        Verify credentials read from stream with the serve auth socket
+
+        Implements the checkpassword interface: stream holds user name and password
+        terminated by NUL bytes. On success reply is executed, otherwise returns exit
+        code 1 for invalid credentials or 111 for temporary failures.
+        """
+        data = b''
+        while len(data) < 512:
+            chunk = stream.read(512 - len(data))
+            if not chunk:
+                break
+            data += chunk
+        fields = data.split(b'\0')
+        if len(fields) < 2:
+            return 111
+        username = fields[0].decode('utf-8', 'replace')
+        password = fields[1].decode('utf-8', 'replace')
+        # Dovecot sets AUTHORIZED=1 for userdb lookups without password
+        if os.environ.get('AUTHORIZED') == '1':
+            request = {'command': 'user', 'user': username}
+        else:
+            request = {'command': 'verify', 'user': username, 'password': password}
+
+        try:
+            address = LookupServer.parse_address(self.auth_socket)
+            if address[0] == 'unix':
+                connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                connection.connect(address[1])
+            else:
+                connection = socket.create_connection(address[1:])
+            with connection:
+                connection.sendall(json.dumps(request).encode('utf-8') + b'\n')
+                result = json.loads(connection.makefile('rb').readline().decode('utf-8'))
+        except (OSError, ValueError) as error:
+            sys.stderr.write('Failed to query auth socket {}: {}\n'.format(
+                self.auth_socket, str(error)))
+            return 111
+        if result.get('result') == 'fail':
+            return 1
+        if result.get('result') != 'ok':
+            sys.stderr.write('Auth failed: {}\n'.format(result.get('error')))
+            return 111
+
+        os.environ['USER'] = username
+        if os.environ.get('AUTHORIZED') == '1':
+            os.environ['AUTHORIZED'] = '2'
+        os.execvp(reply[0], reply)
+
+    def run_command(self, words, output=None):
+        """
+        Run batch command given as list of words, returns exit code
+
+        Statements of a failed command are rolled back. Output of the command is
+        written to output, default stdout.
+        """
+        previous = self.output
+        self.output = output or previous
+        try:
+            if not self.db.conn.in_transaction:
+                self._snapshot_batch([words])
+            return self._run_command(words)
+        finally:
+            self.output = previous
+
+    def _run_command(self, words):
+        """
+        Run batch command in a transaction or savepoint, returns exit code
+        """
+        if not words or words[0] not in self.BATCH_COMMANDS:
+            self.print('Unrecognized command {}'.format(words[0] if words else ''))
+            return 1
+        if ' '.join(words[:2]) in self.BATCH_EXCLUDED:
+            self.print('{} cannot run in a batch, it needs the database outside of a transaction.'
+                       .format(' '.join(words[:2])))
+            return 1
+        self.argv = words[1:]
+        code = 0
+        try:
+            with self.db.transaction():
+                try:
+                    getattr(self, self.COMMAND_METHODS.get(words[0], words[0]))()
+                except SystemExit as error:
+                    # Handlers and argparse exit on errors
+                    code = error.code if isinstance(error.code, int) else 1
+                if code:
+                    raise Rollback()
+        except Rollback:
+            pass
+        except sqlite3.Error as error:
+            self.print('Database error: {}'.format(str(error)))
+            code = 1
+        return code
+
+    def run_commands(self, commands):
+        """
+        Run lists of batch command words in one transaction
+
+        Each command is rolled back on its own if it fails. Returns list of exit
+        code and output of each command, all fail if the commit fails. Like other
+        commands, a snapshot is taken before destructive changes unless one was
+        already taken.
+        """
+        results = []
+        self._snapshot_batch(commands)
+        try:
+            with self.db.transaction():
+                for words in commands:
+                    output = io.StringIO()
+                    code = self.run_command(words, output)
+                    results.append((code, output.getvalue()))
+        except sqlite3.Error as error:
+            del self.pending_invalidations[:]
+            return [(1, 'Failed to commit: {}\n'.format(str(error)))] * len(commands)
+        if self.pending_invalidations:
+            self._invalidate_credentials(self.pending_invalidations)
+            del self.pending_invalidations[:]
+        return results
+
+    def run_batch(self, stream, transaction='command', results='jsonl'):
+        """
+        Run commands read line by line from stream on the open database
+
+        With transaction command each command is committed on its own, with all
+        the batch stops at the first failed command and nothing is committed.
+        Results are written as JSON lines or, for text, as the plain command output.
+        Empty lines and lines starting with # are skipped.
+        """
+        stdout = self.output
+        counts = {'commands': 0, 'failed': 0}
+
+        def report(line_num, line, code, output):
+            counts['commands'] += 1
+            if code:
+                counts['failed'] += 1
+            if results == 'jsonl':
+                stdout.write(json.dumps({'line': line_num, 'command': line,
+                                         'status': 'error' if code else 'ok',
+                                         'exit_code': code,
+                                         'output': output.splitlines()}) + '\n')
+            else:
+                stdout.write(output)
+                if code:
+                    stdout.write('Line {}: {} failed\n'.format(line_num, line))
+
+        def run(lines):
+            for line_num, line in enumerate(lines, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                output = io.StringIO()
+                try:
+                    code = self.run_command(shlex.split(line), output)
+                except ValueError as error:
+                    self.print('Invalid command line: {}'.format(str(error)), file=output)
+                    code = 1
+                report(line_num, line, code, output.getvalue())
+                if code and transaction == 'all':
+                    raise Rollback()
+                if not self.db.conn.in_transaction and self.pending_invalidations:
+                    self._invalidate_credentials(self.pending_invalidations)
+                    del self.pending_invalidations[:]
+
+        committed = True
+        try:
+            if transaction == 'all':
+                # Read ahead to take the snapshot before the transaction
+                lines = list(stream)
+                self._snapshot_batch(line.split() for line in lines)
+                with self.db.transaction():
+                    run(lines)
+            else:
+                run(stream)
+        except Rollback:
+            committed = False
+        if self.pending_invalidations:
+            if committed:
+                self._invalidate_credentials(self.pending_invalidations)
+            del self.pending_invalidations[:]
+
+        summary = 'Ran {} commands, {} failed{}'.format(
+            counts['commands'], counts['failed'],
+            '' if committed else ', all changes rolled back')
+        if results == 'jsonl':
+            counts['committed'] = committed
+            stdout.write(json.dumps({'summary': summary, **counts}) + '\n')
+        else:
+            stdout.write(summary + '\n')
+        return counts['failed'] == 0
+
+    def _write_checksum(self, path):
+        """
+        Write SHA-256 checksum of file to path.sha256 in sha256sum format
+        """
+        with open(path + '.sha256', 'w') as manifest:
+            manifest.write('{}  {}\n'.format(self._checksum(path), os.path.basename(path)))
+
+    def _checksum(self, path):
+        """
+        Return hex SHA-256 digest of file
+        """
+        digest = hashlib.sha256()
+        with open(path, 'rb') as stream:
+            for block in iter(lambda: stream.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def backup_database(self, path, compress=False):
+        """
+        Write online backup of the database to path with checksum manifest
+
+        The backup is written to a temporary file renamed to path when complete.
+        With compress the file is gzip compressed. Returns True on success.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        start = time.monotonic()
+        # Created readable by the owner only, the database contains password hashes
+        handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.mailctl-backup-')
+        os.close(handle)
+        try:
+            pages = self.db.backup(temp_path)
+            if compress:
+                handle = os.open(temp_path + '.gz', os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                                 0o600)
+                with open(temp_path, 'rb') as source, \
+                        gzip.open(os.fdopen(handle, 'wb'), 'wb') as target:
+                    shutil.copyfileobj(source, target, 1024 * 1024)
+                os.replace(temp_path + '.gz', temp_path)
+            os.replace(temp_path, path)
+            self._write_checksum(path)
+        except (IOError, OSError, sqlite3.Error) as error:
+            for leftover in (temp_path, temp_path + '.gz'):
+                if os.path.exists(leftover):
+                    os.unlink(leftover)
+            self.print('Failed to back up database to {}: {}'.format(path, str(error)))
+            return False
+        self.print('Backed up {} pages to {} in {:.2f}s'.format(pages, path,
+                                                               time.monotonic() - start))
+        return True
+
+    def snapshot_database(self, compress=None, keep=None):
+        """
+        Back up the database into the snapshot directory and prune old snapshots
+
+        Returns path of the snapshot or None on failure.
+        """
+        compress = self.snapshot_compress if compress is None else compress
+        keep = self.snapshot_keep if keep is None else keep
+        prefix = os.path.splitext(os.path.basename(self.db.path))[0] + '-'
+        suffix = '.sqlite.gz' if compress else '.sqlite'
+        try:
+            os.makedirs(self.snapshot_dir, mode=0o700, exist_ok=True)
+        except OSError as error:
+            self.print('Failed to create snapshot directory {}: {}'.format(self.snapshot_dir,
+                                                                           str(error)))
+            return None
+        name = prefix + time.strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(self.snapshot_dir, name + suffix)
+        counter = 1
+        while os.path.exists(path):
+            counter += 1
+            path = os.path.join(self.snapshot_dir, '{}-{}{}'.format(name, counter, suffix))
+        if not self.backup_database(path, compress):
+            return None
+
+        # Only snapshots of this database, ordered by time and counter
+        pattern = re.compile(re.escape(prefix) + r'(\d{8}-\d{6})(?:-(\d+))?\.sqlite(?:\.gz)?$')
+        snapshots = []
+        for name in os.listdir(self.snapshot_dir):
+            match = pattern.match(name)
+            if match:
+                snapshots.append((time.strptime(match.group(1), '%Y%m%d-%H%M%S'),
+                                  int(match.group(2) or 1), name))
+        snapshots.sort()
+        for _, _, name in snapshots[:max(len(snapshots) - keep, 0)]:
+            for filename in (name, name + '.sha256'):
+                try:
+                    os.unlink(os.path.join(self.snapshot_dir, filename))
+                except FileNotFoundError:
+                    pass
+            self.print('Removed old snapshot {}'.format(os.path.join(self.snapshot_dir, name)))
+        return path
+
+    def _auto_snapshot(self):
+        """
+        Take a snapshot before the first destructive change of this run
+
+        Returns False if the snapshot failed and the change should not be made.
+        Inside a transaction it fails instead of holding the write lock during
+        the backup, batches take it before with _snapshot_batch().
+        """
+        if not self.auto_snapshot or self.snapshot_taken:
+            return True
+        if self.db.conn.in_transaction or self.snapshot_database() is None:
+            self.print('Not making destructive changes without a snapshot, '
+                       'use --no-snapshot to skip it.')
+            return False
+        self.snapshot_taken = True
+        return True
+
+    def _snapshot_batch(self, commands):
+        """
+        Take the snapshot before the transaction of batch command words if one
+        of them is destructive, a failure is reported by the command itself
+        """
+        if any(' '.join(words[:2]) in self.BATCH_DESTRUCTIVE for words in commands):
+            self._auto_snapshot()
+
+    def restore_database(self, path):
+        """
+        Replace database content with a backup after verifying it
+
+        A checksum manifest next to the backup is verified if present, gzip
+        compressed backups are detected by their .gz extension.
+        """
+        if self.db.conn.in_transaction:
+            self.print('Cannot restore a database inside a transaction.')
+            return False
+        if not os.path.isfile(path):
+            self.print('Backup file {} does not exist.'.format(path))
+            return False
+        if os.path.isfile(path + '.sha256'):
+            with open(path + '.sha256') as manifest:
+                expected = manifest.read().split()[0]
+            if self._checksum(path) != expected:
+                self.print('Checksum of {} does not match its manifest.'.format(path))
+                return False
+        else:
+            self.print('No checksum manifest for {}, skipping verification.'.format(path))
+
+        temp_path = None
+        try:
+            if path.endswith('.gz'):
+                handle, temp_path = tempfile.mkstemp(prefix='.mailctl-restore-')
+                with gzip.open(path, 'rb') as source, os.fdopen(handle, 'wb') as target:
+                    shutil.copyfileobj(source, target, 1024 * 1024)
+            source_path = temp_path or path
+            result = self.db.check_file(source_path)
+            if result != 'ok':
+                self.print('Backup file {} is damaged: {}'.format(path, result))
+                return False
+            if not self._confirm('Enter YES to replace all data in {} with {}: '.format(
+                    self.db.path, path)):
+                self.print('Aborting')
+                return self.assume_yes is None
+            if not self._auto_snapshot():
+                return False
+            self.db.restore(source_path)
+            # Replicas may be ahead of the restored change log
+            self.db.reset_log_id()
+        except (IOError, OSError, sqlite3.Error) as error:
+            self.print('Failed to restore {}: {}'.format(path, str(error)))
+            return False
+        finally:
+            if temp_path is not None:
+                os.unlink(temp_path)
+        # Cached logins may no longer be valid
+        self._invalidate_credentials(self.db.user_emails())
+        self.print('Restored database from {}'.format(path))
+        return True
+
+    def stream_changes(self, since, limit=None, follow=False,
+                       interval=CHANGES_POLL_INTERVAL, stream=None):
+        """
+        Write changes after seq since as JSON lines, oldest first
+
+        Fails if changes after since have been pruned, the reader then has to
+        start over from a full copy. With follow, waits for new changes until
+        limit changes have been written or the process is interrupted.
+        """
+        stream = stream or self.output
+        if not self.db.has_table('mailctl_changes'):
+            self.print('The change log requires schema migration 3, run "mailctl.py db migrate".',
+                       file=sys.stderr)
+            return False
+        while True:
+            first, last = self.db.change_range()
+            if since < first - 1:
+                self.print('Changes {} to {} have been pruned, start over from a full copy.'
+                           .format(since + 1, first - 1), file=sys.stderr)
+                return False
+            # Read before querying, so no commit goes unnoticed while waiting below
+            version = self.db.data_version()
+            count = 0
+            for seq, change in self.db.list_changes(since, limit):
+                stream.write(change + '\n')
+                since = seq
+                count += 1
+            if limit is not None:
+                limit -= count
+            if not follow or limit == 0:
+                return True
+            stream.flush()
+            while self.db.data_version() == version:
+                time.sleep(interval)
+
+    def _read_message(self, stream):
+        """
+        Return next JSON message from the primary, raises ConnectionError at end
+        """
+        line = stream.readline()
+        if not line.endswith(b'\n'):
+            raise ConnectionError('connection closed by primary')
+        return json.loads(line)
+
+    def _copy_full(self, stream):
+        """
+        Replace replicated tables with rows sent by the primary
 
-    def show_users(self):
+        Returns the message following the rows, runs in the open transaction.
         """
-        Show database users
+        start = time.monotonic()
+        counts = collections.Counter()
+        self.db.clear_replicated()
+        with self.db.bulk_alias_insert():
+            table, rows = None, []
+            while True:
+                message = self._read_message(stream)
+                if message.get('type') != 'row' or message['table'] != table or \
+                        len(rows) >= self.IMPORT_CHUNK_SIZE:
+                    if rows:
+                        counts[table] += self.db.upsert_rows(table, rows)
+                    table, rows = message.get('table'), []
+                if message.get('type') != 'row':
+                    break
+                rows.append(message['row'])
+        self.print('Copied {} domains, {} users and {} aliases in {:.1f}s'.format(
+            counts['virtual_domains'], counts['virtual_users'], counts['virtual_aliases'],
+            time.monotonic() - start), flush=True)
+        return message
+
+    def _replicate(self, address, once):
         """
-        db_query = 'SELECT email FROM virtual_users'
-        result = self.db.query(db_query)
-        for row in result:
-            print(row[0])
+        Follow the primary at address parsed by LookupServer.parse_address()
 
-    def add_user(self, username):
+        Returns when caught up with once, raises OSError or ValueError on
+        connection and protocol errors.
         """
-        Add user to database
+        if address[0] == 'unix':
+            connection = socket.socket(socket.AF_UNIX)
+            connection.settimeout(3 * ReplicationServer.HEARTBEAT)
+            connection.connect(address[1])
+        else:
+            connection = socket.create_connection(address[1:],
+                                                  3 * ReplicationServer.HEARTBEAT)
+        with connection, connection.makefile('rb') as stream:
+            state = self.db.replication_state()
+            since = int(state.get('primary_seq', -1))
+            connection.sendall(ReplicationServer.message(log=state.get('primary_log'),
+                                                         since=since))
+            message = self._read_message(stream)
+            log = message['log']
+            try:
+                if message['type'] == 'full':
+                    self.db.begin()
+                    message = self._copy_full(stream)
+                    since = -1
+                else:
+                    self.print('Following changes after {}'.format(since), flush=True)
+                    message = self._read_message(stream)
+                applied = 0
+                while True:
+                    if message.get('type') == 'sync':
+                        # Heartbeats without changes do not need a write
+                        if self.db.conn.in_transaction or message['seq'] != since:
+                            self.db.begin()
+                            self.db.set_replication_state(primary_log=log,
+                                                          primary_seq=message['seq'])
+                            self.db.commit()
+                            since = message['seq']
+                        if applied:
+                            self.print('Applied {} changes up to {}'.format(applied, since),
+                                       flush=True)
+                            applied = 0
+                        if once and since >= message['last']:
+                            return
+                    elif 'operation' in message:
+                        # Changes already applied are skipped, so resending is harmless
+                        if message['seq'] > since:
+                            self.db.begin()
+                            if message['operation'] == 'delete':
+                                self.db.delete_rows(message['table'], (message['id'],))
+                            elif message['row'] is not None:
+                                # Users deleted since are removed by a later change
+                                self.db.upsert_rows(message['table'], (message['row'],))
+                            applied += 1
+                    else:
+                        raise ValueError('unexpected message {}'.format(message))
+                    message = self._read_message(stream)
+            finally:
+                if self.db.conn.in_transaction:
+                    self.db.rollback()
+
+    def replicate_from(self, address, once=False, retry_interval=REPLICATION_RETRY):
         """
+        Apply changes of the primary at address until interrupted
 
-        # Adding users requires passlib to create the password hash to be stored in database.abs
-        if not PASSLIB_ENABLED:
-            print("Adding users is not enabled because the passlib module is missing.")
+        Reconnects after errors. With once, returns after catching up and fails
+        on errors instead.
+        """
+        if not self.db.has_table('mailctl_replication'):
+            self.print('Replication requires schema migration 4, run "mailctl.py db migrate".')
             return False
+        while True:
+            try:
+                self._replicate(address, once)
+                if once:
+                    return True
+            except sqlite3.IntegrityError as error:
+                # The local tables were changed, start over with a full copy
+                self.print('Replica does not match primary: {}'.format(str(error)), flush=True)
+                self.db.set_replication_state(primary_log='', primary_seq=-1)
+            except (OSError, ValueError, KeyError, TypeError) as error:
+                self.print('Replication from {} failed: {}'.format(
+                    ':'.join(map(str, address)), str(error) or type(error).__name__),
+                    flush=True)
+            except KeyboardInterrupt:
+                return True
+            if once:
+                return False
+            time.sleep(retry_interval)
 
-        # Check if user already exists before we add them twice
-        db_query = "SELECT email FROM virtual_users WHERE email = '{}'".format(username)
-        result = self.db.query(db_query)
-        if result.fetchone():
-            print('User {} already exists!'.format(username))
+    def serve_replication(self, addresses, poll_interval):
+        """
+        Stream the change log to replicas connecting to addresses
+        """
+        import asyncio
+        if not self.db.has_table('mailctl_replication'):
+            self.print('Replication requires schema migration 4, run "mailctl.py db migrate".')
             return False
-        # Get id of virtual domain this user belongs to
+        server = ReplicationServer(self.db, poll_interval)
         try:
-            domain = username.split('@')[1]
-        except IndexError:
-            print('Invalid user name syntax. Needs to be user@domain.tld.')
+            asyncio.run(server.serve(addresses))
+        except OSError as error:
+            self.print('Failed to start replication server: {}'.format(str(error)))
             return False
-        db_query = "SELECT id FROM virtual_domains WHERE name = '{}'".format(domain)
-        result = self.db.query(db_query)
+        return True
+
+    def serve_api(self, addresses, readers):
+        """
+        Serve the HTTP/JSON API on addresses
+        """
+        import asyncio
+        # Deletions are confirmed by sending a DELETE request
+        self.assume_yes = True
+        server = ApiServer(self, readers)
         try:
-            domain_id = result.fetchone()[0]
-        except TypeError:
-            print('Domain {} is not handled by this system. Aborting.'.format(domain))
+            asyncio.run(server.serve(addresses))
+        except OSError as error:
+            self.print('Failed to start API server: {}'.format(str(error)))
             return False
+        return True
 
-        # Create SHA512-Crypt password hash for this user
-        charsets = [
-            'abcdefghijklmnopqrstuvwxyz',
-            'ABCDEFGHIJKLMNOPQRSTUVWXYZ',
-            '0123456789',
-            '^!%&/()=?{[]}+~#-_.:,;<>',]
-        password_characters = []
-        charset = choice(charsets)
-        while len(password_characters) < 12:
-            password_characters.append(choice(charset))
-            charset = choice(list(set(charsets) - set([charset])))
-        password = "".join(password_characters)
-        password_hash = self._hash_password(password)
-
-        # Add user to database
-        db_query = "INSERT INTO virtual_users "\
-                   "(domain_id, password, email) VALUES ("\
-                   "'{domain_id}', '{password}', '{user}')"\
-                   .format(
-                       user=username,
-                       password=password_hash,
-                       domain_id=domain_id)
-        result = self.db.query(db_query)
-        if result.rowcount:
-            print('Added user {} with password {}'.format(username, password))
-            return True
-        else:
-            print('Failed to add user {}'.format(username))
+    def migrate_database(self):
+        """
+        Apply pending schema migrations
+        """
+        version = self.db.schema_version()
+        latest = len(self.db.MIGRATIONS)
+        if version > latest:
+            self.print('Database schema version {} is newer than this tool supports ({})!'
+                       .format(version, latest))
             return False
+        if version == latest:
+            self.print('Database schema is up to date (version {})'.format(version))
+            return True
+        for migration in range(version + 1, latest + 1):
+            description = self.db.MIGRATIONS[migration - 1][0]
+            try:
+                changes = self.db.migrate(migration)
+            except sqlite3.Error as error:
+                self.print('Failed to apply schema migration {} ({}): {}'.format(
+                    migration, description, str(error)))
+                return False
+            self.print('Applied schema migration {} ({}), {} rows changed'.format(
+                migration, description, changes))
+        return True
 
-    def change_password(self, username):
-        """
-        Generate new user password
+    def maintain_database(self, quick=False, analysis_limit=None, max_pages=None,
+                          full_vacuum=False):
         """
+        Check database, update planner statistics, release free pages and report sizes
 
-        # Adding users requires passlib to create the password hash to be stored in database.abs
-        if not PASSLIB_ENABLED:
-            print("Pasword update is not enabled because the passlib module is missing.")
+        Nothing is changed if a check fails. Without full_vacuum, all steps
+        only take short locks and can run while the database is in use.
+        """
+        if self.db.conn.in_transaction:
+            self.print('Cannot maintain a database inside a transaction.')
             return False
+        if analysis_limit is None:
+            analysis_limit = self.db.ANALYSIS_LIMIT
+        try:
+            start = time.monotonic()
+            problems = self.db.integrity_check(quick)
+            if problems != ['ok']:
+                self.print('{} found {} problems:'.format(
+                    'Quick check' if quick else 'Integrity check', len(problems)))
+                for problem in problems[:self.BULK_PREVIEW]:
+                    self.print('  {}'.format(problem))
+                return False
+            violations = self.db.foreign_key_check()
+            if violations:
+                self.print('Foreign key check found {} rows without referenced row:'.format(
+                    len(violations)))
+                for table, rowid, parent in violations[:self.BULK_PREVIEW]:
+                    self.print('  {} row {} references missing {}'.format(table, rowid, parent))
+                return False
+            self.print('{} and foreign key check passed in {:.2f}s'.format(
+                'Quick check' if quick else 'Integrity check', time.monotonic() - start))
 
-        # Check if user exists
-        db_query = "SELECT email FROM virtual_users WHERE email = '{}'".format(username)
-        result = self.db.query(db_query)
-        if not result.fetchone():
-            print('User {} does not exist!'.format(username))
-            return False
+            if self.changes_retention is not None and self.db.has_table('mailctl_changes'):
+                self.print('Pruned {} changes older than {:g} days'.format(
+                    self.db.prune_old_changes(self.changes_retention), self.changes_retention))
 
-        # Create SHA512-Crypt password hash for this user
-        charsets = [
-            'abcdefghijklmnopqrstuvwxyz',
-            'ABCDEFGHIJKLMNOPQRSTUVWXYZ',
-            '0123456789',
-            '^!%&/()=?{[]}+~#-_.:,;<>',]
-        password_characters = []
-        charset = choice(charsets)
-        while len(password_characters) < 12:
-            password_characters.append(choice(charset))
-            charset = choice(list(set(charsets) - set([charset])))
-        password = "".join(password_characters)
-        password_hash = self._hash_password(password)
+            start = time.monotonic()
+            self.db.analyze(analysis_limit)
+            self.print('Analyzed tables and indexes in {:.2f}s'.format(time.monotonic() - start))
 
-        # Update user password
-        db_query = "UPDATE virtual_users "\
-                   "SET password = '{password}' "\
-                   "WHERE email = '{username}'"\
-                   .format(
-                       password=password_hash,
-                       username=username)
-        result = self.db.query(db_query)
-        if result.rowcount:
-            print('Changed {} password to {}'.format(username, password))
-            return True
-        else:
-            print('Failed to change {} password'.format(username))
+            start = time.monotonic()
+            free = self.db.page_counts()[2]
+            if full_vacuum:
+                self.db.vacuum()
+                self.print('Rebuilt database with incremental auto vacuum in {:.2f}s'.format(
+                    time.monotonic() - start))
+            elif self.db.auto_vacuum() == 'incremental':
+                steps = self.db.incremental_vacuum(max_pages)
+                self.print('Released {} free pages in {} steps in {:.2f}s'.format(
+                    free - self.db.page_counts()[2], steps, time.monotonic() - start))
+            elif free:
+                self.print('{} free pages are not released, auto vacuum is not incremental. '
+                           'Run "db maintain --full-vacuum" once to enable it.'.format(free))
+            frames, copied = self.db.checkpoint()
+            if frames > 0:
+                self.print('Checkpointed {} of {} WAL frames'.format(copied, frames))
+
+            page_size, pages, free = self.db.page_counts()
+            self.print('Database size {:.1f} MiB: {} pages of {} bytes, {} free'.format(
+                page_size * pages / 1048576.0, pages, page_size, free))
+            try:
+                usage = self.db.space_usage()
+            except sqlite3.OperationalError as error:
+                self.print('No page usage report: {}'.format(str(error)))
+                return True
+        except sqlite3.Error as error:
+            self.print('Failed to maintain database: {}'.format(str(error)))
             return False
+        self.print('{:>9} {:>11} {:>7}  {:<5}  {}'.format('pages', 'KiB', 'unused', 'type',
+                                                          'name'))
+        for name, kind, pages, size, unused in usage:
+            self.print('{:>9} {:>11.1f} {:>6.1f}%  {:<5}  {}'.format(
+                pages, size / 1024.0, 100.0 * unused / size if size else 0, kind, name))
+        return True
 
-    def delete_user(self, username):
+    def _read_records(self, stream, fileformat):
         """
-        Delete user from database
+        Read import records from a CSV or JSONL stream
+
+        Yields tuples of line number and record dictionary. Lines that can not
+        be parsed are yielded with a record of None.
         """
+        if fileformat == 'csv':
+            reader = csv.DictReader(stream)
+            for record in reader:
+                yield reader.line_num, record
+        elif fileformat == 'jsonl':
+            for line_num, line in enumerate(stream, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                if not isinstance(record, dict):
+                    record = None
+                yield line_num, record
 
-        # Check if user to be deleted exists in database
-        db_query = "SELECT email FROM virtual_users WHERE email = '{}'".format(username)
-        result = self.db.query(db_query)
-        if not result.fetchone():
-            print('User {} does not exist!'.format(username))
-            return False
+    def _read_state(self, stream, fileformat):
+        """
+        Read desired state from a YAML or JSON stream
 
-        # Get list of aliases pointing to this user
-        aliases = self._get_user_aliases(username)
-        if aliases:
-            print('User {} is configured destination for these virtual aliases.'.format(username))
-            print('They will be deleted along with the user!')
-            for alias in sorted(aliases):
-                print(alias)
-            prompt = 'Enter YES to confirm deletion of user {} and all of its aliases: '\
-                     .format(username)
+        The document has the lists domains, users and aliases. Aliases are
+        dictionaries with source, destination or a list of destinations, and the
+        optional description and enabled. Returns tuple of domain set, user set and
+        dictionary of (enabled, description) by (source, destination). Raises
+        ValueError for invalid documents.
+        """
+        if fileformat == 'json':
+            document = json.load(stream)
         else:
-            print('No virtual aliases configured for user {}'.format(username))
-            prompt = 'Enter YES to confirm deletion of user {}: '.format(username)
-        confirmation = raw_input(prompt)
-        if confirmation != 'YES':
-            print('Aborting')
-            return True
-
-        # Delete virtual aliases for this user
-        if aliases:
-            quoted_aliases = []
-            for alias in aliases:
-                quoted_aliases.append("'{}'".format(alias))
-            db_query = "DELETE FROM virtual_aliases "\
-                       "WHERE source IN ({aliases}) AND destination = '{user}'"\
-                       .format(aliases=','.join(quoted_aliases),
-                               user=username)
-            result = self.db.query(db_query)
-            if result.rowcount:
-                print("Deleted virtual aliases for " + username)
-            else:
-                print("Failed to delete virtual aliases for " + username)
-                return False
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError('reading YAML requires the PyYAML module')
+            try:
+                document = yaml.safe_load(stream)
+            except yaml.YAMLError as error:
+                raise ValueError(str(error))
+        if document is None:
+            document = {}
+        if not isinstance(document, dict):
+            raise ValueError('document must be a mapping of domains, users and aliases')
 
-        # Delete user
-        db_query = "DELETE FROM virtual_users WHERE email = '{}'".format(username)
-        result = self.db.query(db_query)
-        if result.rowcount:
-            print('Deleted user {}'.format(username))
-            return True
-        else:
-            print('Failed to delete user {} '.format(username))
-            return False
+        def names(key):
+            values = document.get(key) or []
+            if not isinstance(values, list) or \
+                    not all(isinstance(value, str) for value in values):
+                raise ValueError('{} must be a list of names'.format(key))
+            return set(value.strip() for value in values)
 
-    def show_aliases(self, searchterm):
-        """
-        Show configured aliases
-        """
-        if searchterm == 'all':
-            db_query = 'SELECT source, destination FROM virtual_aliases'
-        elif searchterm == 'enabled':
-            db_query = 'SELECT source, destination FROM virtual_aliases WHERE enabled'
-        elif searchterm == 'disabled':
-            db_query = 'SELECT source, destination FROM virtual_aliases WHERE enabled = 0'
-        else:
-            print('Invalid filter: ' + filter)
-            return False
-        result = self.db.query(db_query)
+        domains = names('domains')
+        users = names('users')
         aliases = {}
-        for row in result:
-            source = row[0]
-            destination = row[1]
-            if source in aliases.keys():
-                aliases[source] = '{}, {}'.format(aliases[source], destination)
-            else:
-                aliases[source] = destination
-        for alias in sorted(aliases):
-            print('{} -> {}'.format(alias, aliases[alias]))
-        return True
+        for alias in document.get('aliases') or []:
+            if not isinstance(alias, dict) or not isinstance(alias.get('source'), str):
+                raise ValueError('invalid alias {}'.format(alias))
+            destinations = alias.get('destinations', [alias.get('destination')])
+            if not isinstance(destinations, list) or \
+                    not all(isinstance(value, str) for value in destinations):
+                raise ValueError('invalid destinations of alias {}'.format(alias['source']))
+            for destination in destinations:
+                aliases[(alias['source'].strip(), destination.strip())] = (
+                    bool(alias.get('enabled', True)), alias.get('description') or '')
+        return domains, users, aliases
 
-    def search_aliases(self, pattern):
-        """
-        Search configured aliases
+    def _sync_plan(self, domains, users, aliases):
         """
-        db_query = "SELECT source, destination FROM virtual_aliases "\
-                   "WHERE source LIKE '%{}%'".format(pattern)
-        result = self.db.query(db_query)
-        aliases = {}
-        for row in result:
-            source = row[0]
-            destination = row[1]
-            if source in aliases.keys():
-                aliases[source] = '{}, {}'.format(aliases[source], destination)
-            else:
-                aliases[source] = destination
-        for alias in sorted(aliases):
-            print('{} -> {}'.format(alias, aliases[alias]))
-        return True
+        Return dictionary of changes to make database match the desired state
 
-    def disable_alias(self, alias):
+        Keys are delete_domains, delete_users, delete_aliases, add_domains,
+        add_users, add_aliases and toggle_aliases, values are sorted lists.
+        cascade_users lists the users deleted along with their domain.
         """
-        Disable virtual alias
+        current_domains = set(self.db.domain_ids())
+        current_users = self.db.user_emails()
+        current_aliases = self.db.alias_states()
+        return {
+            'delete_domains': sorted(current_domains - domains),
+            # Users and aliases of deleted domains go with their domain
+            'delete_users': sorted(user for user in current_users - users
+                                   if user.split('@')[-1] in domains),
+            'delete_aliases': sorted(alias for alias in set(current_aliases) - set(aliases)
+                                     if alias[0].split('@')[-1] in domains),
+            'add_domains': sorted(domains - current_domains),
+            'add_users': sorted(users - current_users),
+            'add_aliases': sorted(set(aliases) - set(current_aliases)),
+            'toggle_aliases': sorted(alias for alias in set(aliases) & set(current_aliases)
+                                     if aliases[alias][0] != current_aliases[alias]),
+            'cascade_users': sorted(user for user in current_users
+                                   if user.split('@')[-1] not in domains),
+        }
+
+    def sync_state(self, domains, users, aliases, dry_run=False):
         """
+        Make database contain exactly the given domains, users and aliases
 
-        db_query = "SELECT source FROM virtual_aliases "\
-                   "WHERE enabled AND source = '{}'".format(alias)
-        result = self.db.query(db_query)
-        result_items = result.fetchone()
-        if result_items is None:
-            print('No enabled alias {}!'.format(alias))
+        The desired state is compared to whole table reads with set operations.
+        Only missing records are added, surplus ones deleted and aliases enabled
+        or disabled, all in a single transaction. New users get generated
+        passwords. With dry_run only the plan is shown.
+        """
+        # Check the desired state is consistent on its own
+        errors = []
+        for user in sorted(users):
+            if '@' not in user:
+                errors.append('Invalid user name syntax {}. Needs to be user@domain.tld.'
+                              .format(user))
+            elif user.split('@')[-1] not in domains:
+                errors.append('Domain of user {} is not listed.'.format(user))
+        for source, destination in sorted(aliases):
+            if source.split('@')[-1] not in domains:
+                errors.append('Domain of alias {} is not listed.'.format(source))
+            if destination not in users:
+                errors.append('Destination {} of alias {} is not a listed user.'.format(
+                    destination, source))
+        if errors:
+            for error in errors:
+                self.print(error)
             return False
-        db_query = "UPDATE virtual_aliases SET enabled = 0 "\
-                   "WHERE source = '{}'".format(alias)
-        result = self.db.query(db_query)
-        if result.rowcount:
-            print("Disabled virtual alias " + alias)
+
+        with self.db.snapshot():
+            plan = self._sync_plan(domains, users, aliases)
+        for name in plan['delete_domains']:
+            self.print('- domain {}'.format(name))
+        for email in plan['delete_users']:
+            self.print('- user {}'.format(email))
+        for source, destination in plan['delete_aliases']:
+            self.print('- alias {} -> {}'.format(source, destination))
+        for name in plan['add_domains']:
+            self.print('+ domain {}'.format(name))
+        for email in plan['add_users']:
+            self.print('+ user {}'.format(email))
+        for alias in plan['add_aliases']:
+            self.print('+ alias {} -> {}{}'.format(alias[0], alias[1],
+                                                  '' if aliases[alias][0] else ' (disabled)'))
+        for alias in plan['toggle_aliases']:
+            self.print('~ {} alias {} -> {}'.format('enable' if aliases[alias][0] else 'disable',
+                                                    alias[0], alias[1]))
+        changes = sum(len(changed) for key, changed in plan.items() if key != 'cascade_users')
+        if dry_run or not changes:
+            self.print('{} changes{}'.format(
+                changes, ', not applied' if dry_run and changes else ''))
             return True
-        else:
-            print("Failed to disable virtual alias " + alias)
+        if plan['delete_domains'] or plan['delete_users'] or plan['delete_aliases']:
+            if not self._confirm('Enter YES to apply these changes including deletions: '):
+                self.print('Aborting')
+                # Declining on the terminal is not an error, running without --yes is
+                return self.assume_yes is None
+            if not self._auto_snapshot():
+                return False
+        if plan['add_users'] and not passlib_enabled():
+            self.print("Adding users is not enabled because the passlib module is missing.")
             return False
 
-    def enable_alias(self, alias):
+        # Hash before taking the write lock, the plan is checked again inside
+        results = self._hash_passwords(plan['add_users']) if plan['add_users'] else []
+        with self.db.transaction():
+            if self._sync_plan(domains, users, aliases) != plan:
+                self.print('Database was changed while syncing, please try again.')
+                return False
+            self.db.delete_aliases(plan['delete_aliases'])
+            self.db.delete_users([(email,) for email in plan['delete_users']])
+            # Deleting a domain deletes its remaining users and aliases as well
+            self.db.delete_domains([(name,) for name in plan['delete_domains']])
+            domain_ids = self.db.domain_ids()
+            for name in plan['add_domains']:
+                domain_ids[name] = self.db.add_domain(name)
+            self.db.add_users([(domain_ids[email.split('@')[-1]], password_hash, email)
+                               for email, password, password_hash in results])
+            self.db.add_aliases([alias + (aliases[alias][1], domain_ids[alias[0].split('@')[-1]])
+                                 for alias in plan['add_aliases']])
+            # New aliases are enabled by default
+            disabled = [alias for alias in plan['add_aliases'] if not aliases[alias][0]]
+            self.db.set_aliases_enabled([(int(aliases[alias][0]),) + alias
+                                         for alias in plan['toggle_aliases'] + disabled])
+        deleted_users = plan['delete_users'] + plan['cascade_users']
+        if deleted_users:
+            self._invalidate_credentials(deleted_users)
+        for email, password, password_hash in results:
+            self.print('Added user {} with password {}'.format(email, password))
+        self.print('Applied {} changes'.format(changes))
+        return True
+
+    def import_records(self, records, chunk_size=IMPORT_CHUNK_SIZE):
         """
-        Enable virtual alias
+        Bulk import domains, users and aliases
+
+        Records are dictionaries with the keys type (domain, user or alias), name,
+        destination and description. Existing data is loaded once and duplicates
+        are detected in memory. Domains are committed one at a time, users and aliases
+        are written in chunks, each chunk in a single transaction. Passwords are
+        hashed before the transaction starts. Invalid records are reported and
+        skipped, a chunk or domain failing to be written only fails its records.
         """
+        domains = self.db.domain_ids()
+        users = self.db.user_emails()
+        aliases = self.db.alias_pairs()
+        pending_users = []
+        pending_aliases = []
+        counts = {'domain': 0, 'user': 0, 'alias': 0, 'failed': 0}
+        line_num = 0
 
-        db_query = "SELECT source FROM virtual_aliases "\
-                   "WHERE enabled = 0 AND source = '{}'".format(alias)
-        result = self.db.query(db_query)
-        result_items = result.fetchone()
-        if result_items is None:
-            print('No disabled alias {}!'.format(alias))
-            return False
-        db_query = "UPDATE virtual_aliases SET enabled = 1 "\
-                   "WHERE source = '{}'".format(alias)
-        result = self.db.query(db_query)
-        if result.rowcount:
-            print('Enabled virtual alias ' + alias)
-            return True
-        else:
-            print('Failed to enable virtual alias ' + alias)
-            return False
+        def flush():
+            """
+            Write pending users and aliases and commit the chunk
+            """
+            results = []
+            domain_ids = dict(pending_users)
+            if pending_users:
+                results = self._hash_passwords([email for email, domain_id in pending_users])
+            try:
+                with self.db.transaction():
+                    self.db.add_users([(domain_ids[email], password_hash, email)
+                                       for email, password, password_hash in results])
+                    self.db.add_aliases(pending_aliases)
+            except sqlite3.Error as error:
+                self.print('Failed to import {} records up to line {}: {}'.format(
+                    len(pending_users) + len(pending_aliases), line_num, str(error)))
+                # Rows of the failed chunk may be given again later in the file
+                users.difference_update(email for email, domain_id in pending_users)
+                aliases.difference_update((source, destination) for source, destination,
+                                          description, domain_id in pending_aliases)
+                counts['failed'] += len(pending_users) + len(pending_aliases)
+            else:
+                for email, password, password_hash in results:
+                    self.print('Added user {} with password {}'.format(email, password))
+                counts['user'] += len(pending_users)
+                counts['alias'] += len(pending_aliases)
+            del pending_users[:]
+            del pending_aliases[:]
 
-    def add_alias(self, alias, user, description):
+        for line_num, record in records:
+            # JSON records can hold any type, only strings are valid field values
+            if record is None or not all(isinstance(record.get(key), str) for key in
+                                         self.IMPORT_FIELDS if record.get(key) is not None):
+                self.print('Line {}: Invalid record'.format(line_num))
+                counts['failed'] += 1
+                continue
+            record_type = (record.get('type') or '').strip().lower()
+            name = (record.get('name') or '').strip()
+            destination = (record.get('destination') or '').strip()
+            description = record.get('description') or ''
+            domain = name.split('@')[-1]
+            error = None
+            if not name:
+                error = 'Missing name'
+            elif record_type == 'domain':
+                if name in domains:
+                    error = 'Domain {} already exists!'.format(name)
+            elif record_type == 'user':
+                if not passlib_enabled():
+                    error = 'Adding users is not enabled because the passlib module is missing.'
+                elif name in users:
+                    error = 'User {} already exists!'.format(name)
+                elif '@' not in name:
+                    error = 'Invalid user name syntax. Needs to be user@domain.tld.'
+                elif domain not in domains:
+                    error = 'Domain {} is not handled by this system.'.format(domain)
+            elif record_type == 'alias':
+                if (name, destination) in aliases:
+                    error = 'Alias {} -> {} already exists!'.format(name, destination)
+                elif destination not in users:
+                    error = 'Invalid user {}'.format(destination)
+                elif domain not in domains:
+                    error = '{} is not a domain managed by this server!'.format(domain)
+            else:
+                error = 'Invalid record type {}'.format(record_type)
+            if error:
+                self.print('Line {}: {}'.format(line_num, error))
+                counts['failed'] += 1
+                continue
+
+            if record_type == 'domain':
+                # Domains are rare, commit them right away to learn their id, so
+                # the write lock is not held while the next chunk hashes passwords
+                try:
+                    with self.db.transaction():
+                        domain_id = self.db.add_domain(name)
+                except sqlite3.Error as error:
+                    self.print('Line {}: Failed to add domain {}: {}'.format(
+                        line_num, name, str(error)))
+                    counts['failed'] += 1
+                    continue
+                domains[name] = domain_id
+                counts['domain'] += 1
+            elif record_type == 'user':
+                pending_users.append((name, domains[domain]))
+                users.add(name)
+            elif record_type == 'alias':
+                pending_aliases.append((name, destination, description, domains[domain]))
+                aliases.add((name, destination))
+
+            if len(pending_users) + len(pending_aliases) >= chunk_size:
+                flush()
+        flush()
+
+        self.print('Imported {} domains, {} users and {} aliases, {} records failed'.format(
+            counts['domain'], counts['user'], counts['alias'], counts['failed']))
+        return counts['failed'] == 0
+
+    def _read_lines(self, filename):
         """
-        Add virtual alias
+        Read non-empty lines from file, - for stdin
+
+        Lines starting with # are ignored.
         """
+        try:
+            stream = sys.stdin if filename == '-' else open(filename)
+        except IOError as error:
+            self.print('Failed to open {}: {}'.format(filename, str(error)))
+            sys.exit(1)
+        with stream:
+            return [line.strip() for line in stream
+                    if line.strip() and not line.startswith('#')]
 
-        db_query = "SELECT source, destination FROM virtual_aliases "\
-                   "WHERE source = '{}' "\
-                   "AND destination = '{}'".format(alias, user)
-        result = self.db.query(db_query)
-        result_items = result.fetchone()
-        if result_items:
-            print('Alias {} -> {} already exists!'.format(alias, user))
-            return False
-        alias_domain = alias.split("@")[-1]
-        # Check sanity of desired alias record
-        db_query = "SELECT email FROM virtual_users WHERE email = '{}'".format(user)
-        result = self.db.query(db_query)
-        result_items = result.fetchone()
-        if not result_items:
-            print("Invalid user " + user)
-            return False
-        db_query = "SELECT name FROM virtual_domains WHERE name = '{}'".format(alias_domain)
-        result = self.db.query(db_query)
-        result_items = result.fetchone()
-        if not result_items:
-            print('{} is not a domain managed by this server!'.format(alias_domain))
-            return False
-        # Finally add alias
-        db_query = "INSERT INTO virtual_aliases "\
-                   "(source,destination,description,domain_id) VALUES ("\
-                   "'{source}', '{destination}', '{description}', "\
-                   "(SELECT id from virtual_domains WHERE name='{domain}'))"\
-                   .format(
-                       source=alias,
-                       destination=user,
-                       description=description,
-                       domain=alias_domain)
-        result = self.db.query(db_query)
-        if result.rowcount:
-            print('Added virtual alias {} -> {} '.format(alias, user))
-            return True
-        else:
-            print('Failed to add virtual alias {} -> {} '.format(alias, user))
-            return False
+    def _add_output_arguments(self, parser):
+        """
+        Add output format and paging options to command parser
+        """
+        parser.add_argument('--format',
+                            help='output format',
+                            choices=self.OUTPUT_FORMATS,
+                            default='text')
+        parser.add_argument('--limit', help='show at most this many entries', type=int)
+        parser.add_argument('--offset', help='skip this many entries', type=int)
 
-    def delete_alias(self, alias):
+    def _add_hashing_arguments(self, parser):
         """
-        Delete virtual alias from database
+        Add password hashing options to command parser
         """
+        parser.add_argument('--rounds',
+                            help='SHA512-CRYPT rounds (default: {})'.format(self.password_rounds),
+                            type=int,
+                            default=self.password_rounds)
+        parser.add_argument('--workers',
+                            help='number of hashing processes (default: {})'.format(
+                                self.hash_workers),
+                            type=int,
+                            default=self.hash_workers)
 
-        db_query = "SELECT source FROM virtual_aliases WHERE source = '{}'".format(alias)
-        result = self.db.query(db_query)
-        result_items = result.fetchone()
-        if result_items is None:
-            print('Alias {} does not exist!'.format(alias))
-            return False
-        db_query = "DELETE FROM virtual_aliases WHERE source = '{}'".format(alias)
-        result = self.db.query(db_query)
-        if result.rowcount:
-            print("Deleted virtual alias " + alias)
-            return True
-        else:
-            print("Failed to delete virtual alias " + alias)
-            return False
+    def _apply_hashing_arguments(self, parser, args):
+        """
+        Validate and apply password hashing options
+        """
+        if not self.PASSWORD_MIN_ROUNDS <= args.rounds <= self.PASSWORD_MAX_ROUNDS:
+            parser.error('rounds must be between {} and {}'.format(
+                self.PASSWORD_MIN_ROUNDS, self.PASSWORD_MAX_ROUNDS))
+        if args.workers < 1:
+            parser.error('workers must be at least 1')
+        self.password_rounds = args.rounds
+        self.hash_workers = args.workers
 
     def domain(self):
         """
@@ -577,7 +4950,7 @@ The most commonly used commands are:
         """
 
         # Create command parser
-        parser = argparse.ArgumentParser(
+        parser = self._command_parser(
             description='Manage domains')
         subparsers = parser.add_subparsers(dest='subcommand',
                                            title='subcommands',
@@ -585,20 +4958,28 @@ The most commonly used commands are:
                                            help='valid subcommands')
         # Create subparsers
         parser_show = subparsers.add_parser('show', help='show domains')
+        self._add_output_arguments(parser_show)
         parser_add = subparsers.add_parser('add', help='add doamin')
         parser_add.add_argument('domainname', help='domain name')
-        parser_delete = subparsers.add_parser('delete', help='delete domain')
-        parser_delete.add_argument('domainname', help='domain name')
+        parser_delete = subparsers.add_parser('delete', help='delete domains')
+        parser_delete.add_argument('domainname', help='domain name', nargs='+')
+        parser_delete.add_argument('-y', '--yes', help='delete without confirmation',
+                                   action='store_true')
 
-        args = parser.parse_args(sys.argv[2:])
+        args = parser.parse_args(self.argv)
 
         if args.subcommand == 'show':
-            self.show_domains()
+            self.show_domains(args.format, args.limit, args.offset)
         elif args.subcommand == 'add':
             if not self.add_domain(args.domainname):
                 sys.exit(1)
         elif args.subcommand == 'delete':
-            if not self.delete_domain(args.domainname):
+            if args.yes:
+                self.assume_yes = True
+            if len(args.domainname) == 1:
+                if not self.delete_domain(args.domainname[0]):
+                    sys.exit(1)
+            elif not self.delete_domains(args.domainname):
                 sys.exit(1)
     
     def user(self):
@@ -607,7 +4988,7 @@ The most commonly used commands are:
         """
         
         # Create command parser
-        parser = argparse.ArgumentParser(
+        parser = self._command_parser(
             description='Manage users')
         subparsers = parser.add_subparsers(dest='subcommand',
                                            title='subcommands',
@@ -615,25 +4996,55 @@ The most commonly used commands are:
                                            help='valid subcommands')
         # Create subparsers
         parser_show = subparsers.add_parser('show', help='show users')
+        self._add_output_arguments(parser_show)
         parser_add = subparsers.add_parser('add', help='add user')
-        parser_add.add_argument('username', help='user name')
+        parser_add.add_argument('username', help='user name', nargs='?')
+        parser_add.add_argument('--from-file',
+                                help='add users listed in file, one per line, - for stdin')
+        self._add_hashing_arguments(parser_add)
         parser_delete = subparsers.add_parser('delete', help='delete user')
         parser_delete.add_argument('username', help='user name')
         parser_passwd = subparsers.add_parser('password', help='change password')
-        parser_passwd.add_argument('username', help='user name')
+        parser_passwd.add_argument('username', help='user name', nargs='?')
+        parser_passwd.add_argument('--all',
+                                   help='change passwords of all users',
+                                   action='store_true')
+        parser_passwd.add_argument('--domain', help='change passwords of all users of domain')
+        self._add_hashing_arguments(parser_passwd)
 
-        args = parser.parse_args(sys.argv[2:])
+        args = parser.parse_args(self.argv)
 
         if args.subcommand == 'show':
-            self.show_users()
+            self.show_users(args.format, args.limit, args.offset)
         elif args.subcommand == 'add':
-            if not self.add_user(args.username):
+            self._apply_hashing_arguments(parser_add, args)
+            if bool(args.username) == bool(args.from_file):
+                parser_add.error('either username or --from-file is required')
+            if args.from_file:
+                if not self.add_users(self._read_lines(args.from_file)):
+                    sys.exit(1)
+            elif not self.add_user(args.username):
                 sys.exit(1)
         elif args.subcommand == 'delete':
             if not self.delete_user(args.username):
                 sys.exit(1)
         elif args.subcommand == 'password':
-            if not self.change_password(args.username):
+            self._apply_hashing_arguments(parser_passwd, args)
+            if len([arg for arg in (args.username, args.all, args.domain) if arg]) != 1:
+                parser_passwd.error('either username, --all or --domain is required')
+            if args.all:
+                usernames = sorted(self.db.user_emails())
+            elif args.domain:
+                if self.db.get_domain_id(args.domain) is None:
+                    self.print('Domain {} not found!'.format(args.domain))
+                    sys.exit(1)
+                usernames = sorted(self.db.list_domain_users(args.domain))
+            else:
+                usernames = None
+            if usernames is None:
+                if not self.change_password(args.username):
+                    sys.exit(1)
+            elif not self.change_passwords(usernames):
                 sys.exit(1)
 
     def alias(self):
@@ -641,7 +5052,7 @@ The most commonly used commands are:
         Handle aliases
         """
         # Create command parser
-        parser = argparse.ArgumentParser(
+        parser = self._command_parser(
             description='Manage aliases')
         subparsers = parser.add_subparsers(dest='subcommand',
                                            title='subcommands',
@@ -653,15 +5064,45 @@ The most commonly used commands are:
                                  help='filter alias',
                                  choices=['all', 'enabled', 'disabled'],
                                  default='all')
+        self._add_output_arguments(parser_show)
         # Create parser for the "search" command
         parser_search = subparsers.add_parser('search', help='search aliases')
         parser_search.add_argument('pattern', help='search pattern')
+        parser_search.add_argument('-m', '--mode',
+                                   help='match whole value, prefix, domain or substring',
+                                   choices=Database.SEARCH_MODES,
+                                   default='substring')
+        parser_search.add_argument('--field',
+                                   help='field to search',
+                                   choices=Database.SEARCH_FIELDS,
+                                   default='source')
+        self._add_output_arguments(parser_search)
+        # Create parser for the "resolve" command
+        parser_resolve = subparsers.add_parser('resolve',
+                                               help='show final recipients of addresses')
+        parser_resolve.add_argument('address', help='address to resolve', nargs='+')
+        # Create parser for the "audit" command
+        parser_audit = subparsers.add_parser(
+            'audit', help='check all aliases for cycles, dead ends and large fan-out')
+        parser_audit.add_argument('-p', '--problems',
+                                  help='only show aliases with problems',
+                                  action='store_true')
+        for subparser in (parser_resolve, parser_audit):
+            subparser.add_argument('--format',
+                                   help='output format (default: text)',
+                                   choices=self.OUTPUT_FORMATS,
+                                   default='text')
+            subparser.add_argument('--max-fanout',
+                                   help='report aliases with more recipients '
+                                        '(default: {})'.format(self.ALIAS_MAX_FANOUT),
+                                   type=int,
+                                   default=self.ALIAS_MAX_FANOUT)
         # Create parser for the "disable" command
-        parser_disable = subparsers.add_parser('disable', help='disable alias')
-        parser_disable.add_argument('alias', help='alias to disable')
+        parser_disable = subparsers.add_parser('disable', help='disable aliases')
+        parser_disable.add_argument('alias', help='aliases to disable', nargs='*')
         # Create parser for the "disable" command
-        parser_enable = subparsers.add_parser('enable', help='enable alias')
-        parser_enable.add_argument('alias', help='alias to enable')
+        parser_enable = subparsers.add_parser('enable', help='enable aliases')
+        parser_enable.add_argument('alias', help='aliases to enable', nargs='*')
         # Create parser for the "add" command
         parser_add = subparsers.add_parser('add', help='add alias')
         parser_add.add_argument('-a', '--alias', help='alias name', required=True)
@@ -670,26 +5111,544 @@ The most commonly used commands are:
                                 help='alias description',
                                 default='')
         # Create parser for the "delete" command
-        parser_delete = subparsers.add_parser('delete', help='delete alias')
-        parser_delete.add_argument('alias', help='alias to delete')
+        parser_delete = subparsers.add_parser('delete', help='delete aliases')
+        parser_delete.add_argument('alias', help='aliases to delete', nargs='*')
+        for subparser in (parser_disable, parser_enable, parser_delete):
+            subparser.add_argument('-d', '--domain',
+                                   help='all aliases of domain, may be given multiple times',
+                                   action='append', default=[])
+            subparser.add_argument('-m', '--match',
+                                   help='aliases matching a pattern like old-*@sample.local, '
+                                        'may be given multiple times',
+                                   action='append', default=[])
+            subparser.add_argument('--from-file',
+                                   help='aliases listed in file, one per line, - for stdin')
+            subparser.add_argument('-y', '--yes',
+                                   help='change several aliases without confirmation',
+                                   action='store_true')
 
-        args = parser.parse_args(sys.argv[2:])
+        args = parser.parse_args(self.argv)
 
         if args.subcommand == 'show':
-            self.show_aliases(args.filter)
+            self.show_aliases(args.filter, args.format, args.limit, args.offset)
         elif args.subcommand == 'search':
-            self.search_aliases(args.pattern)
-        elif args.subcommand == 'enable':
-            if not self.enable_alias(args.alias):
+            self.search_aliases(args.pattern, args.format, args.limit, args.offset,
+                                args.mode, args.field)
+        elif args.subcommand == 'resolve':
+            if not self.resolve_aliases(args.address, args.format, args.max_fanout):
+                sys.exit(1)
+        elif args.subcommand == 'audit':
+            if not self.audit_aliases(args.format, args.max_fanout, args.problems):
                 sys.exit(1)
-        elif args.subcommand == 'disable':
-            if not self.disable_alias(args.alias):
+        elif args.subcommand in ('enable', 'disable', 'delete') and \
+                len(args.alias) == 1 and not (args.domain or args.match or args.from_file):
+            method = {'enable': self.enable_alias, 'disable': self.disable_alias,
+                      'delete': self.delete_alias}[args.subcommand]
+            if not method(args.alias[0]):
+                sys.exit(1)
+        elif args.subcommand in ('enable', 'disable', 'delete'):
+            aliases = list(args.alias)
+            if args.from_file:
+                aliases.extend(self._read_lines(args.from_file))
+            if not (aliases or args.domain or args.match):
+                parser.error('aliases, --domain, --match or --from-file are required')
+            if args.yes:
+                self.assume_yes = True
+            if not self.change_aliases(args.subcommand, aliases, args.domain, args.match):
                 sys.exit(1)
         elif args.subcommand == 'add':
             if not self.add_alias(args.alias, args.user, args.comment):
                 sys.exit(1)
-        elif args.subcommand == 'delete':
-            if not self.delete_alias(args.alias):
+
+    def database(self):
+        """
+        Handle database schema
+        """
+        # Create command parser
+        parser = self._command_parser(
+            description='Manage database schema, backups and maintenance')
+        subparsers = parser.add_subparsers(dest='subcommand',
+                                           title='subcommands',
+                                           description='valid subcommands',
+                                           help='valid subcommands')
+        # Create subparsers
+        parser_migrate = subparsers.add_parser('migrate', help='apply schema migrations')
+        parser_version = subparsers.add_parser('version', help='show schema version')
+        parser_backup = subparsers.add_parser('backup', help='back up the live database')
+        parser_backup.add_argument('file', help='backup file')
+        parser_backup.add_argument('-z', '--compress', help='gzip compress the backup',
+                                   action='store_true')
+        parser_snapshot = subparsers.add_parser(
+            'snapshot', help='back up into the snapshot directory and prune old snapshots')
+        parser_snapshot.add_argument('-z', '--compress', help='gzip compress the snapshot',
+                                     action='store_true', default=None)
+        parser_snapshot.add_argument('-k', '--keep',
+                                     help='number of snapshots to keep (default: {})'
+                                          .format(self.snapshot_keep),
+                                     type=int)
+        parser_restore = subparsers.add_parser('restore',
+                                               help='replace the database with a backup')
+        parser_restore.add_argument('file', help='backup or snapshot file')
+        parser_restore.add_argument('-y', '--yes', help='restore without confirmation',
+                                    action='store_true')
+        parser_maintain = subparsers.add_parser(
+            'maintain', help='check the database, update statistics, release free pages '
+                             'and report sizes')
+        parser_maintain.add_argument('-q', '--quick',
+                                     help='quick check without checking indexes',
+                                     action='store_true')
+        parser_maintain.add_argument('--analysis-limit',
+                                     help='rows examined per index by ANALYZE, 0 for all '
+                                          '(default: {})'.format(self.db.ANALYSIS_LIMIT),
+                                     type=int)
+        parser_maintain.add_argument('--max-pages',
+                                     help='free pages to release at most (default: all)',
+                                     type=int)
+        parser_maintain.add_argument('--full-vacuum',
+                                     help='rebuild the database to enable incremental '
+                                          'vacuum, locks out writers until done',
+                                     action='store_true')
+
+        args = parser.parse_args(self.argv)
+
+        if args.subcommand == 'migrate':
+            if not self.migrate_database():
+                sys.exit(1)
+        elif args.subcommand == 'version':
+            self.print('Schema version {} of {}'.format(self.db.schema_version(),
+                                                        len(self.db.MIGRATIONS)))
+        elif args.subcommand == 'backup':
+            if not self.backup_database(args.file, args.compress):
+                sys.exit(1)
+        elif args.subcommand == 'snapshot':
+            if args.keep is not None and args.keep < 1:
+                parser.error('keep must be at least 1')
+            if self.snapshot_database(args.compress, args.keep) is None:
+                sys.exit(1)
+        elif args.subcommand == 'restore':
+            if args.yes:
+                self.assume_yes = True
+            if not self.restore_database(args.file):
+                sys.exit(1)
+        elif args.subcommand == 'maintain':
+            if args.analysis_limit is not None and args.analysis_limit < 0:
+                parser.error('analysis limit must not be negative')
+            if args.max_pages is not None and args.max_pages < 1:
+                parser.error('max pages must be at least 1')
+            if not self.maintain_database(args.quick, args.analysis_limit, args.max_pages,
+                                          args.full_vacuum):
+                sys.exit(1)
+
+    def batch(self):
+        """
+        Handle batch of commands
+        """
+        # Create command parser
+        parser = self._command_parser(
+            description='Run commands like "alias add -a x -u y", one per line, on a '
+                        'single database connection. Supported commands: {}, except {}'
+                        .format(', '.join(self.BATCH_COMMANDS),
+                                ' and '.join(self.BATCH_EXCLUDED)))
+        parser.add_argument('file', help='file with commands, - for stdin (default: -)',
+                            nargs='?', default='-')
+        parser.add_argument('-t', '--transaction',
+                            help='commit each command, or all commands together and '
+                                 'none if one fails (default: command)',
+                            choices=self.BATCH_TRANSACTIONS,
+                            default='command')
+        parser.add_argument('-r', '--results',
+                            help='JSON line per command or plain output (default: jsonl)',
+                            choices=('jsonl', 'text'),
+                            default='jsonl')
+        parser.add_argument('-y', '--yes',
+                            help='confirm deletions, they fail otherwise',
+                            action='store_true')
+
+        args = parser.parse_args(self.argv)
+
+        self.assume_yes = args.yes
+        try:
+            stream = sys.stdin if args.file == '-' else open(args.file)
+        except IOError as error:
+            self.print('Failed to read {}: {}'.format(args.file, str(error)))
+            sys.exit(1)
+        with stream:
+            if not self.run_batch(stream, args.transaction, args.results):
+                sys.exit(1)
+
+    def sync(self):
+        """
+        Handle desired state sync
+        """
+        # Create command parser
+        parser = self._command_parser(
+            description='Add, delete, enable and disable domains, users and aliases '
+                        'so the database matches a YAML or JSON file')
+        parser.add_argument('file', help='file describing the desired state, - for stdin')
+        parser.add_argument('-f', '--format',
+                            help='file format (default: json for .json files, else yaml)',
+                            choices=self.SYNC_FORMATS)
+        parser.add_argument('-n', '--dry-run',
+                            help='only show the changes',
+                            action='store_true')
+        parser.add_argument('-y', '--yes',
+                            help='apply deletions without confirmation',
+                            action='store_true')
+        self._add_hashing_arguments(parser)
+
+        args = parser.parse_args(self.argv)
+        self._apply_hashing_arguments(parser, args)
+
+        fileformat = args.format
+        if fileformat is None:
+            fileformat = 'json' if args.file.endswith('.json') else 'yaml'
+        if args.yes:
+            self.assume_yes = True
+        try:
+            if args.file == '-':
+                state = self._read_state(sys.stdin, fileformat)
+            else:
+                with open(args.file) as stream:
+                    state = self._read_state(stream, fileformat)
+        except IOError as error:
+            self.print('Failed to read {}: {}'.format(args.file, str(error)))
+            sys.exit(1)
+        except ValueError as error:
+            self.print('Invalid state file {}: {}'.format(args.file, str(error)))
+            sys.exit(1)
+        if not self.sync_state(*state, dry_run=args.dry_run):
+            sys.exit(1)
+
+    def changes(self):
+        """
+        Handle change log
+        """
+        # Create command parser
+        parser = self._command_parser(
+            description='Write changes to domains, users and aliases as JSON lines')
+        parser.add_argument('-s', '--since',
+                            help='only changes after this sequence number (default: 0)',
+                            type=int, default=0)
+        parser.add_argument('-l', '--limit',
+                            help='maximum number of changes',
+                            type=int)
+        parser.add_argument('-f', '--follow',
+                            help='keep waiting for new changes',
+                            action='store_true')
+        parser.add_argument('--poll-interval',
+                            help='seconds between checks for new changes with --follow '
+                                 '(default: {})'.format(self.CHANGES_POLL_INTERVAL),
+                            type=float, default=self.CHANGES_POLL_INTERVAL)
+        parser.add_argument('--last',
+                            help='only show the sequence number of the latest change',
+                            action='store_true')
+        parser.add_argument('--prune-before',
+                            help='delete changes with lower sequence numbers',
+                            type=int, metavar='SEQ')
+        parser.add_argument('--prune-days',
+                            help='delete changes logged more than this many days ago',
+                            type=float, metavar='DAYS')
+
+        args = parser.parse_args(self.argv)
+
+        if args.limit is not None and args.limit < 1:
+            parser.error('limit must be positive')
+        if args.poll_interval <= 0:
+            parser.error('poll interval must be positive')
+        if args.prune_days is not None and args.prune_days <= 0:
+            parser.error('days must be positive')
+        if args.last or args.prune_before is not None or args.prune_days is not None:
+            if not self.db.has_table('mailctl_changes'):
+                self.print('The change log requires schema migration 3, '
+                           'run "mailctl.py db migrate".')
+                sys.exit(1)
+            if args.prune_before is not None:
+                self.print('Pruned {} changes'.format(self.db.prune_changes(args.prune_before)))
+            if args.prune_days is not None:
+                self.print('Pruned {} changes'.format(self.db.prune_old_changes(args.prune_days)))
+            if args.last:
+                self.print(self.db.change_range()[1])
+        elif not self.stream_changes(args.since, args.limit, args.follow, args.poll_interval):
+            sys.exit(1)
+
+    def replicate(self):
+        """
+        Handle replication
+        """
+        # Create command parser
+        parser = self._command_parser(
+            description='Serve changes to replicas on a primary, or keep a replica '
+                        'up to date with a primary')
+        group = parser.add_mutually_exclusive_group(required=True)
+        group.add_argument('-l', '--listen',
+                           help='serve replicas on address unix:PATH, inet:HOST:PORT or '
+                                'HOST:PORT with a loopback HOST, may be given multiple times',
+                           action='append')
+        group.add_argument('-f', '--from', dest='primary',
+                           help='follow the primary at address unix:PATH, '
+                                'inet:HOST:PORT or HOST:PORT')
+        parser.add_argument('--once',
+                            help='exit after catching up with the primary',
+                            action='store_true')
+        parser.add_argument('--poll-interval',
+                            help='seconds between checks for new changes on the primary '
+                                 '(default: {})'.format(self.CHANGES_POLL_INTERVAL),
+                            type=float, default=self.CHANGES_POLL_INTERVAL)
+        parser.add_argument('--retry-interval',
+                            help='seconds to wait before reconnecting to the primary '
+                                 '(default: {})'.format(self.REPLICATION_RETRY),
+                            type=float, default=self.REPLICATION_RETRY)
+
+        args = parser.parse_args(self.argv)
+
+        if args.poll_interval <= 0 or args.retry_interval <= 0:
+            parser.error('intervals must be positive')
+        if args.once and args.listen:
+            parser.error('--once requires --from')
+        try:
+            addresses = [LookupServer.parse_address(address)
+                         for address in args.listen or [args.primary]]
+        except ValueError as error:
+            parser.error(str(error))
+        for address in addresses if args.listen else ():
+            # Replicas get password hashes without authentication
+            if address[0] == 'inet' and address[1] not in self.API_HOSTS:
+                parser.error('{} is no loopback address'.format(address[1] or 'any host'))
+        if args.listen:
+            success = self.serve_replication(addresses, args.poll_interval)
+        else:
+            success = self.replicate_from(addresses[0], args.once, args.retry_interval)
+        if not success:
+            sys.exit(1)
+
+    def api(self):
+        """
+        Handle HTTP/JSON API
+        """
+        # Create command parser
+        parser = self._command_parser(
+            description='Serve domain, user and alias operations as HTTP/JSON endpoints '
+                        'on localhost or a Unix socket')
+        parser.add_argument('-l', '--listen',
+                            help='address unix:PATH, inet:HOST:PORT or HOST:PORT with a '
+                                 'loopback HOST, may be given multiple times '
+                                 '(default: {})'.format(self.API_ADDRESS),
+                            action='append')
+        parser.add_argument('-r', '--readers',
+                            help='threads with read-only connections serving reads '
+                                 '(default: {})'.format(ApiServer.READERS),
+                            type=int, default=ApiServer.READERS)
+
+        args = parser.parse_args(self.argv)
+
+        if args.readers < 1:
+            parser.error('at least 1 reader is required')
+        try:
+            addresses = [LookupServer.parse_address(address)
+                         for address in args.listen or [self.API_ADDRESS]]
+        except ValueError as error:
+            parser.error(str(error))
+        for address in addresses:
+            # The API has no authentication, other hosts must not reach it
+            if address[0] == 'inet' and address[1] not in self.API_HOSTS:
+                parser.error('{} is no loopback address'.format(address[1] or 'any host'))
+        if not self.serve_api(addresses, args.readers):
+            sys.exit(1)
+
+    def stats(self):
+        """
+        Handle domain statistics
+        """
+        # Create command parser
+        parser = self._command_parser(
+            description='Show users, aliases and disabled alias destinations per domain '
+                        'from counts kept current by triggers')
+        self._add_output_arguments(parser)
+        parser.add_argument('--prometheus',
+                            help='write metrics in Prometheus text format to this file, '
+                                 'e.g. for the node_exporter textfile collector, - for '
+                                 'stdout')
+
+        args = parser.parse_args(self.argv)
+
+        if not self.db.has_table('mailctl_domain_stats'):
+            self.print('Statistics require schema migration 5, run "mailctl.py db migrate".')
+            sys.exit(1)
+        if args.prometheus:
+            if not self.write_metrics(args.prometheus):
+                sys.exit(1)
+        else:
+            self.show_stats(args.format, args.limit, args.offset)
+
+    def export(self):
+        """
+        Handle lookup table export
+        """
+        # Create command parser
+        parser = self._command_parser(
+            description='Compile domains, users and enabled aliases into lookup tables')
+        parser.add_argument('-d', '--directory',
+                            help='output directory (default: current directory)',
+                            default='.')
+        parser.add_argument('-f', '--format',
+                            help='table format, may be given multiple times (default: all)',
+                            choices=self.EXPORT_FORMATS,
+                            action='append')
+        parser.add_argument('--postmap',
+                            help='run postmap with this table type, e.g. hash, '
+                                 'on changed texthash files')
+
+        args = parser.parse_args(self.argv)
+
+        if not os.path.isdir(args.directory):
+            self.print('Output directory {} does not exist.'.format(args.directory))
+            sys.exit(1)
+        if not self.export_tables(args.directory, args.format or self.EXPORT_FORMATS,
+                                  args.postmap):
+            sys.exit(1)
+
+    def serve(self):
+        """
+        Handle lookup daemon
+        """
+        # Create command parser
+        parser = self._command_parser(
+            description='Answer Postfix socketmap and tcp_table lookups from memory. '
+                        'Tables: {}'.format(', '.join(sorted(LookupServer.TABLES))))
+        parser.add_argument('-s', '--socketmap',
+                            help='socketmap address unix:PATH, inet:HOST:PORT or HOST:PORT, '
+                                 'may be given multiple times (default: {} unless '
+                                 '--tcp-table is given)'.format(self.SOCKETMAP_ADDRESS),
+                            action='append', default=[])
+        parser.add_argument('-t', '--tcp-table',
+                            help='serve table with tcp_table protocol on TABLE=ADDRESS, '
+                                 'may be given multiple times',
+                            action='append', default=[])
+        parser.add_argument('-a', '--auth',
+                            help='serve login verification for checkpassword on this '
+                                 'address (default: {})'.format(self.auth_socket),
+                            nargs='?', const=self.auth_socket, action='append', default=[])
+        parser.add_argument('-D', '--dict',
+                            help='serve passdb/USER and userdb/USER with Dovecot dict '
+                                 'protocol on this address, may be given multiple times',
+                            action='append', default=[])
+        parser.add_argument('--poll-interval',
+                            help='seconds between checks for database changes (default: 1)',
+                            type=float, default=1.0)
+        parser.add_argument('--auth-cache-size',
+                            help='number of verified logins to cache (default: {})'
+                                 .format(self.AUTH_CACHE_SIZE),
+                            type=int, default=self.AUTH_CACHE_SIZE)
+        parser.add_argument('--auth-cache-ttl',
+                            help='seconds verified logins are cached (default: {})'
+                                 .format(self.AUTH_CACHE_TTL),
+                            type=int, default=self.AUTH_CACHE_TTL)
+        parser.add_argument('--workers',
+                            help='number of processes verifying passwords (default: {})'
+                                 .format(self.hash_workers),
+                            type=int)
+
+        args = parser.parse_args(self.argv)
+
+        if not args.socketmap and not args.tcp_table and not args.auth and not args.dict:
+            args.socketmap.append(self.SOCKETMAP_ADDRESS)
+        try:
+            socketmaps = [LookupServer.parse_address(address) for address in args.socketmap]
+            auth = [LookupServer.parse_address(address) for address in args.auth]
+            dicts = [LookupServer.parse_address(address) for address in args.dict]
+            tcp_tables = []
+            for option in args.tcp_table:
+                table, _, address = option.partition('=')
+                if table not in LookupServer.TABLES:
+                    raise ValueError('unknown table {}'.format(table))
+                tcp_tables.append((table, LookupServer.parse_address(address)))
+        except ValueError as error:
+            self.print('Invalid listen address: {}'.format(str(error)))
+            sys.exit(1)
+        if args.poll_interval <= 0:
+            self.print('Poll interval must be positive.')
+            sys.exit(1)
+        if args.auth_cache_size < 0 or args.auth_cache_ttl < 0:
+            self.print('Auth cache size and time to live must not be negative.')
+            sys.exit(1)
+        if args.workers is not None:
+            if args.workers < 1:
+                self.print('Number of workers must be at least 1.')
+                sys.exit(1)
+            self.hash_workers = args.workers
+        if not self.serve_lookups(socketmaps, tcp_tables, args.poll_interval, auth, dicts,
+                                  args.auth_cache_size, args.auth_cache_ttl):
+            sys.exit(1)
+
+    def checkpassword(self):
+        """
+        Handle Dovecot checkpassword helper
+        """
+        # Create command parser
+        parser = self._command_parser(
+            description='Verify the user name and password passed on file descriptor 3 '
+                        'with the auth socket of mailctl.py serve')
+        parser.add_argument('-s', '--socket',
+                            help='auth socket address (default: {})'.format(self.auth_socket))
+        parser.add_argument('reply', help='checkpassword reply program run on success',
+                            nargs=argparse.REMAINDER)
+
+        args = parser.parse_args(self.argv)
+
+        if not args.reply:
+            parser.error('the reply program is required')
+        if args.socket is not None:
+            self.auth_socket = args.socket
+        try:
+            stream = os.fdopen(3, 'rb')
+        except OSError:
+            sys.stderr.write('Credentials must be passed on file descriptor 3\n')
+            sys.exit(111)
+        sys.exit(self.check_password(args.reply, stream))
+
+    def import_(self):
+        """
+        Handle bulk imports
+        """
+        # Create command parser
+        parser = self._command_parser(
+            description='Bulk import domains, users and aliases from CSV or JSONL. '
+                        'Records need the fields type (domain, user or alias), name, '
+                        'destination and description.')
+        parser.add_argument('file', help='file to import, - for stdin')
+        parser.add_argument('-f', '--format',
+                            help='input format, detected from file extension by default',
+                            choices=['csv', 'jsonl'])
+        parser.add_argument('--chunk-size',
+                            help='records per transaction',
+                            type=int,
+                            default=self.IMPORT_CHUNK_SIZE)
+        self._add_hashing_arguments(parser)
+
+        args = parser.parse_args(self.argv)
+        self._apply_hashing_arguments(parser, args)
+
+        fileformat = args.format
+        if fileformat is None:
+            if args.file.endswith('.csv'):
+                fileformat = 'csv'
+            elif args.file.endswith(('.jsonl', '.json')):
+                fileformat = 'jsonl'
+            else:
+                self.print('Unable to detect format of {}, use --format.'.format(args.file))
+                sys.exit(1)
+        if args.file == '-':
+            # Leave stdin open, batches and embedding callers keep using it
+            stream = contextlib.nullcontext(sys.stdin)
+        else:
+            try:
+                stream = open(args.file, newline='')
+            except IOError as error:
+                self.print('Failed to open {}: {}'.format(args.file, str(error)))
+                sys.exit(1)
+        with stream as stream:
+            if not self.import_records(self._read_records(stream, fileformat),
+                                       max(args.chunk_size, 1)):
                 sys.exit(1)
 
 
@@ -0,0 +1,223 @@
+"""
+Tests of mailctl.py import
+
+Runs the command in-process on a temporary database created from
+contrib/db_schema.sql and checks that invalid records, records failing to be
+written and unreadable files are reported without losing the other records.
+"""
+
+import contextlib
+import io
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS, os.pardir))
+
+import mailctl  # noqa: E402
+
+
+class ImportTest(unittest.TestCase):
+    """
+    Import of domains, users and aliases into a database with the current schema
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.db = os.path.join(self.directory.name, 'mail.sqlite')
+        self.config = os.path.join(self.directory.name, 'mailctl.conf')
+        open(self.config, 'w').close()
+        with open(os.path.join(TESTS, os.pardir, 'contrib', 'db_schema.sql')) as schema:
+            self.execute(schema.read(), script=True)
+
+    def execute(self, sql, params=(), script=False):
+        """
+        Run SQL on a connection of its own and return all rows
+        """
+        connection = sqlite3.connect(self.db)
+        try:
+            with connection:
+                if script:
+                    connection.executescript(sql)
+                    return []
+                return connection.execute(sql, params).fetchall()
+        finally:
+            connection.close()
+
+    def run_mailctl(self, *argv):
+        """
+        Run mailctl.py with the given arguments, return exit code and output
+        """
+        output = io.StringIO()
+        code = 0
+        with contextlib.redirect_stdout(output):
+            try:
+                mailctl.MailCtl(['--config', self.config, '--db', self.db] + list(argv))
+            except SystemExit as error:
+                code = error.code
+        return code, output.getvalue()
+
+    def write(self, name, lines):
+        """
+        Write import file and return its path
+        """
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as stream:
+            stream.writelines(line + '\n' for line in lines)
+        return path
+
+    def import_jsonl(self, records, *argv):
+        """
+        Import records, strings are written as they are, return exit code and output
+        """
+        path = self.write('import.jsonl', [record if isinstance(record, str)
+                                           else json.dumps(record) for record in records])
+        return self.run_mailctl('import', '--rounds', '1000', '--workers', '1', path, *argv)
+
+    def aliases(self):
+        return self.execute('SELECT source, destination FROM virtual_aliases ORDER BY id')
+
+    def assertStatsMatch(self):
+        """
+        Check the domain statistics kept by triggers against a recount
+        """
+        self.assertEqual(
+            self.execute('SELECT domain_id, users, aliases, destinations, disabled '
+                         'FROM mailctl_domain_stats ORDER BY domain_id'),
+            self.execute('SELECT id, '
+                         '(SELECT count(*) FROM virtual_users WHERE domain_id = d.id), '
+                         '(SELECT count(DISTINCT source) FROM virtual_aliases '
+                         'WHERE domain_id = d.id), '
+                         '(SELECT count(*) FROM virtual_aliases WHERE domain_id = d.id), '
+                         '(SELECT count(*) FROM virtual_aliases '
+                         'WHERE domain_id = d.id AND NOT enabled) '
+                         'FROM virtual_domains d ORDER BY id'))
+
+    def test_import(self):
+        code, output = self.import_jsonl([
+            {'type': 'domain', 'name': 'sample.test'},
+            {'type': 'user', 'name': 'joe@sample.test'},
+            {'type': 'alias', 'name': 'team@sample.test', 'destination': 'joe@sample.test',
+             'description': 'Team'},
+        ])
+        self.assertEqual(code, 0)
+        self.assertIn('Imported 1 domains, 1 users and 1 aliases, 0 records failed', output)
+        self.assertEqual(self.aliases(), [('team@sample.test', 'joe@sample.test')])
+        self.assertEqual(self.execute("SELECT rowid FROM virtual_aliases_fts "
+                                      "WHERE virtual_aliases_fts MATCH '\"team@\"'"), [(1,)])
+        self.assertEqual(self.execute('SELECT table_name, count(*) FROM mailctl_changes '
+                                      'GROUP BY table_name ORDER BY table_name'),
+                         [('virtual_aliases', 1), ('virtual_domains', 1), ('virtual_users', 1)])
+        self.assertStatsMatch()
+
+    def test_invalid_records_are_skipped(self):
+        code, output = self.import_jsonl([
+            {'type': 'domain', 'name': 'sample.test'},
+            'not json',
+            '["a", "list"]',
+            {'type': 'alias', 'name': 'team@sample.test', 'destination': 42},
+            {'type': 'mailbox', 'name': 'joe@sample.test'},
+            {'type': 'user', 'name': ' '},
+            {'type': 'domain', 'name': 'sample.test'},
+            {'type': 'user', 'name': 'joe'},
+            {'type': 'user', 'name': 'joe@other.test'},
+            {'type': 'user', 'name': 'joe@sample.test'},
+            {'type': 'user', 'name': 'joe@sample.test'},
+            {'type': 'alias', 'name': 'team@sample.test', 'destination': 'jim@sample.test'},
+            {'type': 'alias', 'name': 'team@other.test', 'destination': 'joe@sample.test'},
+            {'type': 'alias', 'name': 'team@sample.test', 'destination': 'joe@sample.test'},
+            {'type': 'alias', 'name': 'team@sample.test', 'destination': 'joe@sample.test'},
+        ])
+        self.assertEqual(code, 1)
+        for message in ['Line 2: Invalid record',
+                        'Line 3: Invalid record',
+                        'Line 4: Invalid record',
+                        'Line 5: Invalid record type mailbox',
+                        'Line 6: Missing name',
+                        'Line 7: Domain sample.test already exists!',
+                        'Line 8: Invalid user name syntax. Needs to be user@domain.tld.',
+                        'Line 9: Domain other.test is not handled by this system.',
+                        'Line 11: User joe@sample.test already exists!',
+                        'Line 12: Invalid user jim@sample.test',
+                        'Line 13: other.test is not a domain managed by this server!',
+                        'Line 15: Alias team@sample.test -> joe@sample.test already exists!',
+                        'Imported 1 domains, 1 users and 1 aliases, 12 records failed']:
+            self.assertIn(message, output)
+        self.assertEqual(self.execute('SELECT email FROM virtual_users'), [('joe@sample.test',)])
+        self.assertEqual(self.aliases(), [('team@sample.test', 'joe@sample.test')])
+
+    def test_users_need_passlib(self):
+        with mock.patch.object(mailctl, 'passlib_enabled', return_value=False):
+            code, output = self.import_jsonl([
+                {'type': 'domain', 'name': 'sample.test'},
+                {'type': 'user', 'name': 'joe@sample.test'},
+            ])
+        self.assertEqual(code, 1)
+        self.assertIn('Line 2: Adding users is not enabled because the passlib module is '
+                      'missing.', output)
+        self.assertIn('Imported 1 domains, 0 users and 0 aliases, 1 records failed', output)
+
+    def test_failed_chunk_only_fails_its_records(self):
+        self.execute("CREATE TRIGGER reject BEFORE INSERT ON virtual_aliases "
+                     "WHEN new.source = 'reject@sample.test' BEGIN "
+                     "SELECT RAISE(ABORT, 'rejected'); END")
+        path = self.write('import.csv', [
+            'type,name,destination,description',
+            'domain,sample.test,,',
+            'user,joe@sample.test,,',
+            'alias,a@sample.test,joe@sample.test,',
+            'alias,reject@sample.test,joe@sample.test,',
+            'alias,b@sample.test,joe@sample.test,',
+            'alias,c@sample.test,joe@sample.test,',
+            # Records of a failed chunk can be given again
+            'alias,b@sample.test,joe@sample.test,',
+        ])
+        code, output = self.run_mailctl('import', '--rounds', '1000', '--workers', '1',
+                                        '--chunk-size', '2', path)
+        self.assertEqual(code, 1)
+        self.assertIn('Failed to import 2 records up to line 6: rejected', output)
+        self.assertIn('Imported 1 domains, 1 users and 3 aliases, 2 records failed', output)
+        self.assertEqual(self.aliases(), [('a@sample.test', 'joe@sample.test'),
+                                          ('c@sample.test', 'joe@sample.test'),
+                                          ('b@sample.test', 'joe@sample.test')])
+        # The rolled back chunk leaves neither index entries nor the bulk insert flag behind
+        self.assertEqual(self.execute("SELECT count(*) FROM virtual_aliases_fts "
+                                      "WHERE virtual_aliases_fts MATCH '\"@sample\"'"), [(3,)])
+        self.assertEqual(self.execute('SELECT count(*) FROM mailctl_changes '
+                                      "WHERE table_name = 'virtual_aliases'"), [(3,)])
+        self.assertEqual(self.execute('SELECT * FROM mailctl_settings'), [])
+        self.assertStatsMatch()
+
+    def test_failed_domain_only_fails_its_record(self):
+        self.execute("CREATE TRIGGER reject BEFORE INSERT ON virtual_domains "
+                     "WHEN new.name = 'reject.test' BEGIN "
+                     "SELECT RAISE(ABORT, 'rejected'); END")
+        code, output = self.import_jsonl([
+            {'type': 'domain', 'name': 'reject.test'},
+            {'type': 'domain', 'name': 'sample.test'},
+            {'type': 'user', 'name': 'joe@reject.test'},
+        ])
+        self.assertEqual(code, 1)
+        self.assertIn('Line 1: Failed to add domain reject.test: rejected', output)
+        self.assertIn('Line 3: Domain reject.test is not handled by this system.', output)
+        self.assertIn('Imported 1 domains, 0 users and 0 aliases, 2 records failed', output)
+        self.assertEqual(self.execute('SELECT name FROM virtual_domains'), [('sample.test',)])
+
+    def test_unreadable_files(self):
+        code, output = self.run_mailctl(
+            'import', os.path.join(self.directory.name, 'missing.csv'))
+        self.assertEqual(code, 1)
+        self.assertIn('Failed to open', output)
+        code, output = self.run_mailctl('import', self.write('import.txt', []))
+        self.assertEqual(code, 1)
+        self.assertIn('Unable to detect format of', output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+"""
+Tests of mailctl.py db migrate
+
+Migrates a database with the schema mailctl.py started out with, before any
+migration, and checks that duplicates are merged, that the existing rows are
+indexed and counted, and that the result matches contrib/db_schema.sql.
+"""
+
+import contextlib
+import io
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS, os.pardir))
+
+import mailctl  # noqa: E402
+
+# Tables as created by contrib/db_schema.sql before schema migrations existed
+BASELINE_SCHEMA = '''
+CREATE TABLE virtual_domains (
+  id INTEGER PRIMARY KEY ASC,
+  name TEXT NOT NULL
+);
+
+CREATE TABLE virtual_users (
+  id INTEGER PRIMARY KEY ASC,
+  domain_id INTEGER NOT NULL,
+  password TEXT NOT NULL,
+  email TEXT NOT NULL,
+  FOREIGN KEY (domain_id) REFERENCES virtual_domains(id) ON DELETE CASCADE
+);
+
+CREATE TABLE virtual_aliases (
+  id INTEGER PRIMARY KEY ASC,
+  domain_id INTEGER NOT NULL,
+  source TEXT NOT NULL,
+  destination TEXT NOT NULL,
+  created TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+  description TEXT,
+  enabled BOOLEAN DEFAULT 1,
+  FOREIGN KEY (domain_id) REFERENCES virtual_domains(id) ON DELETE CASCADE
+);
+'''
+
+# Rows of a database used without unique indexes, with a duplicate domain, user
+# and alias
+BASELINE_DATA = '''
+INSERT INTO virtual_domains (id, name) VALUES
+  (1, 'sample.test'), (2, 'other.test'), (3, 'sample.test');
+INSERT INTO virtual_users (id, domain_id, password, email) VALUES
+  (1, 1, 'hash', 'joe@sample.test'), (2, 3, 'hash', 'jim@sample.test'),
+  (3, 3, 'hash', 'joe@sample.test'), (4, 2, 'hash', 'ann@other.test');
+INSERT INTO virtual_aliases (id, domain_id, source, destination, enabled) VALUES
+  (1, 1, 'team@sample.test', 'joe@sample.test', 1),
+  (2, 3, 'team@sample.test', 'jim@sample.test', 0),
+  (3, 3, 'team@sample.test', 'joe@sample.test', 1),
+  (4, 2, 'info@other.test', 'ann@other.test', 1);
+'''
+
+
+def normalize(sql):
+    """
+    Return SQL with whitespace collapsed, for comparing schema definitions
+    """
+    return re.sub(r'\s*([(),;=])\s*', r'\1', ' '.join(sql.split())) if sql else sql
+
+
+class MigrationTest(unittest.TestCase):
+    """
+    Schema migrations applied to a baseline database
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.db = os.path.join(self.directory.name, 'mail.sqlite')
+        self.config = os.path.join(self.directory.name, 'mailctl.conf')
+        open(self.config, 'w').close()
+        self.execute(BASELINE_SCHEMA + BASELINE_DATA, script=True)
+
+    def execute(self, sql, params=(), script=False, db=None):
+        """
+        Run SQL on a connection of its own and return all rows
+        """
+        connection = sqlite3.connect(db or self.db)
+        try:
+            with connection:
+                if script:
+                    connection.executescript(sql)
+                    return []
+                return connection.execute(sql, params).fetchall()
+        finally:
+            connection.close()
+
+    def run_mailctl(self, *argv):
+        """
+        Run mailctl.py with the given arguments, return exit code and output
+        """
+        output = io.StringIO()
+        code = 0
+        with contextlib.redirect_stdout(output):
+            try:
+                mailctl.MailCtl(['--config', self.config, '--db', self.db] + list(argv))
+            except SystemExit as error:
+                code = error.code
+        return code, output.getvalue()
+
+    def schema(self, db):
+        """
+        Return normalized SQL of all schema objects by type and name
+        """
+        return {(kind, name): normalize(sql) for kind, name, sql in self.execute(
+            "SELECT type, name, sql FROM sqlite_master WHERE name NOT LIKE 'sqlite_%'",
+            db=db)}
+
+    def assertStatsMatch(self):
+        """
+        Check the domain statistics kept by triggers against a recount
+        """
+        self.assertEqual(
+            self.execute('SELECT domain_id, users, aliases, destinations, disabled '
+                         'FROM mailctl_domain_stats ORDER BY domain_id'),
+            self.execute('SELECT id, '
+                         '(SELECT count(*) FROM virtual_users WHERE domain_id = d.id), '
+                         '(SELECT count(DISTINCT source) FROM virtual_aliases '
+                         'WHERE domain_id = d.id), '
+                         '(SELECT count(*) FROM virtual_aliases WHERE domain_id = d.id), '
+                         '(SELECT count(*) FROM virtual_aliases '
+                         'WHERE domain_id = d.id AND NOT enabled) '
+                         'FROM virtual_domains d ORDER BY id'))
+
+    def test_migrate_from_baseline(self):
+        code, output = self.run_mailctl('db', 'migrate')
+        self.assertEqual(code, 0)
+        for version, (description, statements) in enumerate(mailctl.Database.MIGRATIONS, 1):
+            self.assertIn('Applied schema migration {} ({})'.format(version, description),
+                          output)
+        self.assertEqual(self.execute('PRAGMA user_version'),
+                         [(len(mailctl.Database.MIGRATIONS),)])
+        # Duplicates are merged into the oldest row
+        self.assertEqual(self.execute('SELECT id, name FROM virtual_domains ORDER BY id'),
+                         [(1, 'sample.test'), (2, 'other.test')])
+        self.assertEqual(self.execute('SELECT id, domain_id, email FROM virtual_users '
+                                      'ORDER BY id'),
+                         [(1, 1, 'joe@sample.test'), (2, 1, 'jim@sample.test'),
+                          (4, 2, 'ann@other.test')])
+        self.assertEqual(self.execute('SELECT id, domain_id FROM virtual_aliases ORDER BY id'),
+                         [(1, 1), (2, 1), (4, 2)])
+        # Existing rows are indexed and counted, but not logged as changes
+        self.assertEqual(self.execute("SELECT rowid FROM virtual_aliases_fts "
+                                      "WHERE virtual_aliases_fts MATCH '\"team@\"' "
+                                      "ORDER BY rowid"), [(1,), (2,)])
+        self.assertEqual(self.execute('SELECT count(*) FROM mailctl_changes'), [(0,)])
+        self.assertEqual(self.execute('SELECT domain_id, users, aliases, destinations, disabled '
+                                      'FROM mailctl_domain_stats ORDER BY domain_id'),
+                         [(1, 2, 1, 2, 1), (2, 1, 1, 1, 0)])
+
+        code, output = self.run_mailctl('db', 'migrate')
+        self.assertEqual(code, 0)
+        self.assertIn('Database schema is up to date (version {})'.format(
+            len(mailctl.Database.MIGRATIONS)), output)
+
+    def test_migrated_schema_matches_schema_file(self):
+        self.run_mailctl('db', 'migrate')
+        created = os.path.join(self.directory.name, 'created.sqlite')
+        with open(os.path.join(TESTS, os.pardir, 'contrib', 'db_schema.sql')) as schema:
+            self.execute(schema.read(), script=True, db=created)
+        self.assertEqual(self.schema(self.db), self.schema(created))
+        self.assertEqual(self.execute('PRAGMA user_version'),
+                         self.execute('PRAGMA user_version', db=created))
+
+    def test_triggers_after_migration(self):
+        self.run_mailctl('db', 'migrate')
+        db = mailctl.Database(self.db)
+        # One row at a time and in bulk
+        with db.transaction():
+            db.add_alias('single@sample.test', 'jim@sample.test', '', 1)
+        db.add_aliases([('bulk@sample.test', 'joe@sample.test', '', 1),
+                        ('bulk@sample.test', 'jim@sample.test', '', 1),
+                        ('team@sample.test', 'ann@other.test', '', 1),
+                        ('info@other.test', 'joe@sample.test', '', 2)])
+        db.conn.close()
+        self.assertEqual(self.execute('SELECT count(*) FROM virtual_aliases_fts '
+                                      "WHERE virtual_aliases_fts MATCH '\"@sample\"'"), [(7,)])
+        self.assertEqual(self.execute('SELECT operation, count(*) FROM mailctl_changes '
+                                      "WHERE table_name = 'virtual_aliases' "
+                                      'GROUP BY operation'), [('insert', 5)])
+        self.assertEqual(self.execute('SELECT * FROM mailctl_settings'), [])
+        self.assertStatsMatch()
+        self.execute("DELETE FROM virtual_aliases WHERE source = 'team@sample.test'")
+        self.assertStatsMatch()
+
+    def test_newer_schema_is_refused(self):
+        version = len(mailctl.Database.MIGRATIONS) + 1
+        self.execute('PRAGMA user_version = {:d}'.format(version))
+        code, output = self.run_mailctl('db', 'migrate')
+        self.assertEqual(code, 1)
+        self.assertIn('Database schema version {} is newer than this tool supports'.format(
+            version), output)
+
+    def test_failed_migration_is_rolled_back(self):
+        # The full text index of migration 2 can not be rebuilt into a view
+        self.execute('CREATE VIEW virtual_aliases_fts AS SELECT * FROM virtual_aliases')
+        code, output = self.run_mailctl('db', 'migrate')
+        self.assertEqual(code, 1)
+        self.assertIn('Applied schema migration 1', output)
+        self.assertIn('Failed to apply schema migration 2 (full text search index on aliases)',
+                      output)
+        self.assertEqual(self.execute('PRAGMA user_version'), [(1,)])
+        self.assertEqual(self.execute("SELECT name FROM sqlite_master "
+                                      "WHERE name IN ('mailctl_settings', "
+                                      "'virtual_aliases_fts_insert')"), [])
+
+
+if __name__ == '__main__':
+    unittest.main()